@@ -0,0 +1,9 @@
+"""Offline benchmarks of the ingestion and query paths, run with:
+
+    python -m benchmarks --corpus-sizes 100 1000 --batch-sizes 32 256
+
+The embeddings and the LLM are deterministic fakes, so the runs need no API
+key and are comparable from one commit to the next. The pgvector store is
+benchmarked when the Postgres of the POSTGRES_* environment variables is
+reachable.
+"""
@@ -0,0 +1,69 @@
+import argparse
+import json
+import logging
+
+
+from .runner import format_results, run_suite
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the ingestion and query paths with fake embeddings and LLM",
+    )
+    parser.add_argument(
+        "--stores",
+        nargs="+",
+        default=["numpy", "pgvector"],
+        choices=["numpy", "pgvector"],
+    )
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 256])
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--words-per-document", type=int, default=500)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--vector-dimension", type=int, default=384)
+    parser.add_argument(
+        "--embedding-latency", type=float, default=0.0, help="Seconds per call"
+    )
+    parser.add_argument(
+        "--embedding-latency-per-text", type=float, default=0.0, help="Seconds per text"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.0, help="Seconds per response"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip the second run of each case measuring the peak memory",
+    )
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    results = run_suite(
+        stores=args.stores,
+        corpus_sizes=args.corpus_sizes,
+        batch_sizes=args.batch_sizes,
+        num_questions=args.questions,
+        words_per_document=args.words_per_document,
+        trace_memory=not args.no_memory,
+        seed=args.seed,
+        k=args.k,
+        vector_dimension=args.vector_dimension,
+        embedding_latency=args.embedding_latency,
+        embedding_latency_per_text=args.embedding_latency_per_text,
+        llm_latency=args.llm_latency,
+    )
+
+    print(format_results(results))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
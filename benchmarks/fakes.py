@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+
+import numpy as np
+
+
+from rag.base import RAGSystem
+
+
+def _seed(*values):
+    digest = hashlib.sha256(repr(values).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+class FakeEmbeddings:
+    """Deterministic embeddings: the normalized sum of seeded random vectors
+    of the words of the text, so texts sharing words are similar and the
+    searches retrieve meaningful chunks. Each call sleeps latency seconds
+    plus latency_per_text seconds per text, like a provider or a model"""
+
+    def __init__(self, dimension=384, seed=0, latency=0.0, latency_per_text=0.0):
+        self.dimension = dimension
+        self.seed = seed
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+
+        self._lock = threading.Lock()
+        self._word_vectors = {}
+        self.calls = 0
+        self.texts = 0
+
+    def _word_vector(self, word):
+        word_vector = self._word_vectors.get(word)
+
+        if word_vector is None:
+            word_vector = (
+                np.random.default_rng(_seed(self.seed, word))
+                .standard_normal(self.dimension)
+                .astype(np.float32)
+            )
+            self._word_vectors[word] = word_vector
+
+        return word_vector
+
+    def embed(self, text):
+        with self._lock:
+            word_vectors = [self._word_vector(word) for word in text.lower().split()]
+
+        if not word_vectors:
+            return np.zeros(self.dimension, dtype=np.float32)
+
+        embedding_vector = np.sum(word_vectors, axis=0)
+        norm = np.linalg.norm(embedding_vector)
+        return embedding_vector / norm if norm else embedding_vector
+
+    def _latency(self, texts):
+        with self._lock:
+            self.calls += 1
+            self.texts += len(texts)
+
+        return self.latency + self.latency_per_text * len(texts)
+
+    def get_batch_embedding_vectors(self, texts):
+        latency = self._latency(texts)
+        if latency:
+            time.sleep(latency)
+
+        return np.array([self.embed(text) for text in texts], dtype=np.float32)
+
+    async def aget_batch_embedding_vectors(self, texts):
+        latency = self._latency(texts)
+        if latency:
+            await asyncio.sleep(latency)
+
+        return np.array([self.embed(text) for text in texts], dtype=np.float32)
+
+
+class FakeLLM:
+    """Responder answering every prompt with the same text after latency
+    seconds"""
+
+    def __init__(self, latency=0.0, response="This is a fake answer."):
+        self.latency = latency
+        self.response = response
+
+    def generate_response(self, messages):
+        if self.latency:
+            time.sleep(self.latency)
+
+        return self.response
+
+    async def agenerate_response(self, messages):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        return self.response
+
+
+def fake_rag_system(vector_store, embeddings=None, llm=None, **kwargs):
+    """RAG system answering with the fake embeddings and LLM"""
+    embeddings = embeddings if embeddings is not None else FakeEmbeddings()
+    llm = llm if llm is not None else FakeLLM()
+
+    return RAGSystem(
+        vector_store=vector_store,
+        get_batch_embedding_vectors=embeddings.get_batch_embedding_vectors,
+        aget_batch_embedding_vectors=embeddings.aget_batch_embedding_vectors,
+        generate_response=llm.generate_response,
+        agenerate_response=llm.agenerate_response,
+        **kwargs
+    )
+
+
+def make_vocabulary(size=5000, seed=0):
+    rng = np.random.default_rng(_seed(seed, "vocabulary"))
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add("".join(rng.choice(letters, rng.integers(3, 10))))
+
+    return sorted(vocabulary)
+
+
+def make_corpus(num_documents, words_per_document=500, vocabulary=None, seed=0):
+    """Documents of random words, drawn from a Zipf-like distribution over
+    the vocabulary like the words of natural text"""
+    vocabulary = vocabulary if vocabulary is not None else make_vocabulary(seed=seed)
+    rng = np.random.default_rng(_seed(seed, "corpus"))
+
+    probabilities = 1 / np.arange(1, len(vocabulary) + 1)
+    probabilities /= probabilities.sum()
+
+    documents = []
+    for _ in range(num_documents):
+        words = rng.choice(vocabulary, words_per_document, p=probabilities)
+        sentences = [
+            " ".join(sentence) + "."
+            for sentence in np.array_split(words, max(1, words_per_document // 15))
+        ]
+        documents.append(" ".join(sentences))
+
+    return documents
+
+
+def make_questions(corpus, num_questions, words_per_question=8, seed=0):
+    """Questions made of consecutive words of random documents of the
+    corpus, so each has a known relevant document"""
+    rng = np.random.default_rng(_seed(seed, "questions"))
+
+    questions = []
+    for _ in range(num_questions):
+        words = corpus[rng.integers(len(corpus))].split()
+        start = rng.integers(max(1, len(words) - words_per_question))
+        questions.append(" ".join(words[start : start + words_per_question]) + "?")
+
+    return questions
@@ -0,0 +1,316 @@
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+
+
+import numpy as np
+import psycopg
+from psycopg import sql
+
+
+from rag.instrumentation import Instrumentation
+from rag.vector_store.numpy_vectorstore import NumpyVectorDB
+
+
+from .fakes import FakeEmbeddings, FakeLLM, fake_rag_system, make_corpus, make_questions
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingInstrumentation(Instrumentation):
+    """Keep every stage duration, for exact latency percentiles"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_durations = collections.defaultdict(list)
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_duration(name, time.perf_counter() - start)
+
+    def observe_duration(self, stage, seconds):
+        with self._lock:
+            self.stage_durations[stage].append(seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def stage_percentiles(self):
+        """p50, p95 and p99 durations of each stage, in milliseconds"""
+        with self._lock:
+            return {
+                stage: dict(
+                    count=len(durations),
+                    **{
+                        "p%s_ms" % q: float(np.percentile(durations, q) * 1000)
+                        for q in (50, 95, 99)
+                    }
+                )
+                for stage, durations in sorted(self.stage_durations.items())
+            }
+
+
+def pgvector_available():
+    """Whether the Postgres of the POSTGRES_* environment variables accepts
+    connections"""
+    try:
+        psycopg.connect(
+            host=os.getenv("POSTGRES_HOST", "localhost"),
+            port=os.getenv("POSTGRES_PORT", 5432),
+            dbname=os.getenv("POSTGRES_DB", "postgres"),
+            user=os.getenv("POSTGRES_USER", "postgres"),
+            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+            connect_timeout=3,
+        ).close()
+    except psycopg.OperationalError as e:
+        logger.warning("Postgres is not available, skipping pgvector: %s", e)
+        return False
+
+    return True
+
+
+@contextlib.contextmanager
+def vector_store(name, vector_dimension):
+    """Empty vector store of the given kind, dropped afterwards"""
+    if name == "numpy":
+        store = NumpyVectorDB(vector_dimension=vector_dimension)
+        try:
+            yield store
+        finally:
+            store.close()
+
+    elif name == "pgvector":
+        from rag.vector_store.pgvector_vectorstore import PgVectorVectorDB
+
+        store = PgVectorVectorDB.initialize_from_env_variables(
+            vector_dimension=vector_dimension,
+            table_name="benchmark_%s" % uuid.uuid4().hex[:12],
+            create_extension=True,
+        )
+        try:
+            yield store
+        finally:
+            with store._connection() as conn:
+                conn.rollback()
+                conn.execute(
+                    sql.SQL("DROP TABLE IF EXISTS {table_name}").format(
+                        table_name=sql.Identifier(store.table_name)
+                    )
+                )
+                conn.commit()
+
+            store.close()
+
+    else:
+        raise ValueError("Unknown vector store %s" % name)
+
+
+@contextlib.contextmanager
+def _measure(result, trace_memory):
+    """Time the block and record its peak traced memory in result"""
+    if trace_memory:
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    yield
+    result["seconds"] = time.perf_counter() - start
+
+    if trace_memory:
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+
+
+def _ingest(rag, corpus, method, batch_size):
+    if method == "add_documents":
+        rag.add_documents(
+            ((text, {"document": i}) for i, text in enumerate(corpus)),
+            embedding_batch_size=batch_size,
+        )
+    else:
+        for i, text in enumerate(corpus):
+            rag.add_document(text, {"document": i}, batch_size=batch_size)
+
+
+def run_case(
+    store_name,
+    corpus,
+    questions,
+    batch_size,
+    ingestion_methods=("add_document", "add_documents"),
+    k=3,
+    vector_dimension=384,
+    embedding_latency=0.0,
+    embedding_latency_per_text=0.0,
+    llm_latency=0.0,
+    trace_memory=False,
+    seed=0,
+):
+    """Ingest the corpus in a fresh vector store with each ingestion method,
+    then answer the questions one by one and with query_many. Returns a dict
+    per measurement"""
+    results = []
+
+    for method in ingestion_methods:
+        embeddings = FakeEmbeddings(
+            vector_dimension, seed, embedding_latency, embedding_latency_per_text
+        )
+
+        with vector_store(store_name, vector_dimension) as store:
+            instrumentation = RecordingInstrumentation()
+            rag = fake_rag_system(
+                store,
+                embeddings,
+                FakeLLM(llm_latency),
+                instrumentation=instrumentation,
+            )
+
+            result = {"case": method, "unit": "chunks"}
+            with _measure(result, trace_memory):
+                _ingest(rag, corpus, method, batch_size)
+
+            result["items"] = instrumentation.counters["chunks"]
+            result["stages"] = instrumentation.stage_percentiles()
+            results.append(result)
+
+            if method != ingestion_methods[-1]:
+                continue
+
+            # The queries run against the store of the last ingestion
+            for case in ("query", "query_many"):
+                rag.instrumentation = instrumentation = RecordingInstrumentation()
+
+                result = {"case": case, "unit": "queries", "items": len(questions)}
+                with _measure(result, trace_memory):
+                    if case == "query":
+                        for question in questions:
+                            rag.query(question, k)
+                    else:
+                        rag.query_many(questions, k)
+
+                result["stages"] = instrumentation.stage_percentiles()
+                results.append(result)
+
+    for result in results:
+        result.update(
+            store=store_name,
+            corpus_size=len(corpus),
+            batch_size=batch_size,
+            throughput=result["items"] / result["seconds"] if result["seconds"] else 0,
+        )
+
+    return results
+
+
+def run_suite(
+    stores=("numpy", "pgvector"),
+    corpus_sizes=(100, 1000),
+    batch_sizes=(32, 256),
+    num_questions=100,
+    words_per_document=500,
+    trace_memory=True,
+    seed=0,
+    **kwargs
+):
+    """Run the benchmark cases for each vector store, corpus size and batch
+    size. The corpora and questions only depend on the seed, so the runs are
+    comparable.
+
+    tracemalloc slows down the allocations a lot, so with trace_memory the
+    peak memory is measured by a second run of each case"""
+    if "pgvector" in stores and not pgvector_available():
+        stores = [store for store in stores if store != "pgvector"]
+
+    results = []
+    for corpus_size in corpus_sizes:
+        corpus = make_corpus(corpus_size, words_per_document, seed=seed)
+        questions = make_questions(corpus, num_questions, seed=seed)
+
+        for store_name in stores:
+            for batch_size in batch_sizes:
+                logger.info(
+                    "Benchmarking %s with %s documents, batch size %s",
+                    store_name,
+                    corpus_size,
+                    batch_size,
+                )
+                case_results = run_case(
+                    store_name,
+                    corpus,
+                    questions,
+                    batch_size,
+                    trace_memory=False,
+                    seed=seed,
+                    **kwargs
+                )
+
+                if trace_memory:
+                    tracemalloc.start()
+                    try:
+                        memory_results = run_case(
+                            store_name,
+                            corpus,
+                            questions,
+                            batch_size,
+                            trace_memory=True,
+                            seed=seed,
+                            **kwargs
+                        )
+                    finally:
+                        tracemalloc.stop()
+
+                    for result, memory_result in zip(case_results, memory_results):
+                        result["peak_memory_mb"] = memory_result["peak_memory_mb"]
+
+                results.extend(case_results)
+
+    return results
+
+
+def format_results(results):
+    lines = [
+        "%-9s %7s %6s %-14s %12s %10s %10s"
+        % ("store", "corpus", "batch", "case", "throughput", "seconds", "peak MB")
+    ]
+
+    for result in results:
+        lines.append(
+            "%-9s %7s %6s %-14s %10.1f/s %10.3f %10s"
+            % (
+                result["store"],
+                result["corpus_size"],
+                result["batch_size"],
+                result["case"],
+                result["throughput"],
+                result["seconds"],
+                (
+                    "%.1f" % result["peak_memory_mb"]
+                    if "peak_memory_mb" in result
+                    else "-"
+                ),
+            )
+        )
+
+        for stage, percentiles in result["stages"].items():
+            lines.append(
+                "    %-24s n=%-7s p50=%.3fms p95=%.3fms p99=%.3fms"
+                % (
+                    stage,
+                    percentiles["count"],
+                    percentiles["p50_ms"],
+                    percentiles["p95_ms"],
+                    percentiles["p99_ms"],
+                )
+            )
+
+    return "\n".join(lines)
@@ -1,32 +1,90 @@
+import json
 import os
-from typing import Generator
+import queue
+import uuid
+from contextlib import asynccontextmanager
 
 
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 
+from rag.embedding_batcher import EmbeddingMicroBatcher
+from rag.ingestion import IngestionQueue
+from rag.instrumentation import MetricsInstrumentation
 from rag.litellm_rag import LiteLlmRAGSystem
-from rag.vector_store.pgvector_vectorstore import PgVectorVectorDB
+from rag.vector_store.pgvector_vectorstore import (
+    AsyncPgVectorVectorDB,
+    PgVectorVectorDB,
+)
 
 
 API_KEY = os.getenv("LLM_API_KEY")
 EMBEDDING_MODEL = "text-embedding-ada-002"
 EMBEDDING_MODEL_VECTOR_DIMENSION = 1536
 LLM_MODEL = "gpt-4o-mini"
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", 10))
+INGESTION_EMBEDDING_WORKERS = int(os.getenv("INGESTION_EMBEDDING_WORKERS", 2))
+INGESTION_WRITER_WORKERS = int(os.getenv("INGESTION_WRITER_WORKERS", 2))
+INGESTION_MAX_PENDING_JOBS = int(os.getenv("INGESTION_MAX_PENDING_JOBS", 100))
+EMBEDDING_MICRO_BATCH_WAIT = float(os.getenv("EMBEDDING_MICRO_BATCH_WAIT", 0.005))
 
 
-def get_rag() -> Generator[LiteLlmRAGSystem, None, None]:
-    rag = LiteLlmRAGSystem(
+instrumentation = MetricsInstrumentation()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One RAG system and one connection pool for the lifetime of the app
+    app.state.rag = LiteLlmRAGSystem(
+        embedding_model=EMBEDDING_MODEL,
+        llm_model=LLM_MODEL,
+        api_key=API_KEY,
+        vector_store=await AsyncPgVectorVectorDB.initialize_from_env_variables(
+            vector_dimension=EMBEDDING_MODEL_VECTOR_DIMENSION,
+            pool_size=POSTGRES_POOL_SIZE,
+        ).open(),
+        instrumentation=instrumentation,
+        # The question embeddings of concurrent queries are requested together
+        embedding_micro_batcher=EmbeddingMicroBatcher(
+            max_wait=EMBEDDING_MICRO_BATCH_WAIT
+        ),
+    )
+
+    # Documents are ingested in the background by worker threads, with their
+    # own RAG system and connection pool, so ingestion doesn't compete with
+    # the queries for database connections
+    ingestion_rag = LiteLlmRAGSystem(
         embedding_model=EMBEDDING_MODEL,
         llm_model=LLM_MODEL,
         api_key=API_KEY,
         vector_store=PgVectorVectorDB.initialize_from_env_variables(
-            vector_dimension=EMBEDDING_MODEL_VECTOR_DIMENSION
+            vector_dimension=EMBEDDING_MODEL_VECTOR_DIMENSION,
+            pool_size=INGESTION_WRITER_WORKERS,
         ),
+        instrumentation=instrumentation,
     )
-    yield rag
-    rag.close()
+    app.state.ingestion_queue = IngestionQueue(
+        ingestion_rag,
+        embedding_workers=INGESTION_EMBEDDING_WORKERS,
+        writer_workers=INGESTION_WRITER_WORKERS,
+        max_pending_jobs=INGESTION_MAX_PENDING_JOBS,
+    ).start()
+
+    yield
+
+    app.state.ingestion_queue.close()
+    ingestion_rag.close()
+    await app.state.rag.aclose()
+
+
+def get_rag(request: Request) -> LiteLlmRAGSystem:
+    return request.app.state.rag
+
+
+def get_ingestion_queue(request: Request) -> IngestionQueue:
+    return request.app.state.ingestion_queue
 
 
 class DocumentRequest(BaseModel):
@@ -44,27 +102,114 @@ class StatusResponse(BaseModel):
 
 
 class AddDocumentResponse(StatusResponse):
-    pass
+    job_id: str
+
+
+class JobResponse(BaseModel):
+    id: str
+    document_uuid: str
+    status: str
+    error: str | None
+    chunks_total: int | None
+    chunks_embedded: int
+    chunks_stored: int
+    created_at: float
+    finished_at: float | None
 
 
 class QueryResponse(StatusResponse):
     answer: str
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
+# The documents are queued for ingestion in the background, their progress is
+# reported by /jobs/{job_id}. The request is rejected with 503 when the queue
+# is full
 @app.post("/add-document")
 async def add_document(
-    doc: DocumentRequest, rag: PgVectorVectorDB = Depends(get_rag)
-) -> StatusResponse:
-    rag.add_document(text=doc.text, metadata=doc.metadata)
-    return AddDocumentResponse(status=True)
+    doc: DocumentRequest,
+    ingestion_queue: IngestionQueue = Depends(get_ingestion_queue),
+) -> AddDocumentResponse:
+    try:
+        job = ingestion_queue.submit(text=doc.text, metadata=doc.metadata, block=False)
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="The ingestion queue is full")
+
+    return AddDocumentResponse(ok=True, job_id=str(job.id))
+
+
+@app.get("/jobs")
+async def jobs(
+    ingestion_queue: IngestionQueue = Depends(get_ingestion_queue),
+) -> list[JobResponse]:
+    return [JobResponse(**job.to_dict()) for job in ingestion_queue.jobs()]
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(
+    job_id: uuid.UUID,
+    ingestion_queue: IngestionQueue = Depends(get_ingestion_queue),
+) -> JobResponse:
+    job = ingestion_queue.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+
+    return JobResponse(**job.to_dict())
+
+
+# The query endpoints use the asyncio API of the RAG system, so embedding, LLM
+# and database calls never block the event loop and concurrent requests share
+# the RAG system, each one checking out its own pooled connection
 
 
 @app.post("/query")
 async def query(
-    req: QueryRequest, rag: PgVectorVectorDB = Depends(get_rag)
+    req: QueryRequest, rag: LiteLlmRAGSystem = Depends(get_rag)
 ) -> QueryResponse:
-    answer = rag.query(question=req.question, k=req.k)
-    return QueryResponse(status=True, answer=answer)
+    answer = await rag.aquery(question=req.question, k=req.k)
+    return QueryResponse(ok=True, answer=answer)
+
+
+def server_sent_event(event, data):
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
+
+@app.post("/query-stream")
+async def query_stream(
+    req: QueryRequest, rag: LiteLlmRAGSystem = Depends(get_rag)
+) -> StreamingResponse:
+    """Stream the answer as server-sent events: first a "documents" event
+    with the retrieved documents, then a "token" event per generated piece
+    of the answer and finally a "done" event"""
+    relevant_docs, tokens = await rag.aquery_stream(question=req.question, k=req.k)
+
+    async def events():
+        yield server_sent_event(
+            "documents",
+            [
+                {
+                    "id": doc.id,
+                    "collection_uuid": str(doc.collection_uuid),
+                    "metadata": doc.metadata,
+                }
+                for doc in relevant_docs
+            ],
+        )
+
+        async for token in tokens:
+            yield server_sent_event("token", token)
+
+        yield server_sent_event("done", None)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    """Stage latencies, batch sizes and counters in the Prometheus text
+    format"""
+    return PlainTextResponse(
+        instrumentation.render_prometheus(), media_type="text/plain; version=0.0.4"
+    )
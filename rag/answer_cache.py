@@ -0,0 +1,166 @@
+import collections
+import logging
+import threading
+import time
+
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerCacheEntry:
+    __slots__ = (
+        "answer",
+        "document_chunk_ids",
+        "collection_uuids",
+        "expires_at",
+    )
+
+    def __init__(self, answer, document_chunk_ids, collection_uuids, expires_at):
+        self.answer = answer
+        self.document_chunk_ids = document_chunk_ids
+        self.collection_uuids = collection_uuids
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    """Cache of the answers of past questions, looked up by the similarity
+    of the question embeddings.
+
+    A cached answer is returned for a question whose embedding has a cosine
+    similarity of at least similarity_threshold with the one of a past
+    question, when the document chunks retrieved for it are the same ones the
+    answer was generated from. The entries expire after ttl seconds, the
+    least recently used ones are evicted beyond max_size entries and the ones
+    generated from a collection are dropped by invalidate_collection.
+
+    The question embeddings are kept in a NumPy matrix searched exhaustively,
+    which is fast for the few thousand entries this cache is meant for.
+    """
+
+    def __init__(self, similarity_threshold=0.95, max_size=1000, ttl=3600):
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._embeddings = None
+        # Entries by slot in the embedding matrix, least recently used first
+        self._entries = collections.OrderedDict()
+        self._free_slots = list(range(max_size - 1, -1, -1))
+        self._active = np.zeros(max_size, dtype=bool)
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding_vector):
+        embedding_vector = np.asarray(embedding_vector, dtype=np.float32)
+        norm = np.linalg.norm(embedding_vector)
+        return embedding_vector / norm if norm else embedding_vector
+
+    def _remove(self, slot):
+        del self._entries[slot]
+        self._active[slot] = False
+        self._free_slots.append(slot)
+
+    def _remove_expired(self):
+        now = time.monotonic()
+
+        for slot in [
+            slot
+            for slot, entry in self._entries.items()
+            if entry.expires_at is not None and entry.expires_at < now
+        ]:
+            self._remove(slot)
+
+    def get(self, question_embedding, document_chunks):
+        """Return the cached answer for the question, or None. The entries
+        above the similarity threshold are tried from the most similar one,
+        the first generated from the same document chunks is returned"""
+        document_chunk_ids = tuple(
+            document_chunk.id for document_chunk in document_chunks
+        )
+
+        with self._lock:
+            self._remove_expired()
+
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            similarities = self._embeddings @ self._normalize(question_embedding)
+            similarities[~self._active] = -np.inf
+
+            slots = np.flatnonzero(similarities >= self.similarity_threshold)
+
+            for slot in slots[np.argsort(-similarities[slots], kind="stable")]:
+                slot = int(slot)
+                entry = self._entries[slot]
+
+                if entry.document_chunk_ids == document_chunk_ids:
+                    self._entries.move_to_end(slot)
+                    self.hits += 1
+
+                    return entry.answer
+
+            self.misses += 1
+            return None
+
+    def set(self, question_embedding, document_chunks, answer):
+        question_embedding = self._normalize(question_embedding)
+
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros(
+                    (self.max_size, len(question_embedding)), dtype=np.float32
+                )
+
+            if not self._free_slots:
+                # Evict the least recently used entry
+                self._remove(next(iter(self._entries)))
+
+            slot = self._free_slots.pop()
+
+            self._embeddings[slot] = question_embedding
+            self._active[slot] = True
+            self._entries[slot] = AnswerCacheEntry(
+                answer,
+                tuple(document_chunk.id for document_chunk in document_chunks),
+                {document_chunk.collection_uuid for document_chunk in document_chunks},
+                time.monotonic() + self.ttl if self.ttl is not None else None,
+            )
+
+    def invalidate_collection(self, collection_uuid):
+        """Drop the answers generated from chunks of the collection"""
+        with self._lock:
+            slots = [
+                slot
+                for slot, entry in self._entries.items()
+                if collection_uuid in entry.collection_uuids
+            ]
+
+            for slot in slots:
+                self._remove(slot)
+
+        if slots:
+            logger.debug(
+                "Invalidated %s cached answers of collection %s",
+                len(slots),
+                collection_uuid,
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            for slot in list(self._entries):
+                self._remove(slot)
@@ -1,9 +1,18 @@
+import asyncio
+import concurrent.futures
+import functools
+import itertools
 import os
 import logging
+import time
 import uuid
 
 
-from .text_splitters import chunk_text
+from .context import ContextPacker, PackedContext, count_words
+from .instrumentation import Instrumentation
+from .text_splitters import TextChunk, WordTextSplitter
+from .utils import batched, content_hash
+from .vector_store.base import MissingEmbeddingsError
 
 
 logger = logging.getLogger(__name__)
@@ -15,40 +24,166 @@ class RAGSystem:
         vector_store=None,
         get_batch_embedding_vectors=None,
         generate_response=None,
-        text_splitter=chunk_text,
+        text_splitter=WordTextSplitter(),
         max_document_length_text=1500,
         system_message="Answer based on the context. If unsure, say you don't know. Cite sources when possible.",
+        aget_batch_embedding_vectors=None,
+        agenerate_response=None,
+        embedding_cache=None,
+        instrumentation=None,
+        hybrid_search=False,
+        reranker=None,
+        rerank_candidates=20,
+        context_max_tokens=None,
+        answer_cache=None,
+        embedding_micro_batcher=None,
     ):
         self.vector_store = vector_store
+        # Retrieve with the hybrid (vector + full text) search of the vector
+        # store instead of the similarity search
+        self.hybrid_search = hybrid_search
+
+        # With a reranker, rerank_candidates candidates are retrieved and
+        # reranked to keep the best k
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+
+        # With context_max_tokens, merges the overlapping chunks and packs
+        # them in context_max_tokens tokens, counted with the tokenizer of the
+        # model. Without it the chunks are joined as they are
+        self.context_packer = (
+            ContextPacker(max_tokens=context_max_tokens, count_tokens=self.count_tokens)
+            if context_max_tokens is not None
+            else None
+        )
         self.max_document_length_text = max_document_length_text
         self.system_message = system_message
 
         self.text_splitter = text_splitter
 
+        self.instrumentation = (
+            instrumentation if instrumentation is not None else Instrumentation()
+        )
+
         if get_batch_embedding_vectors is not None:
             self.get_batch_embedding_vectors = get_batch_embedding_vectors
 
         if generate_response is not None:
             self.generate_response = generate_response
 
+        if aget_batch_embedding_vectors is not None:
+            self.aget_batch_embedding_vectors = aget_batch_embedding_vectors
+
+        if agenerate_response is not None:
+            self.agenerate_response = agenerate_response
+
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+
+        # Coalesces the embedding requests of concurrent questions in batches
+        self.embedding_micro_batcher = embedding_micro_batcher
+
+        if embedding_cache is not None:
+            self._use_embedding_cache(embedding_cache)
+
+    def _use_embedding_cache(self, embedding_cache):
+        model = self.get_embedding_model_name()
+
+        # The default asyncio implementation runs get_batch_embedding_vectors
+        # in a thread, it only has to be wrapped when it's overridden
+        if (
+            "aget_batch_embedding_vectors" in self.__dict__
+            or type(self).aget_batch_embedding_vectors
+            is not RAGSystem.aget_batch_embedding_vectors
+        ):
+            self.aget_batch_embedding_vectors = functools.partial(
+                embedding_cache.aget_batch_embedding_vectors,
+                aget_batch_embedding_vectors=self.aget_batch_embedding_vectors,
+                model=model,
+            )
+
+        self.get_batch_embedding_vectors = functools.partial(
+            embedding_cache.get_batch_embedding_vectors,
+            get_batch_embedding_vectors=self.get_batch_embedding_vectors,
+            model=model,
+        )
+
     def get_system_message(self):
         return self.system_message
 
+    def get_embedding_model_name(self):
+        """Name of the embedding model, used for keying cached embeddings"""
+        return None
+
     def get_batch_embedding_vectors(self, texts):
         raise NotImplementedError
 
     def get_embedding_vector(self, text):
+        if self.embedding_micro_batcher is not None:
+            return self.embedding_micro_batcher.embed(
+                text, self.get_batch_embedding_vectors
+            )
+
         return self.get_batch_embedding_vectors([text])[0]
 
+    def count_tokens(self, text):
+        """Number of tokens of the text for the LLM. By default the words are
+        counted"""
+        return count_words(text)
+
     def generate_response(self, messages):
         raise NotImplementedError
 
+    def generate_response_stream(self, messages):
+        """Yield the response in pieces as they are generated. By default
+        the whole response is yielded at once"""
+        yield self.generate_response(messages)
+
+    async def aget_batch_embedding_vectors(self, texts):
+        return await asyncio.to_thread(self.get_batch_embedding_vectors, texts)
+
+    async def aget_embedding_vector(self, text):
+        if self.embedding_micro_batcher is not None:
+            return await self.embedding_micro_batcher.aembed(
+                text, self.aget_batch_embedding_vectors
+            )
+
+        return (await self.aget_batch_embedding_vectors([text]))[0]
+
+    async def agenerate_response(self, messages):
+        return await asyncio.to_thread(self.generate_response, messages)
+
+    async def agenerate_response_stream(self, messages):
+        yield await self.agenerate_response(messages)
+
     def chunk_text(self, text):
-        """Split long text into chunks"""
+        """Split long text into chunks, yielding TextChunk tuples"""
         if self.text_splitter is not None:
-            yield from self.text_splitter(text)
+            for chunk in self.text_splitter(text):
+                yield TextChunk(chunk) if isinstance(chunk, str) else chunk
         else:
-            yield text
+            yield TextChunk(text, 0, len(text))
+
+    def chunk_texts(self, texts):
+        """Split many texts lazily, yielding an iterable with the chunks of
+        each text. Text splitters having a split_many method (like
+        SpacyTextSplitter) split the texts in batches"""
+        if self.text_splitter is not None and hasattr(self.text_splitter, "split_many"):
+            for chunks in self.text_splitter.split_many(texts):
+                yield [
+                    TextChunk(chunk) if isinstance(chunk, str) else chunk
+                    for chunk in chunks
+                ]
+        else:
+            for text in texts:
+                yield self.chunk_text(text)
+
+    def _document_chunks(self, text, chunks=None):
+        """Chunks of a document, which is only split if it's long"""
+        if len(text) > self.max_document_length_text:
+            return self.chunk_text(text) if chunks is None else chunks
+        else:
+            return [TextChunk(text, 0, len(text))]
 
     def add_document(self, text, metadata=None, document_uuid=None, batch_size=None):
         """Add single document, automatically chunking if needed"""
@@ -56,38 +191,313 @@ class RAGSystem:
         if document_uuid is None:
             document_uuid = uuid.uuid4()
 
-        if len(text) > self.max_document_length_text:
-            chunks = self.chunk_text(text)
+        chunks = self._document_chunks(text)
 
-            if batch_size:
-                # Batch process embeddings
-                metadatas = [metadata] * batch_size
-                for i in range(0, len(chunks), batch_size):
-                    chunk_batch = chunks[i : i + batch_size]
-                    embedding_vectors = self.get_batch_embedding_vectors(chunk_batch)
+        if batch_size:
+            # Batch process embeddings
+            for chunk_batch in batched(chunks, batch_size):
+                chunk_texts = [chunk.text for chunk in chunk_batch]
+                embedding_vectors = self._embed_chunks(chunk_texts)
 
+                self.instrumentation.observe_batch_size(
+                    "store_chunks", len(chunk_texts)
+                )
+                with self.instrumentation.stage("store_chunks"):
                     self.vector_store.store_document_chunks_in_batch(
-                        document_uuid, chunk_batch, embedding_vectors, metadatas
+                        document_uuid,
+                        chunk_texts,
+                        embedding_vectors,
+                        [metadata] * len(chunk_texts),
                     )
-            else:
-                for chunk in chunks:
-                    embedding_vector = self.get_embedding_vector(chunk)
+                self.instrumentation.increment("stored_rows", len(chunk_texts))
+        else:
+            for chunk in chunks:
+                embedding_vector = self._embed_chunks([chunk.text])[0]
+
+                with self.instrumentation.stage("store_chunks"):
                     self.vector_store.store_document_chunk(
                         collection_uuid=document_uuid,
-                        content=chunk,
+                        content=chunk.text,
                         embedding_vector=embedding_vector,
                         metadata=metadata,
                     )
-        else:
-            embedding_vector = self.get_embedding_vector(text)
-            self.vector_store.store_document_chunk(
-                collection_uuid=document_uuid,
-                content=text,
-                embedding_vector=embedding_vector,
-                metadata=metadata,
+                self.instrumentation.increment("stored_rows")
+
+        self.invalidate_collection(document_uuid)
+        self.instrumentation.increment("documents")
+
+    def _embed_chunks(self, chunk_texts):
+        self.instrumentation.observe_batch_size("embed_chunks", len(chunk_texts))
+        self.instrumentation.increment("chunks", len(chunk_texts))
+
+        with self.instrumentation.stage("embed_chunks"):
+            return self.get_batch_embedding_vectors(chunk_texts)
+
+    async def _aembed_chunks(self, chunk_texts):
+        self.instrumentation.observe_batch_size("embed_chunks", len(chunk_texts))
+        self.instrumentation.increment("chunks", len(chunk_texts))
+
+        with self.instrumentation.stage("embed_chunks"):
+            return await self.aget_batch_embedding_vectors(chunk_texts)
+
+    def add_documents(self, documents, embedding_batch_size=100, batch_size=1000):
+        """Add many documents, given as an iterable of (text, metadata) pairs.
+
+        Chunks are embedded in batches of embedding_batch_size and streamed
+        into the vector store bulk loader, which commits once per batch_size
+        chunks. Returns the uuids of the added documents"""
+        document_uuids = []
+
+        document_chunks = self._embed_document_chunks(
+            self._iter_document_chunks(documents, document_uuids),
+            embedding_batch_size,
+        )
+        # The chunks are embedded while they are streamed into the vector
+        # store, so only the embedding stage is timed
+        document_chunk_ids = self.vector_store.bulk_store_document_chunks(
+            document_chunks, batch_size=batch_size
+        )
+
+        self.instrumentation.increment("stored_rows", len(document_chunk_ids))
+        self.instrumentation.increment("documents", len(document_uuids))
+
+        return document_uuids
+
+    def _iter_document_chunks(self, documents, document_uuids):
+        documents, texts = itertools.tee(documents)
+
+        for (text, metadata), chunks in zip(
+            documents, self.chunk_texts(text for text, _ in texts)
+        ):
+            document_uuid = uuid.uuid4()
+            document_uuids.append(document_uuid)
+
+            for chunk in self._document_chunks(text, chunks):
+                yield document_uuid, chunk.text, metadata
+
+    def _embed_document_chunks(self, document_chunks, embedding_batch_size):
+        for batch in batched(document_chunks, embedding_batch_size):
+            embedding_vectors = self._embed_chunks([chunk for _, chunk, _ in batch])
+
+            for (document_uuid, chunk, metadata), embedding_vector in zip(
+                batch, embedding_vectors
+            ):
+                yield document_uuid, chunk, embedding_vector, metadata
+
+    async def aadd_document(
+        self, text, metadata=None, document_uuid=None, batch_size=None
+    ):
+        """Add single document, automatically chunking if needed"""
+
+        if document_uuid is None:
+            document_uuid = uuid.uuid4()
+
+        chunks = [chunk.text for chunk in self._document_chunks(text)]
+
+        batch_size = batch_size or 1
+
+        for i in range(0, len(chunks), batch_size):
+            chunk_batch = chunks[i : i + batch_size]
+            embedding_vectors = await self._aembed_chunks(chunk_batch)
+
+            self.instrumentation.observe_batch_size("store_chunks", len(chunk_batch))
+            with self.instrumentation.stage("store_chunks"):
+                if len(chunk_batch) == 1:
+                    await self.vector_store.astore_document_chunk(
+                        collection_uuid=document_uuid,
+                        content=chunk_batch[0],
+                        embedding_vector=embedding_vectors[0],
+                        metadata=metadata,
+                    )
+                else:
+                    await self.vector_store.astore_document_chunks_in_batch(
+                        document_uuid,
+                        chunk_batch,
+                        embedding_vectors,
+                        [metadata] * len(chunk_batch),
+                    )
+            self.instrumentation.increment("stored_rows", len(chunk_batch))
+
+        self.invalidate_collection(document_uuid)
+        self.instrumentation.increment("documents")
+
+    def _plan_upsert(self, text, stored_hashes):
+        """Split the document and classify its chunks against the hashes of
+        the stored ones. Returns the chunks to write, as (chunk_index,
+        content, content_hash) tuples, the ones that must be embedded and the
+        number of chunks"""
+        stored_hash_set = set(stored_hashes.values())
+
+        changed_chunks = []
+        chunks_to_embed = {}
+        num_chunks = 0
+
+        for chunk_index, chunk in enumerate(self._document_chunks(text)):
+            num_chunks += 1
+            chunk_hash = content_hash(chunk.text)
+
+            if stored_hashes.get(chunk_index) == chunk_hash:
+                continue
+
+            changed_chunks.append((chunk_index, chunk.text, chunk_hash))
+
+            # Chunks moved to another position reuse their stored embedding
+            if chunk_hash not in stored_hash_set:
+                chunks_to_embed[chunk_hash] = chunk.text
+
+        return changed_chunks, chunks_to_embed, num_chunks
+
+    @staticmethod
+    def _upsert_chunks(changed_chunks, embeddings_by_hash):
+        """Chunks of upsert_document_chunks, the ones without embedding reuse
+        the stored one with the same hash"""
+        return [
+            (chunk_index, chunk_text, chunk_hash, embeddings_by_hash.get(chunk_hash))
+            for chunk_index, chunk_text, chunk_hash in changed_chunks
+        ]
+
+    @staticmethod
+    def _chunks_to_reembed(changed_chunks, chunks_to_embed, content_hashes):
+        """Add to chunks_to_embed the changed chunks whose stored embedding
+        disappeared, and return them"""
+        logger.info(
+            "Stored embeddings of %s chunks gone, embedding them again",
+            len(content_hashes),
+        )
+
+        missing_chunks = {
+            chunk_hash: chunk_text
+            for _, chunk_text, chunk_hash in changed_chunks
+            if chunk_hash in content_hashes
+        }
+        chunks_to_embed.update(missing_chunks)
+
+        return missing_chunks
+
+    def _upsert_result(self, changed_chunks, chunks_to_embed, num_chunks, deleted):
+        self.instrumentation.increment("upserted_chunks", len(changed_chunks))
+
+        return {
+            "chunks": num_chunks,
+            "written": len(changed_chunks),
+            "embedded": len(chunks_to_embed),
+            "deleted": deleted,
+        }
+
+    def _embed_chunks_by_hash(self, chunks_to_embed, batch_size):
+        """Embed the {content hash: chunk text} chunks in batches, returning
+        their embeddings by hash"""
+        embeddings_by_hash = {}
+
+        for chunk_batch in batched(chunks_to_embed.items(), batch_size):
+            embedding_vectors = self._embed_chunks(
+                [chunk_text for _, chunk_text in chunk_batch]
+            )
+            embeddings_by_hash.update(
+                zip((chunk_hash for chunk_hash, _ in chunk_batch), embedding_vectors)
             )
 
-    def query(self, question, k=3, metadata_filter=None, return_full_data=False):
+        return embeddings_by_hash
+
+    async def _aembed_chunks_by_hash(self, chunks_to_embed, batch_size):
+        embeddings_by_hash = {}
+
+        for chunk_batch in batched(chunks_to_embed.items(), batch_size):
+            embedding_vectors = await self._aembed_chunks(
+                [chunk_text for _, chunk_text in chunk_batch]
+            )
+            embeddings_by_hash.update(
+                zip((chunk_hash for chunk_hash, _ in chunk_batch), embedding_vectors)
+            )
+
+        return embeddings_by_hash
+
+    def upsert_document(self, document_uuid, text, metadata=None, batch_size=100):
+        """Add or update a document idempotently. Only its new or changed
+        chunks are embedded and written, and its stale chunks deleted, in one
+        transaction. Returns the number of chunks of the document and of
+        written, embedded and deleted chunks"""
+        stored_hashes = self.vector_store.get_document_chunk_hashes(document_uuid)
+
+        changed_chunks, chunks_to_embed, num_chunks = self._plan_upsert(
+            text, stored_hashes
+        )
+
+        embeddings_by_hash = self._embed_chunks_by_hash(chunks_to_embed, batch_size)
+
+        # The stored chunks may change before the upsert: the ones whose
+        # embedding was to be reused and is gone are embedded and the upsert
+        # retried
+        while True:
+            try:
+                with self.instrumentation.stage("store_chunks"):
+                    deleted = self.vector_store.upsert_document_chunks(
+                        document_uuid,
+                        self._upsert_chunks(changed_chunks, embeddings_by_hash),
+                        num_chunks,
+                        metadata,
+                    )
+                break
+            except MissingEmbeddingsError as e:
+                embeddings_by_hash.update(
+                    self._embed_chunks_by_hash(
+                        self._chunks_to_reembed(
+                            changed_chunks, chunks_to_embed, e.content_hashes
+                        ),
+                        batch_size,
+                    )
+                )
+
+        self.invalidate_collection(document_uuid)
+
+        return self._upsert_result(changed_chunks, chunks_to_embed, num_chunks, deleted)
+
+    async def aupsert_document(
+        self, document_uuid, text, metadata=None, batch_size=100
+    ):
+        stored_hashes = await self.vector_store.aget_document_chunk_hashes(
+            document_uuid
+        )
+
+        changed_chunks, chunks_to_embed, num_chunks = self._plan_upsert(
+            text, stored_hashes
+        )
+
+        embeddings_by_hash = await self._aembed_chunks_by_hash(
+            chunks_to_embed, batch_size
+        )
+
+        while True:
+            try:
+                with self.instrumentation.stage("store_chunks"):
+                    deleted = await self.vector_store.aupsert_document_chunks(
+                        document_uuid,
+                        self._upsert_chunks(changed_chunks, embeddings_by_hash),
+                        num_chunks,
+                        metadata,
+                    )
+                break
+            except MissingEmbeddingsError as e:
+                embeddings_by_hash.update(
+                    await self._aembed_chunks_by_hash(
+                        self._chunks_to_reembed(
+                            changed_chunks, chunks_to_embed, e.content_hashes
+                        ),
+                        batch_size,
+                    )
+                )
+
+        self.invalidate_collection(document_uuid)
+
+        return self._upsert_result(changed_chunks, chunks_to_embed, num_chunks, deleted)
+
+    def invalidate_collection(self, collection_uuid):
+        """Drop the cached answers generated from a collection, to be called
+        when it's modified"""
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate_collection(collection_uuid)
+
+    def _log_query(self, question, k, metadata_filter):
         logger.info(
             "Making semantic query: %s (k=%s, metadata_filter=%s)",
             question,
@@ -95,30 +505,564 @@ class RAGSystem:
             metadata_filter,
         )
 
-        question_embedding = self.get_embedding_vector(question)
-        relevant_docs = self.vector_store.similarity_search(
-            question_embedding, k, metadata_filter
-        )
-        context = "\n\n".join([doc.content for doc in relevant_docs])
+    def _build_context(self, relevant_docs):
+        if self.context_packer is None:
+            return PackedContext(
+                "\n\n".join(doc.content for doc in relevant_docs), None, None
+            )
 
-        system_message = self.get_system_message()
-        chat_completion_messages = [
-            {"role": "system", "content": system_message},
+        with self.instrumentation.stage("build_context"):
+            packed_context = self.context_packer.pack(relevant_docs)
+
+        self.instrumentation.increment("context_tokens", packed_context.tokens)
+
+        return packed_context
+
+    def _build_chat_completion_messages(self, question, context):
+        return [
+            {"role": "system", "content": self.get_system_message()},
             {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"},
         ]
 
-        answer = self.generate_response(chat_completion_messages)
-
+    def _build_query_result(
+        self,
+        question,
+        chat_completion_messages,
+        relevant_docs,
+        answer,
+        return_full_data,
+        packed_context=None,
+    ):
         if return_full_data:
             return {
                 "question": question,
-                "system_message": system_message,
+                "system_message": chat_completion_messages[0]["content"],
                 "chat_completion_messages": chat_completion_messages,
                 "relevant_docs": relevant_docs,
+                "context_tokens": (
+                    packed_context.tokens if packed_context is not None else None
+                ),
+                "context_packing": (
+                    packed_context.decisions if packed_context is not None else None
+                ),
                 "answer": answer,
             }
         else:
             return answer
 
+    def _search_params(self, k):
+        """Number of results to fetch from the vector store and the extra
+        search arguments"""
+        if self.reranker is None:
+            return k, {}
+
+        search_kwargs = {}
+        if self.reranker.needs_embeddings:
+            search_kwargs["include_embeddings"] = True
+
+        return max(k, self.rerank_candidates), search_kwargs
+
+    def _rerank(self, question, question_embedding, candidates, k):
+        if self.reranker is None:
+            return candidates
+
+        self.instrumentation.observe_batch_size("rerank", len(candidates))
+        with self.instrumentation.stage("rerank"):
+            return self.reranker.rerank(question, question_embedding, candidates, k)
+
+    def _rerank_many(self, questions, question_embeddings, candidates_list, k):
+        if self.reranker is None:
+            return candidates_list
+
+        return [
+            self._rerank(question, question_embedding, candidates, k)
+            for question, question_embedding, candidates in zip(
+                questions, question_embeddings, candidates_list
+            )
+        ]
+
+    def _retrieve(self, question, k, metadata_filter):
+        with self.instrumentation.stage("embed_question"):
+            question_embedding = self.get_embedding_vector(question)
+
+        fetch_k, search_kwargs = self._search_params(k)
+
+        if self.hybrid_search:
+            with self.instrumentation.stage("hybrid_search"):
+                relevant_docs = self.vector_store.hybrid_search(
+                    question_embedding,
+                    question,
+                    fetch_k,
+                    metadata_filter,
+                    **search_kwargs,
+                )
+        else:
+            with self.instrumentation.stage("similarity_search"):
+                relevant_docs = self.vector_store.similarity_search(
+                    question_embedding, fetch_k, metadata_filter, **search_kwargs
+                )
+
+        relevant_docs = self._rerank(question, question_embedding, relevant_docs, k)
+
+        self.instrumentation.increment("retrieved_chunks", len(relevant_docs))
+
+        return question_embedding, relevant_docs
+
+    async def _aretrieve(self, question, k, metadata_filter):
+        with self.instrumentation.stage("embed_question"):
+            question_embedding = await self.aget_embedding_vector(question)
+
+        fetch_k, search_kwargs = self._search_params(k)
+
+        if self.hybrid_search:
+            with self.instrumentation.stage("hybrid_search"):
+                relevant_docs = await self.vector_store.ahybrid_search(
+                    question_embedding,
+                    question,
+                    fetch_k,
+                    metadata_filter,
+                    **search_kwargs,
+                )
+        else:
+            with self.instrumentation.stage("similarity_search"):
+                relevant_docs = await self.vector_store.asimilarity_search(
+                    question_embedding, fetch_k, metadata_filter, **search_kwargs
+                )
+
+        if self.reranker is not None:
+            # Reranking is CPU bound, like a cross encoder inference
+            relevant_docs = await asyncio.to_thread(
+                self._rerank, question, question_embedding, relevant_docs, k
+            )
+
+        self.instrumentation.increment("retrieved_chunks", len(relevant_docs))
+
+        return question_embedding, relevant_docs
+
+    def _generate_response(self, chat_completion_messages):
+        with self.instrumentation.stage("generate_response"):
+            return self.generate_response(chat_completion_messages)
+
+    async def _agenerate_response(self, chat_completion_messages):
+        with self.instrumentation.stage("generate_response"):
+            return await self.agenerate_response(chat_completion_messages)
+
+    def _get_cached_answer(self, question_embedding, relevant_docs):
+        if self.answer_cache is None:
+            return None
+
+        answer = self.answer_cache.get(question_embedding, relevant_docs)
+
+        self.instrumentation.increment(
+            "answer_cache_misses" if answer is None else "answer_cache_hits"
+        )
+
+        return answer
+
+    def _cache_answer(self, question_embedding, relevant_docs, answer):
+        if self.answer_cache is not None:
+            self.answer_cache.set(question_embedding, relevant_docs, answer)
+
+    def _answer(self, question_embedding, relevant_docs, chat_completion_messages):
+        """Return the cached answer of the question or generate it"""
+        answer = self._get_cached_answer(question_embedding, relevant_docs)
+
+        if answer is None:
+            answer = self._generate_response(chat_completion_messages)
+            self._cache_answer(question_embedding, relevant_docs, answer)
+
+        return answer
+
+    async def _aanswer(
+        self, question_embedding, relevant_docs, chat_completion_messages
+    ):
+        answer = self._get_cached_answer(question_embedding, relevant_docs)
+
+        if answer is None:
+            answer = await self._agenerate_response(chat_completion_messages)
+            self._cache_answer(question_embedding, relevant_docs, answer)
+
+        return answer
+
+    def query(self, question, k=3, metadata_filter=None, return_full_data=False):
+        self._log_query(question, k, metadata_filter)
+        self.instrumentation.increment("queries")
+
+        with self.instrumentation.stage("query"):
+            question_embedding, relevant_docs = self._retrieve(
+                question, k, metadata_filter
+            )
+
+            packed_context = self._build_context(relevant_docs)
+            chat_completion_messages = self._build_chat_completion_messages(
+                question, packed_context.text
+            )
+
+            answer = self._answer(
+                question_embedding, relevant_docs, chat_completion_messages
+            )
+
+        return self._build_query_result(
+            question,
+            chat_completion_messages,
+            relevant_docs,
+            answer,
+            return_full_data,
+            packed_context,
+        )
+
+    async def aquery(self, question, k=3, metadata_filter=None, return_full_data=False):
+        self._log_query(question, k, metadata_filter)
+        self.instrumentation.increment("queries")
+
+        with self.instrumentation.stage("query"):
+            question_embedding, relevant_docs = await self._aretrieve(
+                question, k, metadata_filter
+            )
+
+            packed_context = self._build_context(relevant_docs)
+            chat_completion_messages = self._build_chat_completion_messages(
+                question, packed_context.text
+            )
+
+            answer = await self._aanswer(
+                question_embedding, relevant_docs, chat_completion_messages
+            )
+
+        return self._build_query_result(
+            question,
+            chat_completion_messages,
+            relevant_docs,
+            answer,
+            return_full_data,
+            packed_context,
+        )
+
+    def _retrieve_many(self, questions, k, metadata_filter):
+        self.instrumentation.observe_batch_size("embed_questions", len(questions))
+        with self.instrumentation.stage("embed_questions"):
+            question_embeddings = self.get_batch_embedding_vectors(questions)
+
+        fetch_k, search_kwargs = self._search_params(k)
+
+        if self.hybrid_search:
+            with self.instrumentation.stage("hybrid_search_many"):
+                relevant_docs_list = self.vector_store.hybrid_search_many(
+                    question_embeddings,
+                    questions,
+                    fetch_k,
+                    metadata_filter,
+                    **search_kwargs,
+                )
+        else:
+            with self.instrumentation.stage("similarity_search_many"):
+                relevant_docs_list = self.vector_store.similarity_search_many(
+                    question_embeddings, fetch_k, metadata_filter, **search_kwargs
+                )
+
+        relevant_docs_list = self._rerank_many(
+            questions, question_embeddings, relevant_docs_list, k
+        )
+
+        self.instrumentation.increment(
+            "retrieved_chunks",
+            sum(len(relevant_docs) for relevant_docs in relevant_docs_list),
+        )
+
+        return question_embeddings, relevant_docs_list
+
+    async def _aretrieve_many(self, questions, k, metadata_filter):
+        self.instrumentation.observe_batch_size("embed_questions", len(questions))
+        with self.instrumentation.stage("embed_questions"):
+            question_embeddings = await self.aget_batch_embedding_vectors(questions)
+
+        fetch_k, search_kwargs = self._search_params(k)
+
+        if self.hybrid_search:
+            with self.instrumentation.stage("hybrid_search_many"):
+                relevant_docs_list = await self.vector_store.ahybrid_search_many(
+                    question_embeddings,
+                    questions,
+                    fetch_k,
+                    metadata_filter,
+                    **search_kwargs,
+                )
+        else:
+            with self.instrumentation.stage("similarity_search_many"):
+                relevant_docs_list = await self.vector_store.asimilarity_search_many(
+                    question_embeddings, fetch_k, metadata_filter, **search_kwargs
+                )
+
+        if self.reranker is not None:
+            relevant_docs_list = await asyncio.to_thread(
+                self._rerank_many,
+                questions,
+                question_embeddings,
+                relevant_docs_list,
+                k,
+            )
+
+        self.instrumentation.increment(
+            "retrieved_chunks",
+            sum(len(relevant_docs) for relevant_docs in relevant_docs_list),
+        )
+
+        return question_embeddings, relevant_docs_list
+
+    def query_many(
+        self,
+        questions,
+        k=3,
+        metadata_filter=None,
+        return_full_data=False,
+        max_concurrency=8,
+    ):
+        """Answer many questions. The questions are embedded in one batch,
+        the retrieval of all of them is done in one vector store call and
+        the responses are generated concurrently by up to max_concurrency
+        threads. Returns the results in the order of the questions"""
+        questions = list(questions)
+
+        logger.info(
+            "Making %s semantic queries (k=%s, metadata_filter=%s)",
+            len(questions),
+            k,
+            metadata_filter,
+        )
+        self.instrumentation.increment("queries", len(questions))
+
+        question_embeddings, relevant_docs_list = self._retrieve_many(
+            questions, k, metadata_filter
+        )
+
+        packed_contexts = [
+            self._build_context(relevant_docs) for relevant_docs in relevant_docs_list
+        ]
+        chat_completion_messages_list = [
+            self._build_chat_completion_messages(question, packed_context.text)
+            for question, packed_context in zip(questions, packed_contexts)
+        ]
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency
+        ) as executor:
+            answers = list(
+                executor.map(
+                    self._answer,
+                    question_embeddings,
+                    relevant_docs_list,
+                    chat_completion_messages_list,
+                )
+            )
+
+        return [
+            self._build_query_result(
+                question,
+                chat_completion_messages,
+                relevant_docs,
+                answer,
+                return_full_data,
+                packed_context,
+            )
+            for (
+                question,
+                chat_completion_messages,
+                relevant_docs,
+                answer,
+                packed_context,
+            ) in zip(
+                questions,
+                chat_completion_messages_list,
+                relevant_docs_list,
+                answers,
+                packed_contexts,
+            )
+        ]
+
+    async def aquery_many(
+        self,
+        questions,
+        k=3,
+        metadata_filter=None,
+        return_full_data=False,
+        max_concurrency=8,
+    ):
+        questions = list(questions)
+
+        logger.info(
+            "Making %s semantic queries (k=%s, metadata_filter=%s)",
+            len(questions),
+            k,
+            metadata_filter,
+        )
+        self.instrumentation.increment("queries", len(questions))
+
+        question_embeddings, relevant_docs_list = await self._aretrieve_many(
+            questions, k, metadata_filter
+        )
+
+        packed_contexts = [
+            self._build_context(relevant_docs) for relevant_docs in relevant_docs_list
+        ]
+        chat_completion_messages_list = [
+            self._build_chat_completion_messages(question, packed_context.text)
+            for question, packed_context in zip(questions, packed_contexts)
+        ]
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(question_embedding, relevant_docs, chat_completion_messages):
+            async with semaphore:
+                return await self._aanswer(
+                    question_embedding, relevant_docs, chat_completion_messages
+                )
+
+        answers = await asyncio.gather(
+            *[
+                answer(question_embedding, relevant_docs, chat_completion_messages)
+                for question_embedding, relevant_docs, chat_completion_messages in zip(
+                    question_embeddings,
+                    relevant_docs_list,
+                    chat_completion_messages_list,
+                )
+            ]
+        )
+
+        return [
+            self._build_query_result(
+                question,
+                chat_completion_messages,
+                relevant_docs,
+                answer,
+                return_full_data,
+                packed_context,
+            )
+            for (
+                question,
+                chat_completion_messages,
+                relevant_docs,
+                answer,
+                packed_context,
+            ) in zip(
+                questions,
+                chat_completion_messages_list,
+                relevant_docs_list,
+                answers,
+                packed_contexts,
+            )
+        ]
+
+    def _instrument_response_stream(self, tokens, question_embedding, relevant_docs):
+        """Time the response stream and cache the complete answer"""
+        start = time.perf_counter()
+        first_token = True
+        answer_tokens = []
+
+        for token in tokens:
+            if first_token:
+                self.instrumentation.observe_duration(
+                    "first_token", time.perf_counter() - start
+                )
+                first_token = False
+
+            answer_tokens.append(token)
+            yield token
+
+        self.instrumentation.observe_duration(
+            "generate_response", time.perf_counter() - start
+        )
+
+        self._cache_answer(question_embedding, relevant_docs, "".join(answer_tokens))
+
+    async def _ainstrument_response_stream(
+        self, tokens, question_embedding, relevant_docs
+    ):
+        start = time.perf_counter()
+        first_token = True
+        answer_tokens = []
+
+        async for token in tokens:
+            if first_token:
+                self.instrumentation.observe_duration(
+                    "first_token", time.perf_counter() - start
+                )
+                first_token = False
+
+            answer_tokens.append(token)
+            yield token
+
+        self.instrumentation.observe_duration(
+            "generate_response", time.perf_counter() - start
+        )
+
+        self._cache_answer(question_embedding, relevant_docs, "".join(answer_tokens))
+
+    def query_stream(self, question, k=3, metadata_filter=None):
+        """Retrieve the relevant documents and return them together with an
+        iterator over the pieces of the answer, so the documents are
+        available before the first token is generated"""
+        self._log_query(question, k, metadata_filter)
+        self.instrumentation.increment("queries")
+
+        question_embedding, relevant_docs = self._retrieve(question, k, metadata_filter)
+
+        answer = self._get_cached_answer(question_embedding, relevant_docs)
+        if answer is not None:
+            return relevant_docs, iter([answer])
+
+        packed_context = self._build_context(relevant_docs)
+        chat_completion_messages = self._build_chat_completion_messages(
+            question, packed_context.text
+        )
+
+        return relevant_docs, self._instrument_response_stream(
+            self.generate_response_stream(chat_completion_messages),
+            question_embedding,
+            relevant_docs,
+        )
+
+    async def aquery_stream(self, question, k=3, metadata_filter=None):
+        self._log_query(question, k, metadata_filter)
+        self.instrumentation.increment("queries")
+
+        question_embedding, relevant_docs = await self._aretrieve(
+            question, k, metadata_filter
+        )
+
+        answer = self._get_cached_answer(question_embedding, relevant_docs)
+        if answer is not None:
+
+            async def cached_answer_stream():
+                yield answer
+
+            return relevant_docs, cached_answer_stream()
+
+        packed_context = self._build_context(relevant_docs)
+        chat_completion_messages = self._build_chat_completion_messages(
+            question, packed_context.text
+        )
+
+        return relevant_docs, self._ainstrument_response_stream(
+            self.agenerate_response_stream(chat_completion_messages),
+            question_embedding,
+            relevant_docs,
+        )
+
     def close(self):
         self.vector_store.close()
+
+        if self.embedding_micro_batcher is not None:
+            self.embedding_micro_batcher.close()
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+
+    async def aclose(self):
+        await self.vector_store.aclose()
+
+        if self.embedding_micro_batcher is not None:
+            # Joins the collector thread, which mustn't block the event loop
+            await asyncio.to_thread(self.embedding_micro_batcher.close)
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
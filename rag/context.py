@@ -0,0 +1,191 @@
+from typing import NamedTuple
+
+
+def count_words(text):
+    """Rough token count used when no tokenizer is available"""
+    return len(text.split())
+
+
+def overlap_length(words, next_words):
+    """Length of the longest suffix of words that is a prefix of next_words"""
+    max_length = min(len(words), len(next_words))
+
+    if max_length == 0:
+        return 0
+
+    first_word = next_words[0]
+
+    # Only the positions of the tail of words holding the first word of
+    # next_words can start an overlap, the longest one is tried first
+    for start in range(len(words) - max_length, len(words)):
+        if (
+            words[start] == first_word
+            and words[start:] == next_words[: len(words) - start]
+        ):
+            return len(words) - start
+
+    return 0
+
+
+class ContextPassage(NamedTuple):
+    text: str
+    document_chunk_ids: list
+    collection_uuid: object
+    # Rank of the best ranked document chunk of the passage
+    rank: int
+    overlap_words_removed: int = 0
+
+
+class PackedContext(NamedTuple):
+    text: str
+    tokens: int
+    # A dict per passage describing the packing decision taken for it
+    decisions: list
+
+
+class ContextPacker:
+    """Assemble the context of the prompt from the retrieved document chunks:
+
+    - The chunks of the same collection with consecutive ids, or whose texts
+      overlap by at least min_overlap_words words, are merged in a single
+      passage and the overlapping words are dropped.
+    - The passages are packed in the order of their best ranked chunk while
+      they fit in max_tokens tokens, counted with count_tokens. When not even
+      the first passage fits, it's truncated.
+
+    With max_tokens=None all the passages are packed.
+    """
+
+    def __init__(
+        self,
+        max_tokens=None,
+        count_tokens=count_words,
+        separator="\n\n",
+        min_overlap_words=5,
+    ):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.separator = separator
+        self.min_overlap_words = min_overlap_words
+
+    def merge(self, document_chunks):
+        """Merge the adjacent or overlapping document chunks in passages,
+        returned in the order of their best ranked chunk"""
+        collections = {}
+        for rank, document_chunk in enumerate(document_chunks):
+            collections.setdefault(document_chunk.collection_uuid, []).append(
+                (rank, document_chunk)
+            )
+
+        passages = []
+
+        for collection_uuid, ranked_chunks in collections.items():
+            ranked_chunks.sort(key=lambda ranked_chunk: ranked_chunk[1].id)
+
+            previous_words = None
+            for rank, document_chunk in ranked_chunks:
+                words = document_chunk.content.split()
+
+                if previous_words is not None:
+                    overlap = overlap_length(previous_words, words)
+
+                    if (
+                        document_chunk.id == ids[-1] + 1
+                        or overlap >= self.min_overlap_words
+                    ):
+                        if not overlap:
+                            pieces.append(document_chunk.content)
+                        elif overlap < len(words):
+                            pieces.append(" ".join(words[overlap:]))
+
+                        previous_words = words
+                        ids.append(document_chunk.id)
+                        best_rank = min(best_rank, rank)
+                        overlap_words_removed += overlap
+                        continue
+
+                    passages.append(
+                        ContextPassage(
+                            " ".join(pieces),
+                            ids,
+                            collection_uuid,
+                            best_rank,
+                            overlap_words_removed,
+                        )
+                    )
+
+                previous_words = words
+                pieces = [document_chunk.content]
+                ids = [document_chunk.id]
+                best_rank = rank
+                overlap_words_removed = 0
+
+            passages.append(
+                ContextPassage(
+                    " ".join(pieces),
+                    ids,
+                    collection_uuid,
+                    best_rank,
+                    overlap_words_removed,
+                )
+            )
+
+        passages.sort(key=lambda passage: passage.rank)
+        return passages
+
+    def _truncate(self, text, max_tokens):
+        """Longest prefix of whole words of the text fitting in max_tokens"""
+        words = text.split()
+        low, high = 0, len(words)
+
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(" ".join(words[:middle])) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+
+        return " ".join(words[:low])
+
+    def pack(self, document_chunks):
+        passages = self.merge(document_chunks)
+
+        separator_tokens = self.count_tokens(self.separator) if passages else 0
+
+        texts = []
+        tokens = 0
+        decisions = []
+
+        for passage in passages:
+            passage_tokens = self.count_tokens(passage.text)
+            # The separator is only needed between passages
+            needed_tokens = passage_tokens + (separator_tokens if texts else 0)
+
+            decision = {
+                "document_chunk_ids": passage.document_chunk_ids,
+                "collection_uuid": passage.collection_uuid,
+                "tokens": passage_tokens,
+                "overlap_words_removed": passage.overlap_words_removed,
+                "included": True,
+                "truncated": False,
+            }
+
+            if self.max_tokens is None or tokens + needed_tokens <= self.max_tokens:
+                texts.append(passage.text)
+                tokens += needed_tokens
+            elif not texts and not decisions:
+                text = self._truncate(passage.text, self.max_tokens)
+
+                if text:
+                    decision["tokens"] = self.count_tokens(text)
+                    decision["truncated"] = True
+                    texts.append(text)
+                    tokens += decision["tokens"]
+                else:
+                    decision["included"] = False
+            else:
+                decision["included"] = False
+
+            decisions.append(decision)
+
+        return PackedContext(self.separator.join(texts), tokens, decisions)
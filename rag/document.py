@@ -3,10 +3,17 @@ import datetime
 from dataclasses import dataclass
 
 
-@dataclass
+import numpy as np
+
+
+@dataclass(slots=True)
 class DocumentChunk:
     id: int
     collection_uuid: uuid.UUID
     content: str
     created_at: datetime.datetime
     metadata: dict | None = None
+    # Only set when the search is asked to include the embeddings
+    embedding_vector: np.ndarray | None = None
+    # Cosine distance to the query vector, set by the searches
+    distance: float | None = None
@@ -0,0 +1,206 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingMicroBatcher:
+    """Coalesce concurrent single text embedding requests in batches.
+
+    The texts requested while a batch is being collected, for at most
+    max_wait seconds after its first text or until it holds max_batch_size
+    texts, are embedded with a single get_batch_embedding_vectors call and
+    each caller gets the embedding vector of its text. A lone request waits
+    max_wait seconds at most, under load the batches fill up and the
+    provider or the local model gets one request instead of many.
+
+    The synchronous requests are collected by a background thread, started
+    on first use and stopped by close, and the asyncio ones in the event loop
+    of the callers. The requests made after close raise RuntimeError.
+    """
+
+    def __init__(self, max_batch_size=64, max_wait=0.005):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._closed = False
+
+        # Batch being collected by event loop: (pending requests, flush timer)
+        self._async_batches = {}
+        self._async_tasks = set()
+
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+
+    def _count_batch(self, num_texts):
+        with self._stats_lock:
+            self.requests += num_texts
+            self.batches += 1
+
+    @staticmethod
+    def _group_by_function(requests):
+        """Group the (text, embedding function, future) requests by embedding
+        function, a batcher is usually shared by callers of the same one"""
+        groups = {}
+        for text, get_batch_embedding_vectors, future in requests:
+            groups.setdefault(get_batch_embedding_vectors, []).append((text, future))
+
+        return groups.items()
+
+    @staticmethod
+    def _check_embedding_vectors(group, embedding_vectors):
+        # A future without embedding vector would never be resolved
+        if len(embedding_vectors) != len(group):
+            raise ValueError(
+                "Got %s embedding vectors for %s texts"
+                % (len(embedding_vectors), len(group))
+            )
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("The embedding micro-batcher is closed")
+
+    def _start(self):
+        # Called with the thread lock held
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._collector, name="embedding-micro-batcher", daemon=True
+            )
+            self._thread.start()
+
+    def _collector(self):
+        stopping = False
+
+        while not stopping and (request := self._queue.get()) is not None:
+            requests = [request]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if request is None:
+                    stopping = True
+                    break
+
+                requests.append(request)
+
+            self._embed_batch(requests)
+
+    def _embed_batch(self, requests):
+        for get_batch_embedding_vectors, group in self._group_by_function(requests):
+            self._count_batch(len(group))
+
+            try:
+                embedding_vectors = get_batch_embedding_vectors(
+                    [text for text, _ in group]
+                )
+                self._check_embedding_vectors(group, embedding_vectors)
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), embedding_vector in zip(group, embedding_vectors):
+                future.set_result(embedding_vector)
+
+    def submit(self, text, get_batch_embedding_vectors):
+        """Queue the text and return a concurrent.futures.Future of its
+        embedding vector"""
+        future = concurrent.futures.Future()
+
+        # The request is queued with the lock held, so it can't be queued
+        # after the stop sentinel of close
+        with self._thread_lock:
+            self._check_open()
+            self._start()
+            self._queue.put((text, get_batch_embedding_vectors, future))
+
+        return future
+
+    def embed(self, text, get_batch_embedding_vectors):
+        return self.submit(text, get_batch_embedding_vectors).result()
+
+    def _aflush(self, loop):
+        requests, timer = self._async_batches.pop(loop, (None, None))
+        if not requests:
+            return
+
+        if timer is not None:
+            timer.cancel()
+
+        task = loop.create_task(self._aembed_batch(requests))
+        self._async_tasks.add(task)
+        task.add_done_callback(self._async_tasks.discard)
+
+    async def _aembed_batch(self, requests):
+        for aget_batch_embedding_vectors, group in self._group_by_function(requests):
+            self._count_batch(len(group))
+
+            try:
+                embedding_vectors = await aget_batch_embedding_vectors(
+                    [text for text, _ in group]
+                )
+                self._check_embedding_vectors(group, embedding_vectors)
+            except Exception as e:
+                for _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), embedding_vector in zip(group, embedding_vectors):
+                if not future.done():
+                    future.set_result(embedding_vector)
+
+    async def aembed(self, text, aget_batch_embedding_vectors):
+        self._check_open()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        if loop not in self._async_batches:
+            self._async_batches[loop] = (
+                [],
+                loop.call_later(self.max_wait, self._aflush, loop),
+            )
+
+        requests, _ = self._async_batches[loop]
+        requests.append((text, aget_batch_embedding_vectors, future))
+
+        if len(requests) >= self.max_batch_size:
+            self._aflush(loop)
+
+        return await future
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0,
+            }
+
+    def close(self):
+        """Embed the queued texts and stop the background thread"""
+        with self._thread_lock:
+            self._closed = True
+
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
@@ -0,0 +1,201 @@
+import collections
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+
+
+import numpy as np
+
+
+from .utils import batched
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """Normalize unicode and whitespace, so that texts only differing on
+    them share the cached embedding"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_cache_key(model, text):
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return "%s:%s" % (model, digest)
+
+
+class SQLiteEmbeddingStore:
+    """Persistent tier of the embedding cache stored in a SQLite database"""
+
+    # Maximum number of keys per SELECT, below the SQLite variable limit
+    max_query_keys = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding_vector BLOB)"
+            )
+            self.conn.commit()
+
+    def get_many(self, keys):
+        found = {}
+
+        with self.lock:
+            for keys_batch in batched(keys, self.max_query_keys):
+                rows = self.conn.execute(
+                    "SELECT key, embedding_vector FROM embeddings WHERE key IN (%s)"
+                    % ",".join("?" * len(keys_batch)),
+                    keys_batch,
+                )
+                for key, embedding_vector in rows:
+                    found[key] = np.frombuffer(embedding_vector, dtype=np.float32)
+
+        return found
+
+    def set_many(self, items):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding_vector) VALUES (?, ?)",
+                [
+                    (key, embedding_vector.tobytes())
+                    for key, embedding_vector in items.items()
+                ],
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class EmbeddingCache:
+    """Embedding cache keyed by the embedding model and the hash of the
+    normalized text.
+
+    It has a bounded in-memory LRU tier and an optional persistent tier
+    (for example, a SQLiteEmbeddingStore). Cached embedding vectors are
+    float32 NumPy arrays.
+    """
+
+    def __init__(self, max_size=10000, store=None):
+        self.max_size = max_size
+        self.store = store
+
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+    def get_many(self, keys):
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                embedding_vector = self._lru.get(key)
+                if embedding_vector is not None:
+                    self._lru.move_to_end(key)
+                    found[key] = embedding_vector
+
+        if self.store is not None:
+            missing_keys = list({key: None for key in keys if key not in found})
+
+            if missing_keys:
+                stored = self.store.get_many(missing_keys)
+                self._set_lru(stored)
+                found.update(stored)
+
+                with self._lock:
+                    self.store_hits += sum(1 for key in keys if key in stored)
+
+        with self._lock:
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return found
+
+    def set_many(self, items):
+        self._set_lru(items)
+
+        if self.store is not None:
+            self.store.set_many(items)
+
+    def _set_lru(self, items):
+        with self._lock:
+            for key, embedding_vector in items.items():
+                self._lru[key] = embedding_vector
+                self._lru.move_to_end(key)
+
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def _lookup(self, model, texts):
+        keys = [embedding_cache_key(model, text) for text in texts]
+        found = self.get_many(keys)
+
+        # Cache misses, without duplicates, in the order of the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+
+        return keys, found, missing
+
+    def _store_computed(self, found, missing, embedding_vectors):
+        computed = {
+            key: np.asarray(embedding_vector, dtype=np.float32)
+            for key, embedding_vector in zip(missing, embedding_vectors)
+        }
+        self.set_many(computed)
+        found.update(computed)
+
+    def get_batch_embedding_vectors(self, texts, get_batch_embedding_vectors, model):
+        """Return the embedding vectors of the texts in order, only sending
+        the cache misses to get_batch_embedding_vectors"""
+        keys, found, missing = self._lookup(model, texts)
+
+        if missing:
+            logger.debug("Embedding cache misses: %s of %s", len(missing), len(texts))
+            embedding_vectors = get_batch_embedding_vectors(list(missing.values()))
+            self._store_computed(found, missing, embedding_vectors)
+
+        return [found[key] for key in keys]
+
+    async def aget_batch_embedding_vectors(
+        self, texts, aget_batch_embedding_vectors, model
+    ):
+        keys, found, missing = self._lookup(model, texts)
+
+        if missing:
+            logger.debug("Embedding cache misses: %s of %s", len(missing), len(texts))
+            embedding_vectors = await aget_batch_embedding_vectors(
+                list(missing.values())
+            )
+            self._store_computed(found, missing, embedding_vectors)
+
+        return [found[key] for key in keys]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "store_hits": self.store_hits,
+                "size": len(self._lru),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
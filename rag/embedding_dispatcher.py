@@ -0,0 +1,301 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# HTTP status codes of the errors worth retrying: rate limits and transient
+# server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def estimate_tokens(text):
+    """Rough token count, about 4 characters per token"""
+    return len(text) // 4 + 1
+
+
+def is_rate_limit_error(exc):
+    return getattr(exc, "status_code", None) == 429 or "RateLimit" in type(exc).__name__
+
+
+def is_retryable_error(exc):
+    return (
+        is_rate_limit_error(exc)
+        or getattr(exc, "status_code", None) in RETRYABLE_STATUS_CODES
+        or isinstance(exc, (TimeoutError, ConnectionError))
+    )
+
+
+class TokenBucket:
+    """Rate limiter allowing rate units per second with bursts of up to
+    capacity units. A request larger than the available units is let
+    through and the next ones wait until the bucket is refilled"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def _reserve(self, amount):
+        """Take amount units and return the seconds to wait before using
+        them"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+
+            self._tokens -= amount
+
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, amount=1):
+        wait = self._reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, amount=1):
+        wait = self._reserve(amount)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class _Job:
+    """Texts being embedded by a dispatcher call, handed out in contiguous
+    sub-batches"""
+
+    def __init__(self, texts, token_counts):
+        self.texts = texts
+        self.token_counts = token_counts
+        self.embedding_vectors = [None] * len(texts)
+
+        self._lock = threading.Lock()
+        self._position = 0
+
+    def next_batch(self, batch_size, max_batch_tokens):
+        """Return the (start, end) range of the next sub-batch, or None"""
+        with self._lock:
+            start = self._position
+            if start >= len(self.texts):
+                return None
+
+            end = start
+            tokens = 0
+            while end < len(self.texts) and end - start < batch_size:
+                if end > start and tokens + self.token_counts[end] > max_batch_tokens:
+                    break
+
+                tokens += self.token_counts[end]
+                end += 1
+
+            self._position = end
+            return start, end
+
+
+class EmbeddingDispatcher:
+    """Send the texts to embed to the provider in sub-batches of at most
+    batch_size texts and max_batch_tokens tokens, up to max_concurrency
+    sub-batches at a time, respecting the requests_per_minute and
+    tokens_per_minute limits. Rate limit and transient errors are retried
+    with exponential backoff. The embedding vectors are returned in the order
+    of the texts.
+
+    The batch size adapts to the provider: it's halved on rate limit errors
+    and when a sub-batch takes longer than target_latency seconds, and grows
+    while full sub-batches take less than half of it.
+    """
+
+    def __init__(
+        self,
+        batch_size=256,
+        min_batch_size=16,
+        max_batch_size=2048,
+        max_batch_tokens=250000,
+        count_tokens=estimate_tokens,
+        max_concurrency=4,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_retries=6,
+        initial_backoff=1.0,
+        max_backoff=60.0,
+        target_latency=10.0,
+        is_retryable=is_retryable_error,
+    ):
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.count_tokens = count_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.target_latency = target_latency
+        self.is_retryable = is_retryable
+
+        self.request_limiter = (
+            TokenBucket(requests_per_minute / 60, max(1, requests_per_minute / 60))
+            if requests_per_minute
+            else None
+        )
+        self.token_limiter = (
+            TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60)
+            if tokens_per_minute
+            else None
+        )
+
+        self._lock = threading.Lock()
+
+    def _adapt_batch_size(self, num_texts, latency=None, rate_limited=False):
+        with self._lock:
+            if rate_limited or (latency is not None and latency > self.target_latency):
+                batch_size = max(self.min_batch_size, self.batch_size // 2)
+            elif (
+                latency is not None
+                and num_texts >= self.batch_size
+                and latency < self.target_latency / 2
+            ):
+                batch_size = min(self.max_batch_size, int(self.batch_size * 1.5))
+            else:
+                return
+
+            if batch_size != self.batch_size:
+                logger.debug(
+                    "Embedding batch size: %s -> %s", self.batch_size, batch_size
+                )
+                self.batch_size = batch_size
+
+    def _backoff(self, attempt):
+        backoff = min(self.max_backoff, self.initial_backoff * 2**attempt)
+        return backoff * random.uniform(0.5, 1)
+
+    def _handle_error(self, exc, attempt, num_texts):
+        """Return the seconds to wait before retrying, or raise the error"""
+        if attempt >= self.max_retries or not self.is_retryable(exc):
+            raise exc
+
+        rate_limited = is_rate_limit_error(exc)
+        if rate_limited:
+            self._adapt_batch_size(num_texts, rate_limited=True)
+
+        backoff = self._backoff(attempt)
+        logger.warning(
+            "Embedding request of %s texts failed (%r), retrying in %.1fs",
+            num_texts,
+            exc,
+            backoff,
+        )
+
+        return backoff
+
+    def _embed_batch(self, job, start, end, get_batch_embedding_vectors):
+        texts = job.texts[start:end]
+        tokens = sum(job.token_counts[start:end])
+
+        for attempt in itertools.count():
+            if self.request_limiter is not None:
+                self.request_limiter.acquire()
+            if self.token_limiter is not None:
+                self.token_limiter.acquire(tokens)
+
+            started_at = time.monotonic()
+            try:
+                embedding_vectors = get_batch_embedding_vectors(texts)
+            except Exception as e:
+                time.sleep(self._handle_error(e, attempt, len(texts)))
+                continue
+
+            self._adapt_batch_size(len(texts), time.monotonic() - started_at)
+            job.embedding_vectors[start:end] = embedding_vectors
+            return
+
+    async def _aembed_batch(self, job, start, end, aget_batch_embedding_vectors):
+        texts = job.texts[start:end]
+        tokens = sum(job.token_counts[start:end])
+
+        for attempt in itertools.count():
+            if self.request_limiter is not None:
+                await self.request_limiter.aacquire()
+            if self.token_limiter is not None:
+                await self.token_limiter.aacquire(tokens)
+
+            started_at = time.monotonic()
+            try:
+                embedding_vectors = await aget_batch_embedding_vectors(texts)
+            except Exception as e:
+                await asyncio.sleep(self._handle_error(e, attempt, len(texts)))
+                continue
+
+            self._adapt_batch_size(len(texts), time.monotonic() - started_at)
+            job.embedding_vectors[start:end] = embedding_vectors
+            return
+
+    def _worker(self, job, get_batch_embedding_vectors, failed):
+        while not failed.is_set():
+            batch = job.next_batch(self.batch_size, self.max_batch_tokens)
+            if batch is None:
+                return
+
+            try:
+                self._embed_batch(job, *batch, get_batch_embedding_vectors)
+            except Exception:
+                failed.set()
+                raise
+
+    def embed(self, texts, get_batch_embedding_vectors):
+        """Embed the texts calling get_batch_embedding_vectors with each
+        sub-batch"""
+        texts = list(texts)
+        job = _Job(texts, [self.count_tokens(text) for text in texts])
+
+        if self.max_concurrency <= 1 or (
+            len(texts) <= self.batch_size
+            and sum(job.token_counts) <= self.max_batch_tokens
+        ):
+            # Inputs fitting in one sub-batch are embedded in the calling thread
+            self._worker(job, get_batch_embedding_vectors, threading.Event())
+            return job.embedding_vectors
+
+        failed = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrency
+        ) as executor:
+            futures = [
+                executor.submit(self._worker, job, get_batch_embedding_vectors, failed)
+                for _ in range(self.max_concurrency)
+            ]
+
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+        return job.embedding_vectors
+
+    async def aembed(self, texts, aget_batch_embedding_vectors):
+        texts = list(texts)
+        job = _Job(texts, [self.count_tokens(text) for text in texts])
+
+        async def worker():
+            while (
+                batch := job.next_batch(self.batch_size, self.max_batch_tokens)
+            ) is not None:
+                await self._aembed_batch(job, *batch, aget_batch_embedding_vectors)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.max_concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+
+        return job.embedding_vectors
@@ -0,0 +1,342 @@
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+
+
+from .utils import batched
+
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionJob:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, text, metadata=None, document_uuid=None):
+        self.id = uuid.uuid4()
+        self.document_uuid = (
+            document_uuid if document_uuid is not None else uuid.uuid4()
+        )
+        self.text = text
+        self.metadata = metadata
+
+        self.status = self.QUEUED
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+        self.chunks_total = None
+        self.chunks_embedded = 0
+        self.chunks_stored = 0
+
+        self._lock = threading.Lock()
+        self._batches_total = None
+        self._batches_stored = 0
+        # Ids of the stored chunks, deleted when the job fails
+        self._document_chunk_ids = []
+        self._done = threading.Event()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": str(self.id),
+                "document_uuid": str(self.document_uuid),
+                "status": self.status,
+                "error": self.error,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "chunks_stored": self.chunks_stored,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+
+    def wait(self, timeout=None):
+        """Wait until the job is done or failed"""
+        return self._done.wait(timeout)
+
+    def _finish(self, status, error=None):
+        # Called with the lock held
+        if self.status in (self.DONE, self.FAILED):
+            return False
+
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self.text = None
+        self._done.set()
+        return True
+
+
+class IngestionQueue:
+    """Ingest documents in the background with a pipeline of worker threads:
+
+    splitter workers -> embedding workers -> writer workers
+
+    The splitters chunk the documents of the submitted jobs in batches of
+    embedding_batch_size chunks, the embedding workers embed them and the
+    writers bulk store them in the vector store of the RAG system. The queues
+    between the stages are bounded, so a slow stage makes the previous ones
+    wait instead of piling up batches in memory, and submit blocks (or raises
+    queue.Full) when max_pending_jobs jobs are waiting.
+
+    When a job fails, the chunks of its document already stored are deleted.
+
+    The vector store must be usable from several threads, like a pooled
+    PgVectorVectorDB with at least writer_workers connections.
+    """
+
+    def __init__(
+        self,
+        rag,
+        splitter_workers=1,
+        embedding_workers=2,
+        writer_workers=1,
+        embedding_batch_size=100,
+        max_pending_jobs=100,
+        max_pending_batches=16,
+        max_finished_jobs=1000,
+    ):
+        self.rag = rag
+        self.splitter_workers = splitter_workers
+        self.embedding_workers = embedding_workers
+        self.writer_workers = writer_workers
+        self.embedding_batch_size = embedding_batch_size
+        self.max_finished_jobs = max_finished_jobs
+
+        self._job_queue = queue.Queue(maxsize=max_pending_jobs)
+        self._embedding_queue = queue.Queue(maxsize=max_pending_batches)
+        self._writer_queue = queue.Queue(maxsize=max_pending_batches)
+
+        self._jobs_lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        self._finished_job_ids = collections.deque()
+
+        self._threads = []
+
+    def start(self):
+        for name, target, num_workers in (
+            ("splitter", self._splitter_worker, self.splitter_workers),
+            ("embedding", self._embedding_worker, self.embedding_workers),
+            ("writer", self._writer_worker, self.writer_workers),
+        ):
+            threads = [
+                threading.Thread(
+                    target=target, name="ingestion-%s-%s" % (name, i), daemon=True
+                )
+                for i in range(num_workers)
+            ]
+            for thread in threads:
+                thread.start()
+
+            self._threads.append(threads)
+
+        return self
+
+    def submit(self, text, metadata=None, document_uuid=None, block=True, timeout=None):
+        """Queue a document for ingestion and return its job. Raises
+        queue.Full when the queue is full and block is False, or after
+        timeout seconds"""
+        job = IngestionJob(text, metadata, document_uuid)
+
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+
+        try:
+            self._job_queue.put(job, block=block, timeout=timeout)
+        except queue.Full:
+            with self._jobs_lock:
+                del self._jobs[job.id]
+            raise
+
+        self.rag.instrumentation.increment("ingestion_jobs_submitted")
+
+        return job
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._jobs_lock:
+            return list(self._jobs.values())
+
+    def stats(self):
+        with self._jobs_lock:
+            statuses = collections.Counter(job.status for job in self._jobs.values())
+
+        return {
+            "jobs": dict(statuses),
+            "pending_jobs": self._job_queue.qsize(),
+            "pending_embedding_batches": self._embedding_queue.qsize(),
+            "pending_writer_batches": self._writer_queue.qsize(),
+        }
+
+    def _delete_document_chunks(self, job, document_chunk_ids):
+        """Delete the chunks of a failed job, so its document isn't left
+        partially ingested"""
+        logger.info(
+            "Deleting the %s stored chunks of failed ingestion job %s",
+            len(document_chunk_ids),
+            job.id,
+        )
+
+        for document_chunk_id in document_chunk_ids:
+            try:
+                self.rag.vector_store.delete_document_chunk_by_id(document_chunk_id)
+            except Exception:
+                logger.exception(
+                    "Error deleting chunk %s of failed job %s",
+                    document_chunk_id,
+                    job.id,
+                )
+
+    def _job_finished(self, job, status, error=None):
+        document_chunk_ids = []
+
+        with job._lock:
+            finished = job._finish(status, error)
+
+            if finished and status == IngestionJob.FAILED:
+                document_chunk_ids = job._document_chunk_ids
+                job._document_chunk_ids = []
+                job.chunks_stored = 0
+
+        if not finished:
+            return
+
+        if document_chunk_ids:
+            self._delete_document_chunks(job, document_chunk_ids)
+
+        if status == IngestionJob.DONE:
+            self.rag.invalidate_collection(job.document_uuid)
+            self.rag.instrumentation.increment("documents")
+            logger.info("Ingestion job %s done (%s chunks)", job.id, job.chunks_total)
+        else:
+            logger.error("Ingestion job %s failed: %s", job.id, error)
+
+        self.rag.instrumentation.increment("ingestion_jobs_%s" % status)
+
+        # Keep only the last max_finished_jobs finished jobs
+        with self._jobs_lock:
+            self._finished_job_ids.append(job.id)
+
+            while len(self._finished_job_ids) > self.max_finished_jobs:
+                self._jobs.pop(self._finished_job_ids.popleft(), None)
+
+    def _splitter_worker(self):
+        while (job := self._job_queue.get()) is not None:
+            with job._lock:
+                job.status = IngestionJob.RUNNING
+                text = job.text
+
+            num_chunks = 0
+            num_batches = 0
+
+            try:
+                for chunk_batch in batched(
+                    self.rag._document_chunks(text), self.embedding_batch_size
+                ):
+                    if job.status == IngestionJob.FAILED:
+                        break
+
+                    num_chunks += len(chunk_batch)
+                    num_batches += 1
+
+                    self._embedding_queue.put(
+                        (job, [chunk.text for chunk in chunk_batch])
+                    )
+            except Exception as e:
+                logger.exception("Error splitting the document of job %s", job.id)
+                self._job_finished(job, IngestionJob.FAILED, repr(e))
+                continue
+
+            with job._lock:
+                job.chunks_total = num_chunks
+                job._batches_total = num_batches
+                done = job._batches_stored == num_batches
+
+            if done:
+                self._job_finished(job, IngestionJob.DONE)
+
+    def _embedding_worker(self):
+        while (item := self._embedding_queue.get()) is not None:
+            job, chunk_texts = item
+
+            if job.status == IngestionJob.FAILED:
+                continue
+
+            try:
+                embedding_vectors = self.rag._embed_chunks(chunk_texts)
+            except Exception as e:
+                logger.exception("Error embedding chunks of job %s", job.id)
+                self._job_finished(job, IngestionJob.FAILED, repr(e))
+                continue
+
+            with job._lock:
+                job.chunks_embedded += len(chunk_texts)
+
+            self._writer_queue.put((job, chunk_texts, embedding_vectors))
+
+    def _writer_worker(self):
+        while (item := self._writer_queue.get()) is not None:
+            job, chunk_texts, embedding_vectors = item
+
+            if job.status == IngestionJob.FAILED:
+                continue
+
+            try:
+                with self.rag.instrumentation.stage("store_chunks"):
+                    document_chunk_ids = (
+                        self.rag.vector_store.bulk_store_document_chunks(
+                            zip(
+                                itertools.repeat(job.document_uuid),
+                                chunk_texts,
+                                embedding_vectors,
+                                itertools.repeat(job.metadata),
+                            ),
+                            batch_size=len(chunk_texts),
+                        )
+                    )
+            except Exception as e:
+                logger.exception("Error storing chunks of job %s", job.id)
+                self._job_finished(job, IngestionJob.FAILED, repr(e))
+                continue
+
+            self.rag.instrumentation.increment("stored_rows", len(chunk_texts))
+
+            with job._lock:
+                # The job may have failed while the batch was stored, after
+                # its stored chunks were deleted
+                failed = job.status == IngestionJob.FAILED
+
+                if not failed:
+                    job._document_chunk_ids.extend(document_chunk_ids)
+                    job.chunks_stored += len(chunk_texts)
+                    job._batches_stored += 1
+                    done = job._batches_stored == job._batches_total
+
+            if failed:
+                self._delete_document_chunks(job, document_chunk_ids)
+            elif done:
+                self._job_finished(job, IngestionJob.DONE)
+
+    def close(self):
+        """Wait until the queued jobs are ingested and stop the workers"""
+        for job_queue, threads in zip(
+            (self._job_queue, self._embedding_queue, self._writer_queue),
+            self._threads,
+        ):
+            for _ in threads:
+                job_queue.put(None)
+
+            for thread in threads:
+                thread.join()
+
+        self._threads = []
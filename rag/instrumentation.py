@@ -0,0 +1,210 @@
+import bisect
+import contextlib
+import threading
+import time
+
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+DEFAULT_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+class Instrumentation:
+    """Instrumentation hooks called by the RAG system. This base class
+    ignores them:
+
+    - stage(name): context manager timing a stage of the pipeline, like
+      "embed_question", "similarity_search" or "generate_response".
+    - observe_duration(stage, seconds): duration of a stage timed by the
+      caller, like the time to the first token of a streamed response.
+    - observe_batch_size(stage, size): size of a batch processed by a stage.
+    - increment(name, value): increment a counter, like "chunks" or
+      "llm_prompt_tokens".
+    """
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def observe_duration(self, stage, seconds):
+        pass
+
+    def observe_batch_size(self, stage, size):
+        pass
+
+    def increment(self, name, value=1):
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket containing
+        it"""
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        cumulative_count = 0
+
+        for upper_bound, bucket_count in zip(
+            self.buckets + (float("inf"),), self.bucket_counts
+        ):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                return upper_bound
+
+        return float("inf")
+
+
+class MetricsInstrumentation(Instrumentation):
+    """Record the stage latencies and batch sizes in histograms and the
+    counters in process. They can be exported in the Prometheus text format
+    with render_prometheus.
+
+    When an OpenTelemetry tracer is given (for example,
+    opentelemetry.trace.get_tracer("rag")) each stage is also a span.
+    """
+
+    def __init__(
+        self,
+        prefix="rag",
+        latency_buckets=DEFAULT_LATENCY_BUCKETS,
+        size_buckets=DEFAULT_SIZE_BUCKETS,
+        tracer=None,
+    ):
+        self.prefix = prefix
+        self.latency_buckets = latency_buckets
+        self.size_buckets = size_buckets
+        self.tracer = tracer
+
+        self._lock = threading.Lock()
+        self.stage_durations = {}
+        self.batch_sizes = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.tracer is not None:
+            span_context = self.tracer.start_as_current_span(
+                "%s.%s" % (self.prefix, name)
+            )
+        else:
+            span_context = contextlib.nullcontext()
+
+        start = time.perf_counter()
+        try:
+            with span_context:
+                yield
+        finally:
+            self.observe_duration(name, time.perf_counter() - start)
+
+    def observe_duration(self, stage, seconds):
+        self._observe(self.stage_durations, stage, seconds, self.latency_buckets)
+
+    def observe_batch_size(self, stage, size):
+        self._observe(self.batch_sizes, stage, size, self.size_buckets)
+
+    def _observe(self, histograms, key, value, buckets):
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(buckets)
+
+            histogram.observe(value)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Counters and the count, sum and estimated p50/p95/p99 of the
+        histograms"""
+
+        def summarize(histogram):
+            return {
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99),
+            }
+
+        with self._lock:
+            return {
+                "stage_durations": {
+                    name: summarize(histogram)
+                    for name, histogram in self.stage_durations.items()
+                },
+                "batch_sizes": {
+                    name: summarize(histogram)
+                    for name, histogram in self.batch_sizes.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def render_prometheus(self):
+        lines = []
+
+        with self._lock:
+            for metric_name, histograms in (
+                ("stage_duration_seconds", self.stage_durations),
+                ("batch_size", self.batch_sizes),
+            ):
+                if not histograms:
+                    continue
+
+                metric_name = "%s_%s" % (self.prefix, metric_name)
+                lines.append("# TYPE %s histogram" % metric_name)
+
+                for stage, histogram in sorted(histograms.items()):
+                    cumulative_count = 0
+
+                    for upper_bound, bucket_count in zip(
+                        histogram.buckets + ("+Inf",), histogram.bucket_counts
+                    ):
+                        cumulative_count += bucket_count
+                        lines.append(
+                            '%s_bucket{stage="%s",le="%s"} %s'
+                            % (metric_name, stage, upper_bound, cumulative_count)
+                        )
+
+                    lines.append(
+                        '%s_sum{stage="%s"} %s' % (metric_name, stage, histogram.sum)
+                    )
+                    lines.append(
+                        '%s_count{stage="%s"} %s'
+                        % (metric_name, stage, histogram.count)
+                    )
+
+            for name, value in sorted(self.counters.items()):
+                metric_name = "%s_%s_total" % (self.prefix, name)
+                lines.append("# TYPE %s counter" % metric_name)
+                lines.append("%s %s" % (metric_name, value))
+
+        return "\n".join(lines) + "\n"
@@ -5,19 +5,56 @@ from .base import RAGSystem
 
 class LiteLlmRAGSystem(RAGSystem):
     def __init__(
-        self, embedding_model, llm_model, api_key=None, temperature=0.7, **kwargs
+        self,
+        embedding_model,
+        llm_model,
+        api_key=None,
+        temperature=0.7,
+        embedding_dispatcher=None,
+        **kwargs
     ):
         self.embedding_model = embedding_model
         self.llm_model = llm_model
         self.api_key = api_key
         self.temperature = temperature
 
+        # Optional EmbeddingDispatcher splitting the embedding requests in
+        # sub-batches sent concurrently, within the rate limits of the
+        # provider. Without it each batch is sent in one request
+        self.embedding_dispatcher = embedding_dispatcher
+
         super().__init__(**kwargs)
 
+    def get_embedding_model_name(self):
+        return self.embedding_model
+
+    def count_tokens(self, text):
+        return litellm.token_counter(model=self.llm_model, text=text)
+
+    def _count_usage(
+        self, response, prompt_tokens_counter, completion_tokens_counter=None
+    ):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+
+        self.instrumentation.increment(prompt_tokens_counter, usage.prompt_tokens or 0)
+        if completion_tokens_counter is not None:
+            self.instrumentation.increment(
+                completion_tokens_counter, usage.completion_tokens or 0
+            )
+
     def get_batch_embedding_vectors(self, texts):
+        if self.embedding_dispatcher is None:
+            return self._embedding_request(texts)
+
+        return self.embedding_dispatcher.embed(texts, self._embedding_request)
+
+    def _embedding_request(self, texts):
         response = litellm.embedding(
             model=self.embedding_model, api_key=self.api_key, input=texts
         )
+        self._count_usage(response, "embedding_tokens")
 
         return [item["embedding"] for item in response.data]
 
@@ -28,4 +65,57 @@ class LiteLlmRAGSystem(RAGSystem):
             api_key=self.api_key,
             temperature=self.temperature,
         )
+        self._count_usage(response, "llm_prompt_tokens", "llm_completion_tokens")
+
         return response.choices[0].message.content
+
+    def generate_response_stream(self, messages):
+        response = litellm.completion(
+            model=self.llm_model,
+            messages=messages,
+            api_key=self.api_key,
+            temperature=self.temperature,
+            stream=True,
+        )
+        for chunk in response:
+            token = chunk.choices[0].delta.content
+            if token:
+                yield token
+
+    async def aget_batch_embedding_vectors(self, texts):
+        if self.embedding_dispatcher is None:
+            return await self._aembedding_request(texts)
+
+        return await self.embedding_dispatcher.aembed(texts, self._aembedding_request)
+
+    async def _aembedding_request(self, texts):
+        response = await litellm.aembedding(
+            model=self.embedding_model, api_key=self.api_key, input=texts
+        )
+        self._count_usage(response, "embedding_tokens")
+
+        return [item["embedding"] for item in response.data]
+
+    async def agenerate_response(self, messages):
+        response = await litellm.acompletion(
+            model=self.llm_model,
+            messages=messages,
+            api_key=self.api_key,
+            temperature=self.temperature,
+        )
+        self._count_usage(response, "llm_prompt_tokens", "llm_completion_tokens")
+
+        return response.choices[0].message.content
+
+    async def agenerate_response_stream(self, messages):
+        response = await litellm.acompletion(
+            model=self.llm_model,
+            messages=messages,
+            api_key=self.api_key,
+            temperature=self.temperature,
+            stream=True,
+        )
+        async for chunk in response:
+            token = chunk.choices[0].delta.content
+            if token:
+                yield token
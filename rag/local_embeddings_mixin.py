@@ -1,7 +1,10 @@
+import asyncio
+import logging
 import os
+import threading
 
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 
 
 SENTENCE_TRANSFORMER_LOCAL_EMBEDDING_MODEL = os.getenv(
@@ -10,9 +13,113 @@ SENTENCE_TRANSFORMER_LOCAL_EMBEDDING_MODEL = os.getenv(
 )
 
 
-model = SentenceTransformer(SENTENCE_TRANSFORMER_LOCAL_EMBEDDING_MODEL)
+logger = logging.getLogger(__name__)
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_sentence_transformer(model_name, device=None):
+    """Load a sentence transformer model, only once per process and on first
+    use"""
+    with _models_lock:
+        model = _models.get((model_name, device))
+
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            logger.info("Loading sentence transformer model %s", model_name)
+            model = SentenceTransformer(model_name, device=device)
+            _models[(model_name, device)] = model
+
+        return model
 
 
 class LocalEmbeddingsMixin:
-    def get_batch_embeddings(self, texts):
-        return model.encode(texts)
+    """Compute the embeddings with a local sentence transformer model. For
+    example:
+
+        class LocalEmbeddingsRAGSystem(LocalEmbeddingsMixin, LiteLlmRAGSystem):
+            local_embedding_processes = 4
+
+    Batches of at least local_embedding_multi_process_min_texts texts are
+    encoded by a pool of local_embedding_processes CPU processes, when it's
+    set.
+    """
+
+    local_embedding_model = SENTENCE_TRANSFORMER_LOCAL_EMBEDDING_MODEL
+    local_embedding_device = None
+    local_embedding_batch_size = 32
+    local_embedding_processes = None
+    local_embedding_multi_process_min_texts = 1000
+
+    _local_embedding_pool = None
+    _local_embedding_pool_lock = threading.Lock()
+
+    def get_embedding_model_name(self):
+        return self.local_embedding_model
+
+    def get_local_embedding_model(self):
+        return get_sentence_transformer(
+            self.local_embedding_model, self.local_embedding_device
+        )
+
+    def _get_local_embedding_pool(self, model):
+        with self._local_embedding_pool_lock:
+            if self._local_embedding_pool is None:
+                logger.info(
+                    "Starting %s local embedding processes",
+                    self.local_embedding_processes,
+                )
+                self._local_embedding_pool = model.start_multi_process_pool(
+                    target_devices=["cpu"] * self.local_embedding_processes
+                )
+
+            return self._local_embedding_pool
+
+    def encode_local_embeddings(self, texts):
+        """Return the embedding vectors of the texts as a float32 NumPy array
+        with a row per text"""
+        model = self.get_local_embedding_model()
+
+        if (
+            self.local_embedding_processes
+            and len(texts) >= self.local_embedding_multi_process_min_texts
+        ):
+            embedding_vectors = model.encode_multi_process(
+                texts,
+                self._get_local_embedding_pool(model),
+                batch_size=self.local_embedding_batch_size,
+            )
+        else:
+            embedding_vectors = model.encode(
+                texts,
+                batch_size=self.local_embedding_batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+
+        return embedding_vectors.astype(np.float32, copy=False)
+
+    def get_batch_embedding_vectors(self, texts):
+        return self.encode_local_embeddings(texts)
+
+    async def aget_batch_embedding_vectors(self, texts):
+        return await asyncio.to_thread(self.encode_local_embeddings, texts)
+
+    def stop_local_embedding_processes(self):
+        with self._local_embedding_pool_lock:
+            if self._local_embedding_pool is not None:
+                self.get_local_embedding_model().stop_multi_process_pool(
+                    self._local_embedding_pool
+                )
+                self._local_embedding_pool = None
+
+    def close(self):
+        self.stop_local_embedding_processes()
+        super().close()
+
+    async def aclose(self):
+        self.stop_local_embedding_processes()
+        await super().aclose()
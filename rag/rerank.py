@@ -0,0 +1,141 @@
+import logging
+import threading
+
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def maximal_marginal_relevance(
+    query_embedding, candidate_embeddings, k=3, lambda_mult=0.5
+):
+    """Select k candidates with maximal marginal relevance: each step picks
+    the candidate maximizing
+
+        lambda_mult * sim(query, candidate)
+        - (1 - lambda_mult) * max(sim(candidate, selected))
+
+    with cosine similarities computed once as matrix products. Returns the
+    indices of the selected candidates, in selection order"""
+    if len(candidate_embeddings) == 0 or k <= 0:
+        return []
+
+    candidate_embeddings = _normalize_rows(candidate_embeddings)
+    query_similarities = candidate_embeddings @ _normalize_rows(query_embedding)
+    candidate_similarities = candidate_embeddings @ candidate_embeddings.T
+
+    k = min(k, len(candidate_embeddings))
+
+    # Highest similarity of each candidate to the selected ones
+    max_selected_similarities = np.full(len(candidate_embeddings), -np.inf)
+    available = np.ones(len(candidate_embeddings), dtype=bool)
+    selected = []
+
+    for _ in range(k):
+        if selected:
+            scores = (
+                lambda_mult * query_similarities
+                - (1 - lambda_mult) * max_selected_similarities
+            )
+        else:
+            scores = query_similarities.copy()
+
+        scores[~available] = -np.inf
+        index = int(np.argmax(scores))
+
+        selected.append(index)
+        available[index] = False
+        np.maximum(
+            max_selected_similarities,
+            candidate_similarities[index],
+            out=max_selected_similarities,
+        )
+
+    return selected
+
+
+class Reranker:
+    """Reorder the candidates retrieved for a question and keep the best k.
+    The RAG system fetches the candidates with their embedding vectors when
+    needs_embeddings is set"""
+
+    needs_embeddings = False
+
+    def rerank(self, question, question_embedding, candidates, k):
+        raise NotImplementedError
+
+
+class MMRReranker(Reranker):
+    """Diversify the candidates with maximal marginal relevance, so
+    overlapping chunks don't fill the context with near duplicates.
+    lambda_mult=1 ranks by relevance only, lambda_mult=0 by diversity only"""
+
+    needs_embeddings = True
+
+    def __init__(self, lambda_mult=0.5):
+        self.lambda_mult = lambda_mult
+
+    def rerank(self, question, question_embedding, candidates, k):
+        indices = maximal_marginal_relevance(
+            question_embedding,
+            [candidate.embedding_vector for candidate in candidates],
+            k,
+            self.lambda_mult,
+        )
+        return [candidates[index] for index in indices]
+
+
+_cross_encoders = {}
+_cross_encoders_lock = threading.Lock()
+
+
+def get_cross_encoder(model_name, device=None):
+    """Load a cross encoder model, only once per process and on first use"""
+    with _cross_encoders_lock:
+        model = _cross_encoders.get((model_name, device))
+
+        if model is None:
+            from sentence_transformers import CrossEncoder
+
+            logger.info("Loading cross encoder model %s", model_name)
+            model = CrossEncoder(model_name, device=device)
+            _cross_encoders[(model_name, device)] = model
+
+        return model
+
+
+class CrossEncoderReranker(Reranker):
+    """Score the (question, candidate) pairs in one batch with a
+    sentence-transformers cross encoder and keep the k best"""
+
+    def __init__(
+        self,
+        model_name="cross-encoder/ms-marco-MiniLM-L-6-v2",
+        device=None,
+        batch_size=32,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+
+    def rerank(self, question, question_embedding, candidates, k):
+        if not candidates:
+            return []
+
+        scores = get_cross_encoder(self.model_name, self.device).predict(
+            [(question, candidate.content) for candidate in candidates],
+            batch_size=self.batch_size,
+            show_progress_bar=False,
+        )
+
+        indices = np.argsort(-np.asarray(scores), kind="stable")[:k]
+        return [candidates[index] for index in indices]
@@ -1,9 +1,64 @@
-def recursive_character_text_splitter(
-    text,
-    chunk_size=1000,
-    chunk_overlap=200,
-    length_function=len,
-    is_separator_regex=False,
+import collections
+import functools
+import re
+from typing import NamedTuple
+
+
+class TextChunk(NamedTuple):
+    text: str
+    # Character offsets of the chunk in the split text, None when unknown
+    start: int | None = None
+    end: int | None = None
+
+
+_word_re = re.compile(r"\S+")
+
+
+class WordTextSplitter:
+    """Split text lazily in chunks of chunk_size words, each one overlapping
+    the previous one by overlap words"""
+
+    def __init__(self, chunk_size=1000, overlap=100):
+        if overlap >= chunk_size:
+            raise ValueError("The overlap must be smaller than the chunk size")
+
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def __call__(self, text):
+        step = self.chunk_size - self.overlap
+
+        # Matches of the words of the next chunk
+        window = collections.deque()
+
+        for match in _word_re.finditer(text):
+            window.append(match)
+
+            if len(window) == self.chunk_size:
+                yield self._make_chunk(window)
+
+                for _ in range(step):
+                    window.popleft()
+
+        # Chunks starting at the remaining words, shorter than chunk_size
+        while window:
+            yield self._make_chunk(window)
+
+            for _ in range(min(step, len(window))):
+                window.popleft()
+
+    @staticmethod
+    def _make_chunk(matches):
+        return TextChunk(
+            " ".join(match.group() for match in matches),
+            matches[0].start(),
+            matches[-1].end(),
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_recursive_character_text_splitter(
+    chunk_size, chunk_overlap, length_function, is_separator_regex
 ):
     from langchain_text_splitters import RecursiveCharacterTextSplitter
 
@@ -12,38 +67,133 @@ def recursive_character_text_splitter(
         chunk_overlap=chunk_overlap,
         length_function=length_function,
         is_separator_regex=is_separator_regex,
-    ).split_text(text)
+        add_start_index=True,
+    )
 
 
-def chunk_text(text, chunk_size=1000, overlap=100):
-    words = text.split()
-    return [
-        " ".join(words[i : i + chunk_size])
-        for i in range(0, len(words), chunk_size - overlap)
-    ]
+class RecursiveCharacterTextSplitter:
+    """Split text with langchain's RecursiveCharacterTextSplitter, which is
+    built once per configuration"""
 
+    def __init__(
+        self,
+        chunk_size=1000,
+        chunk_overlap=200,
+        length_function=len,
+        is_separator_regex=False,
+    ):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length_function = length_function
+        self.is_separator_regex = is_separator_regex
 
-def spacy_chunk(text, max_words=200):
+    def __call__(self, text):
+        splitter = _get_recursive_character_text_splitter(
+            self.chunk_size,
+            self.chunk_overlap,
+            self.length_function,
+            self.is_separator_regex,
+        )
+
+        for document in splitter.create_documents([text]):
+            start = document.metadata["start_index"]
+
+            if start < 0:
+                yield TextChunk(document.page_content)
+            else:
+                yield TextChunk(
+                    document.page_content, start, start + len(document.page_content)
+                )
+
+
+@functools.lru_cache(maxsize=None)
+def load_spacy_model(model_name):
+    """Load a spaCy pipeline once per process, without the components not
+    needed for sentence segmentation"""
     import spacy
 
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load(model_name)
+
+    for pipe_name in ("ner", "lemmatizer"):
+        if pipe_name in nlp.pipe_names:
+            nlp.disable_pipe(pipe_name)
+
+    return nlp
+
+
+class SpacyTextSplitter:
+    """Split text in chunks of whole sentences of up to max_words words
+    (longer sentences make their own chunk). split_many processes many texts
+    in batches with nlp.pipe"""
+
+    def __init__(
+        self, max_words=200, model_name="en_core_web_sm", batch_size=32, n_process=1
+    ):
+        self.max_words = max_words
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.n_process = n_process
+
+    def __call__(self, text):
+        yield from self._chunk_doc(load_spacy_model(self.model_name)(text))
+
+    def split_many(self, texts):
+        """Yield a list with the chunks of each text"""
+        nlp = load_spacy_model(self.model_name)
 
-    doc = nlp(text)
-    chunks = []
-    current_chunk = []
-    current_len = 0
+        for doc in nlp.pipe(
+            texts, batch_size=self.batch_size, n_process=self.n_process
+        ):
+            yield list(self._chunk_doc(doc))
+
+    def _chunk_doc(self, doc):
+        current_chunk = []
+        current_len = 0
+        start = end = None
+
+        for sent in doc.sents:
+            words = sent.text.split()
+
+            if current_chunk and current_len + len(words) > self.max_words:
+                yield TextChunk(" ".join(current_chunk), start, end)
+                current_chunk = []
+                current_len = 0
+
+            if not current_chunk:
+                start = sent.start_char
 
-    for sent in doc.sents:
-        words = sent.text.split()
-        if current_len + len(words) > max_words:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = words
-            current_len = len(words)
-        else:
             current_chunk.extend(words)
             current_len += len(words)
+            end = sent.end_char
+
+        if current_chunk:
+            yield TextChunk(" ".join(current_chunk), start, end)
+
+
+def recursive_character_text_splitter(
+    text,
+    chunk_size=1000,
+    chunk_overlap=200,
+    length_function=len,
+    is_separator_regex=False,
+):
+    return [
+        chunk.text
+        for chunk in RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+            is_separator_regex=is_separator_regex,
+        )(text)
+    ]
 
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
 
-    return chunks
+def chunk_text(text, chunk_size=1000, overlap=100):
+    return [
+        chunk.text
+        for chunk in WordTextSplitter(chunk_size=chunk_size, overlap=overlap)(text)
+    ]
+
+
+def spacy_chunk(text, max_words=200):
+    return [chunk.text for chunk in SpacyTextSplitter(max_words=max_words)(text)]
@@ -0,0 +1,17 @@
+import hashlib
+import itertools
+
+
+def batched(iterable, n):
+    """Batch data from the iterable into lists of length n. The last batch
+    may be shorter (like itertools.batched of Python 3.12)"""
+    if n < 1:
+        raise ValueError("n must be at least one")
+
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -1,26 +1,261 @@
+import asyncio
+
+
+class MissingEmbeddingsError(KeyError):
+    """Raised by upsert_document_chunks when a chunk without embedding
+    vector has no stored chunk with its content hash to reuse the embedding
+    of, because the collection changed since its hashes were read. Nothing
+    is written, the chunks of content_hashes must be embedded again"""
+
+    def __init__(self, content_hashes):
+        super().__init__(sorted(content_hashes))
+        self.content_hashes = set(content_hashes)
+
+
 class VectorDB:
-    def store_document_chunk(self, collection_uuid, content, embedding, metadata=None):
+    def store_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
         raise NotImplementedError
 
     def store_document_chunks_in_batch(
         self, collection_uuid, content_list, embedding_list, metadata_list
     ):
-        for content, embedding, metadata in zip(
-            content_list, embedding_list, metadata_list
-        ):
-            self.store_document(content, embedding, metadata, collection_uuid)
+        return [
+            self.store_document_chunk(
+                collection_uuid, content, embedding_vector, metadata
+            ).id
+            for content, embedding_vector, metadata in zip(
+                content_list, embedding_list, metadata_list
+            )
+        ]
 
-    def similarity_search(self, embedding_vector, k=3, metadata_filter=None):
+    def bulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        """Store an iterable of (collection_uuid, content, embedding_vector,
+        metadata) tuples. Returns the ids of the stored document chunks"""
+        return [
+            self.store_document_chunk(
+                collection_uuid, content, embedding_vector, metadata
+            ).id
+            for collection_uuid, content, embedding_vector, metadata in document_chunks
+        ]
+
+    def similarity_search(
+        self, embedding_vector, k=3, metadata_filter=None, include_embeddings=False
+    ):
+        """Return the k document chunks most similar to the embedding vector.
+        With include_embeddings their embedding vectors are returned too"""
         raise NotImplementedError
 
+    def similarity_search_many(
+        self, embedding_vectors, k=3, metadata_filter=None, include_embeddings=False
+    ):
+        """Run a similarity search for each embedding vector. Returns a list
+        with the list of document chunks found for each one"""
+        return [
+            self.similarity_search(
+                embedding_vector, k, metadata_filter, include_embeddings
+            )
+            for embedding_vector in embedding_vectors
+        ]
+
+    def hybrid_search(
+        self,
+        embedding_vector,
+        query_text,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+    ):
+        """Search combining the similarity to the embedding vector and a full
+        text search of query_text. candidates is the number of results of
+        each search that are fused"""
+        raise NotImplementedError
+
+    def hybrid_search_many(
+        self,
+        embedding_vectors,
+        query_texts,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+    ):
+        return [
+            self.hybrid_search(
+                embedding_vector,
+                query_text,
+                k,
+                metadata_filter,
+                candidates,
+                include_embeddings,
+            )
+            for embedding_vector, query_text in zip(embedding_vectors, query_texts)
+        ]
+
     def delete_document_chunk_by_id(self, document_chunk_id: int):
         raise NotImplementedError
 
-    def delete_all_chunks_of_document(self, document_id: int):
+    def delete_all_chunks_in_collection(self, collection_uuid):
         raise NotImplementedError
 
     def delete_document_chunks(self, **metadata_filter):
         raise NotImplementedError
 
+    def get_document_chunk_hashes(self, collection_uuid):
+        """Return the content hash of each chunk index of the collection, for
+        the chunks stored with upsert_document_chunks"""
+        raise NotImplementedError
+
+    def upsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        """Store the new or changed chunks of a collection, given as
+        (chunk_index, content, content_hash, embedding_vector) tuples, and
+        delete the chunks from num_chunks on. A chunk with embedding vector
+        None reuses the one of the stored chunk with the same hash, or
+        raises MissingEmbeddingsError when there is none. Returns the number
+        of deleted chunks"""
+        raise NotImplementedError
+
     def close(self):
         pass
+
+    # Asyncio interface. By default the blocking methods are run in a worker
+    # thread, native async vector stores override these methods. The extra
+    # arguments of the searches (search_params, collection_uuid...) are
+    # passed on to the blocking methods of the stores supporting them.
+
+    async def astore_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
+        return await asyncio.to_thread(
+            self.store_document_chunk,
+            collection_uuid,
+            content,
+            embedding_vector,
+            metadata,
+        )
+
+    async def astore_document_chunks_in_batch(
+        self, collection_uuid, content_list, embedding_list, metadata_list
+    ):
+        return await asyncio.to_thread(
+            self.store_document_chunks_in_batch,
+            collection_uuid,
+            content_list,
+            embedding_list,
+            metadata_list,
+        )
+
+    async def abulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        return await asyncio.to_thread(
+            self.bulk_store_document_chunks, document_chunks, batch_size
+        )
+
+    async def asimilarity_search(
+        self,
+        embedding_vector,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return await asyncio.to_thread(
+            self.similarity_search,
+            embedding_vector,
+            k,
+            metadata_filter,
+            include_embeddings,
+            **kwargs,
+        )
+
+    async def asimilarity_search_many(
+        self,
+        embedding_vectors,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return await asyncio.to_thread(
+            self.similarity_search_many,
+            embedding_vectors,
+            k,
+            metadata_filter,
+            include_embeddings,
+            **kwargs,
+        )
+
+    async def ahybrid_search(
+        self,
+        embedding_vector,
+        query_text,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return await asyncio.to_thread(
+            self.hybrid_search,
+            embedding_vector,
+            query_text,
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            **kwargs,
+        )
+
+    async def ahybrid_search_many(
+        self,
+        embedding_vectors,
+        query_texts,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return await asyncio.to_thread(
+            self.hybrid_search_many,
+            embedding_vectors,
+            query_texts,
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            **kwargs,
+        )
+
+    async def adelete_document_chunk_by_id(self, document_chunk_id: int):
+        return await asyncio.to_thread(
+            self.delete_document_chunk_by_id, document_chunk_id
+        )
+
+    async def adelete_all_chunks_in_collection(self, collection_uuid):
+        return await asyncio.to_thread(
+            self.delete_all_chunks_in_collection, collection_uuid
+        )
+
+    async def adelete_document_chunks(self, **metadata_filter):
+        return await asyncio.to_thread(self.delete_document_chunks, **metadata_filter)
+
+    async def aget_document_chunk_hashes(self, collection_uuid):
+        return await asyncio.to_thread(self.get_document_chunk_hashes, collection_uuid)
+
+    async def aupsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        return await asyncio.to_thread(
+            self.upsert_document_chunks,
+            collection_uuid,
+            document_chunks,
+            num_chunks,
+            metadata,
+        )
+
+    async def aclose(self):
+        await asyncio.to_thread(self.close)
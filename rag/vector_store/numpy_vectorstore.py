@@ -0,0 +1,584 @@
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import uuid
+
+
+import numpy as np
+
+from .base import MissingEmbeddingsError, VectorDB
+from ..document import DocumentChunk
+
+
+logger = logging.getLogger(__name__)
+
+
+def jsonb_contains(value, other):
+    """Python version of the jsonb containment operator: value @> other"""
+    if isinstance(other, dict):
+        return isinstance(value, dict) and all(
+            key in value and jsonb_contains(value[key], other_value)
+            for key, other_value in other.items()
+        )
+
+    if isinstance(other, list):
+        return isinstance(value, list) and all(
+            any(jsonb_contains(item, other_item) for item in value)
+            for other_item in other
+        )
+
+    if isinstance(value, (dict, list)):
+        return False
+
+    return _scalar_key(value) == _scalar_key(other)
+
+
+def _scalar_key(value):
+    """Hashable key of a JSON scalar with jsonb equality: 1 equals 1.0 but
+    true doesn't equal 1"""
+    if isinstance(value, bool):
+        return ("boolean", value)
+    if isinstance(value, (int, float)):
+        return ("number", float(value))
+    return (type(value).__name__, value)
+
+
+def _is_scalar(value):
+    return not isinstance(value, (dict, list))
+
+
+class NumpyVectorDB(VectorDB):
+    """In-process vector store keeping the embeddings in a contiguous float32
+    matrix and the rest of the fields in columns.
+
+    Similarity search is one vectorized cosine top-k. Metadata filters have
+    the semantics of the jsonb containment operator (metadata @> filter) and
+    are answered with masks built from an inverted index of the top-level
+    scalar metadata values. Deleted rows are tombstoned and the matrix is
+    compacted when they exceed compaction_threshold of the rows. Upserted
+    chunks replace the stored ones by tombstoning them and appending the new
+    rows.
+
+    When path is given, the store is persisted there by save() and loaded
+    from there on initialization, memory-mapping the embeddings file if
+    mmap is true. A memory-mapped matrix is copied into memory on the first
+    write.
+    """
+
+    embeddings_file_name = "embeddings.npy"
+    columns_file_name = "columns.json"
+
+    def __init__(
+        self,
+        vector_dimension=1536,
+        path=None,
+        mmap=True,
+        initial_capacity=1024,
+        compaction_threshold=0.25,
+    ):
+        if not isinstance(vector_dimension, int) or vector_dimension <= 0:
+            raise ValueError("Invalid vector dimention %s" % vector_dimension)
+
+        self.vector_dimension = vector_dimension
+        self.path = path
+        self.compaction_threshold = compaction_threshold
+
+        self._lock = threading.RLock()
+
+        self._embeddings = np.zeros(
+            (initial_capacity, vector_dimension), dtype=np.float32
+        )
+        self._alive = np.zeros(initial_capacity, dtype=bool)
+        self._ids = np.zeros(initial_capacity, dtype=np.int64)
+        self._collection_uuids = []
+        self._contents = []
+        self._metadatas = []
+        self._created_ats = []
+        # Position and content hash of the chunks stored by
+        # upsert_document_chunks, None for the other chunks
+        self._chunk_indexes = []
+        self._content_hashes = []
+
+        self._size = 0
+        self._num_deleted = 0
+        self._next_id = 1
+        self._rows_by_id = {}
+
+        # (key, scalar key) -> rows having that top-level metadata value
+        self._metadata_index = collections.defaultdict(list)
+        self._mask_cache = {}
+
+        if path is not None and os.path.exists(
+            os.path.join(path, self.embeddings_file_name)
+        ):
+            self._load(mmap)
+
+    def __len__(self):
+        return self._size - self._num_deleted
+
+    def _load(self, mmap):
+        logger.info("Loading vector store from %s", self.path)
+
+        embeddings = np.load(
+            os.path.join(self.path, self.embeddings_file_name),
+            mmap_mode="r" if mmap else None,
+        )
+        if embeddings.shape[1] != self.vector_dimension:
+            raise ValueError(
+                "Stored vector dimension %s doesn't match %s"
+                % (embeddings.shape[1], self.vector_dimension)
+            )
+
+        with open(os.path.join(self.path, self.columns_file_name)) as f:
+            columns = json.load(f)
+
+        size = len(columns["ids"])
+
+        self._embeddings = embeddings
+        self._alive = np.ones(size, dtype=bool)
+        self._ids = np.array(columns["ids"], dtype=np.int64)
+        self._collection_uuids = [
+            uuid.UUID(collection_uuid)
+            for collection_uuid in columns["collection_uuids"]
+        ]
+        self._contents = columns["contents"]
+        self._metadatas = columns["metadatas"]
+        self._created_ats = [
+            datetime.datetime.fromisoformat(created_at)
+            for created_at in columns["created_ats"]
+        ]
+        # Stores saved before upserts were supported have no chunk indexes
+        self._chunk_indexes = columns.get("chunk_indexes", [None] * size)
+        self._content_hashes = columns.get("content_hashes", [None] * size)
+        self._size = size
+        self._next_id = columns["next_id"]
+
+        self._rebuild_indexes()
+
+    def save(self):
+        """Compact the store and write it to path"""
+        if self.path is None:
+            raise ValueError("The vector store has no path")
+
+        with self._lock:
+            self.compact()
+
+            os.makedirs(self.path, exist_ok=True)
+
+            # Written to temporary files and renamed, the current embeddings
+            # file may be memory-mapped
+            embeddings_path = os.path.join(self.path, self.embeddings_file_name)
+            with open(embeddings_path + ".tmp", "wb") as f:
+                np.save(f, self._embeddings[: self._size])
+            os.replace(embeddings_path + ".tmp", embeddings_path)
+
+            columns_path = os.path.join(self.path, self.columns_file_name)
+            with open(columns_path + ".tmp", "w") as f:
+                json.dump(
+                    {
+                        "ids": self._ids[: self._size].tolist(),
+                        "collection_uuids": [
+                            str(collection_uuid)
+                            for collection_uuid in self._collection_uuids
+                        ],
+                        "contents": self._contents,
+                        "metadatas": self._metadatas,
+                        "created_ats": [
+                            created_at.isoformat() for created_at in self._created_ats
+                        ],
+                        "chunk_indexes": self._chunk_indexes,
+                        "content_hashes": self._content_hashes,
+                        "next_id": self._next_id,
+                    },
+                    f,
+                )
+            os.replace(columns_path + ".tmp", columns_path)
+
+    def _rebuild_indexes(self):
+        self._rows_by_id = {}
+        self._metadata_index = collections.defaultdict(list)
+        self._mask_cache = {}
+
+        for row in range(self._size):
+            if self._alive[row]:
+                self._index_row(row)
+
+    def _index_row(self, row):
+        self._rows_by_id[int(self._ids[row])] = row
+
+        metadata = self._metadatas[row]
+        if isinstance(metadata, dict):
+            for key, value in metadata.items():
+                if _is_scalar(value):
+                    self._metadata_index[(key, _scalar_key(value))].append(row)
+
+    def _ensure_capacity(self, size):
+        capacity = len(self._embeddings)
+
+        if size <= capacity and self._embeddings.flags.writeable:
+            return
+
+        # Grow geometrically. A read-only memory-mapped matrix is copied into
+        # memory here
+        new_capacity = max(size, 2 * capacity)
+
+        embeddings = np.zeros((new_capacity, self.vector_dimension), dtype=np.float32)
+        embeddings[: self._size] = self._embeddings[: self._size]
+        self._embeddings = embeddings
+
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[: self._size] = self._alive[: self._size]
+        self._alive = alive
+
+        ids = np.zeros(new_capacity, dtype=np.int64)
+        ids[: self._size] = self._ids[: self._size]
+        self._ids = ids
+
+    def _normalize(self, embedding_vectors):
+        embedding_vectors = np.asarray(embedding_vectors, dtype=np.float32)
+
+        if embedding_vectors.shape[-1] != self.vector_dimension:
+            raise ValueError(
+                "Invalid vector dimension %s, expected %s"
+                % (embedding_vectors.shape[-1], self.vector_dimension)
+            )
+
+        norms = np.linalg.norm(embedding_vectors, axis=-1, keepdims=True)
+        return embedding_vectors / np.where(norms == 0, 1, norms)
+
+    def store_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
+        logger.debug("Storing document chunk: [%s] %s", collection_uuid, content)
+
+        document_chunk_id = self.bulk_store_document_chunks(
+            [(collection_uuid, content, embedding_vector, metadata)]
+        )[0]
+
+        with self._lock:
+            row = self._rows_by_id[document_chunk_id]
+            return self._row_to_document_chunk(row)
+
+    def store_document_chunks_in_batch(
+        self, collection_uuid, content_list, embedding_list, metadata_list
+    ):
+        return self.bulk_store_document_chunks(
+            [
+                (collection_uuid, content, embedding_vector, metadata)
+                for content, embedding_vector, metadata in zip(
+                    content_list, embedding_list, metadata_list
+                )
+            ]
+        )
+
+    def bulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        document_chunk_ids = []
+
+        batch = []
+        for document_chunk in document_chunks:
+            batch.append(document_chunk)
+
+            if len(batch) == batch_size:
+                document_chunk_ids.extend(self._append(batch))
+                batch = []
+
+        if batch:
+            document_chunk_ids.extend(self._append(batch))
+
+        return document_chunk_ids
+
+    def _append(self, batch, chunk_keys=None):
+        embedding_vectors = self._normalize(
+            [embedding_vector for _, _, embedding_vector, _ in batch]
+        )
+        created_at = datetime.datetime.now()
+
+        with self._lock:
+            start = self._size
+            end = start + len(batch)
+
+            self._ensure_capacity(end)
+
+            document_chunk_ids = list(range(self._next_id, self._next_id + len(batch)))
+            self._next_id += len(batch)
+
+            self._embeddings[start:end] = embedding_vectors
+            self._alive[start:end] = True
+            self._ids[start:end] = document_chunk_ids
+
+            for collection_uuid, content, _, metadata in batch:
+                self._collection_uuids.append(collection_uuid)
+                self._contents.append(content)
+                self._metadatas.append(metadata)
+                self._created_ats.append(created_at)
+
+            for chunk_index, content_hash in chunk_keys or [(None, None)] * len(batch):
+                self._chunk_indexes.append(chunk_index)
+                self._content_hashes.append(content_hash)
+
+            self._size = end
+            self._mask_cache = {}
+
+            for row in range(start, end):
+                self._index_row(row)
+
+        return document_chunk_ids
+
+    def _filter_mask(self, metadata_filter):
+        """Boolean mask of the live rows matching the metadata filter"""
+        mask = self._alive[: self._size].copy()
+
+        if not metadata_filter:
+            return mask
+
+        nested_filter = {}
+
+        for key, value in metadata_filter.items():
+            if not _is_scalar(value):
+                nested_filter[key] = value
+                continue
+
+            index_key = (key, _scalar_key(value))
+            key_mask = self._mask_cache.get(index_key)
+
+            if key_mask is None:
+                key_mask = np.zeros(self._size, dtype=bool)
+                key_mask[self._metadata_index.get(index_key, [])] = True
+                self._mask_cache[index_key] = key_mask
+
+            mask &= key_mask
+
+        if nested_filter:
+            for row in np.flatnonzero(mask):
+                if not jsonb_contains(self._metadatas[row], nested_filter):
+                    mask[row] = False
+
+        return mask
+
+    @staticmethod
+    def _top_k(scores, k):
+        """Indices of the k highest scores, in descending order"""
+        k = min(k, len(scores))
+
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+
+        indices = np.argpartition(-scores, k - 1)[:k]
+        return indices[np.argsort(-scores[indices], kind="stable")]
+
+    def similarity_search(
+        self, embedding_vector, k=3, metadata_filter=None, include_embeddings=False
+    ):
+        return self.similarity_search_many(
+            [embedding_vector], k, metadata_filter, include_embeddings
+        )[0]
+
+    def similarity_search_many(
+        self, embedding_vectors, k=3, metadata_filter=None, include_embeddings=False
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        query_vectors = self._normalize(embedding_vectors)
+
+        with self._lock:
+            mask = self._filter_mask(metadata_filter)
+
+            # Only the rows matching the filter and not deleted are scored
+            if mask.all():
+                rows = np.arange(self._size)
+                scores = query_vectors @ self._embeddings[: self._size].T
+            else:
+                rows = np.flatnonzero(mask)
+                scores = query_vectors @ self._embeddings[rows].T
+
+            results = []
+            for row_scores in scores:
+                top_k = self._top_k(row_scores, k)
+
+                results.append(
+                    [
+                        self._row_to_document_chunk(
+                            row, include_embeddings, 1.0 - float(score)
+                        )
+                        for row, score in zip(rows[top_k], row_scores[top_k])
+                    ]
+                )
+
+            return results
+
+    def _row_to_document_chunk(self, row, include_embeddings=False, distance=None):
+        return DocumentChunk(
+            id=int(self._ids[row]),
+            collection_uuid=self._collection_uuids[row],
+            content=self._contents[row],
+            metadata=self._metadatas[row],
+            created_at=self._created_ats[row],
+            # The stored embeddings are normalized
+            embedding_vector=(
+                np.array(self._embeddings[row]) if include_embeddings else None
+            ),
+            distance=distance,
+        )
+
+    def _delete_rows(self, rows):
+        with self._lock:
+            rows = [row for row in rows if self._alive[row]]
+
+            for row in rows:
+                self._alive[row] = False
+                del self._rows_by_id[int(self._ids[row])]
+
+            self._num_deleted += len(rows)
+            self._mask_cache = {}
+
+            if self._num_deleted > self.compaction_threshold * self._size:
+                self.compact()
+
+            return len(rows)
+
+    def delete_document_chunk_by_id(self, document_chunk_id: int):
+        with self._lock:
+            row = self._rows_by_id.get(document_chunk_id)
+
+            if row is None:
+                return False
+
+            return self._delete_rows([row]) == 1
+
+    def delete_all_chunks_in_collection(self, collection_uuid: uuid.UUID):
+        with self._lock:
+            return self._delete_rows(
+                [
+                    row
+                    for row in range(self._size)
+                    if self._collection_uuids[row] == collection_uuid
+                ]
+            )
+
+    def delete_document_chunks(self, **metadata_filter):
+        with self._lock:
+            return self._delete_rows(np.flatnonzero(self._filter_mask(metadata_filter)))
+
+    def _collection_rows(self, collection_uuid):
+        return [
+            row
+            for row in range(self._size)
+            if self._alive[row] and self._collection_uuids[row] == collection_uuid
+        ]
+
+    def get_document_chunk_hashes(self, collection_uuid):
+        with self._lock:
+            return {
+                self._chunk_indexes[row]: self._content_hashes[row]
+                for row in self._collection_rows(collection_uuid)
+                if self._chunk_indexes[row] is not None
+            }
+
+    def upsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        """Tombstone the stored chunks replaced by the new or changed chunks,
+        given as (chunk_index, content, content_hash, embedding_vector)
+        tuples, and the stale ones, then append the new chunks. A chunk with
+        embedding vector None reuses the one of the stored chunk with the
+        same hash, or raises MissingEmbeddingsError when there is none"""
+        document_chunks = list(document_chunks)
+        chunk_indexes = {chunk_index for chunk_index, _, _, _ in document_chunks}
+
+        with self._lock:
+            rows = self._collection_rows(collection_uuid)
+
+            embeddings_by_hash = {}
+            for row in rows:
+                if self._content_hashes[row] is not None:
+                    embeddings_by_hash.setdefault(
+                        self._content_hashes[row], np.array(self._embeddings[row])
+                    )
+
+            missing_hashes = {
+                content_hash
+                for _, _, content_hash, embedding_vector in document_chunks
+                if embedding_vector is None and content_hash not in embeddings_by_hash
+            }
+            if missing_hashes:
+                raise MissingEmbeddingsError(missing_hashes)
+
+            # The chunks not stored by upserts have no chunk index and are
+            # left alone
+            stale_rows = [
+                row
+                for row in rows
+                if self._chunk_indexes[row] is not None
+                and self._chunk_indexes[row] >= num_chunks
+            ]
+            replaced_rows = [
+                row
+                for row in rows
+                if self._chunk_indexes[row] in chunk_indexes
+                and self._chunk_indexes[row] < num_chunks
+            ]
+
+            # Deleting may compact the store and move the rows
+            self._delete_rows(stale_rows + replaced_rows)
+
+            if document_chunks:
+                self._append(
+                    [
+                        (
+                            collection_uuid,
+                            content,
+                            (
+                                embedding_vector
+                                if embedding_vector is not None
+                                else embeddings_by_hash[content_hash]
+                            ),
+                            metadata,
+                        )
+                        for _, content, content_hash, embedding_vector in document_chunks
+                    ],
+                    [
+                        (chunk_index, content_hash)
+                        for chunk_index, _, content_hash, _ in document_chunks
+                    ],
+                )
+
+            # The collection metadata is updated on all its chunks
+            metadata_changed = False
+            for row in self._collection_rows(collection_uuid):
+                if self._metadatas[row] != metadata:
+                    self._metadatas[row] = metadata
+                    metadata_changed = True
+
+            if metadata_changed:
+                self._rebuild_indexes()
+
+            return len(stale_rows)
+
+    def compact(self):
+        """Remove the tombstoned rows"""
+        with self._lock:
+            if self._num_deleted == 0:
+                return
+
+            logger.debug("Compacting %s deleted rows", self._num_deleted)
+
+            rows = np.flatnonzero(self._alive[: self._size])
+
+            self._embeddings = self._embeddings[rows]
+            self._alive = np.ones(len(rows), dtype=bool)
+            self._ids = self._ids[rows]
+            self._collection_uuids = [self._collection_uuids[row] for row in rows]
+            self._contents = [self._contents[row] for row in rows]
+            self._metadatas = [self._metadatas[row] for row in rows]
+            self._created_ats = [self._created_ats[row] for row in rows]
+            self._chunk_indexes = [self._chunk_indexes[row] for row in rows]
+            self._content_hashes = [self._content_hashes[row] for row in rows]
+
+            self._size = len(rows)
+            self._num_deleted = 0
+
+            self._rebuild_indexes()
@@ -1,24 +1,71 @@
+import contextlib
 import itertools
 import os
 import logging
+import threading
+import time
 import uuid
 import datetime
 
 
 import psycopg
 from psycopg import sql
-from psycopg.types.json import Json
-from pgvector.psycopg import register_vector
+from psycopg.types.json import Json, Jsonb
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+from pgvector.psycopg import register_vector, register_vector_async
 import numpy as np
 
-from .base import VectorDB
+from .base import MissingEmbeddingsError, VectorDB
 from ..document import DocumentChunk
+from ..utils import batched
 
 
 logger = logging.getLogger(__name__)
 
 
-class PgVectorVectorDB(VectorDB):
+# Tables whose schema has already been initialized by this process, keyed by
+# (host, port, database, table_name) and the options adding columns, indexes
+# or partitions to the schema
+_initialized_tables = set()
+_initialized_tables_lock = threading.Lock()
+
+
+# Search parameters accepted by the searches, and the settings they set
+SEARCH_PARAMS = {
+    "ef_search": "hnsw.ef_search",
+    # off, strict_order or relaxed_order, needs pgvector 0.8
+    "iterative_scan": "hnsw.iterative_scan",
+    "max_scan_tuples": "hnsw.max_scan_tuples",
+    "scan_mem_multiplier": "hnsw.scan_mem_multiplier",
+}
+
+# Default and maximum hnsw.ef_search of pgvector
+DEFAULT_EF_SEARCH = 40
+MAX_EF_SEARCH = 1000
+
+# Precisions of the HNSW index, and how many times k candidates are fetched
+# from a quantized index by default to be re-ranked by exact distance
+INDEX_PRECISIONS = ("float", "half", "binary")
+DEFAULT_OVERSAMPLING = {"half": 2, "binary": 10}
+
+PARTITIONINGS = (None, "hash", "list")
+
+# Columns of the document chunks the similarity searches can return
+SEARCH_COLUMNS = (
+    "id",
+    "collection_uuid",
+    "content",
+    "metadata",
+    "created_at",
+    "distance",
+    "embedding_vector",
+)
+
+
+class BasePgVectorVectorDB(VectorDB):
+    """Configuration and SQL statements shared by the blocking and the
+    asyncio pgvector vector stores"""
+
     def __init__(
         self,
         host="localhost",
@@ -31,6 +78,21 @@ class PgVectorVectorDB(VectorDB):
         vector_dimension=1536,
         table_name="documents",
         create_extension=False,
+        pool_size=None,
+        pool_min_size=1,
+        pool_timeout=30.0,
+        full_text_search=False,
+        text_search_config="english",
+        rrf_k=60,
+        search_params=None,
+        index_precision="float",
+        oversampling=None,
+        metadata_index=False,
+        indexed_metadata_keys=(),
+        partitioning=None,
+        partitions=None,
+        maintenance_work_mem=None,
+        max_parallel_maintenance_workers=None,
     ):
         if not isinstance(vector_dimension, int) and vector_dimension <= 0:
             raise ValueError("Invalid vector dimention %s" % vector_dimension)
@@ -44,28 +106,85 @@ class PgVectorVectorDB(VectorDB):
             password,
         )
 
-        self.conn = psycopg.connect(
+        self.conninfo = dict(
             host=host, port=port, dbname=database, user=user, password=password
         )
 
-        register_vector(self.conn)
-
         self.m = m
         self.ef_construction = ef_construction
         self.vector_dimension = vector_dimension
         self.table_name = table_name
+        self.create_extension = create_extension
 
-        embedding_idx_name = table_name + "_embedding_idx"
-        self.embedding_idx_name = embedding_idx_name
+        self.pool_size = pool_size
+        self.pool_min_size = pool_min_size
+        self.pool_timeout = pool_timeout
+
+        # Hybrid search needs a tsvector column, kept up to date by postgres
+        # as a generated column, with a GIN index
+        self.full_text_search = full_text_search
+        self.text_search_config = text_search_config
+        self.rrf_k = rrf_k
+
+        # Default search parameters, overridden by the ones of each search
+        self.search_params = search_params or {}
+
+        # The HNSW index can be built on the embeddings quantized to half
+        # precision floats (2x smaller) or to bits (32x smaller). The searches
+        # then fetch oversampling times more candidates from the index and
+        # re-rank them by the exact distance of the full precision vectors
+        if index_precision not in INDEX_PRECISIONS:
+            raise ValueError("Invalid index precision %s" % index_precision)
+
+        self.index_precision = index_precision
+        self.oversampling = (
+            oversampling
+            if oversampling is not None
+            else DEFAULT_OVERSAMPLING.get(index_precision, 1)
+        )
 
-        self._init_db(
-            m=m,
-            ef_construction=ef_construction,
-            table_name=table_name,
-            embedding_idx_name=embedding_idx_name,
-            vector_dimension=vector_dimension,
-            create_extension=create_extension,
+        # metadata @> filters can be served by a jsonb_path_ops GIN index,
+        # and the equality of the values of the hot metadata keys by
+        # expression indexes. Both are opt-in: they are created on first use
+        # with a plain CREATE INDEX, which blocks the writes to an existing
+        # table while it's built
+        self.metadata_index = metadata_index
+        self.indexed_metadata_keys = tuple(indexed_metadata_keys)
+
+        # The table can be partitioned by collection_uuid, with hash
+        # partitions (partitions is their number) or list partitions
+        # (partitions maps partition names to lists of collection uuids, the
+        # other collections go to a default partition). Each partition gets
+        # its own HNSW index, and the searches scoped to collections only
+        # scan their partitions
+        if partitioning not in PARTITIONINGS:
+            raise ValueError("Invalid partitioning %s" % partitioning)
+
+        self.partitioning = partitioning
+        self.partitions = (
+            partitions
+            if partitions is not None
+            else (16 if partitioning == "hash" else {})
+        )
+
+        # Settings of the index builds, like "4GB" and 7: an HNSW graph that
+        # doesn't fit in maintenance_work_mem takes much longer to build
+        self.maintenance_work_mem = maintenance_work_mem
+        self.max_parallel_maintenance_workers = max_parallel_maintenance_workers
+
+        embedding_idx_name = table_name + (
+            "_embedding_idx"
+            if index_precision == "float"
+            else "_embedding_%s_idx" % index_precision
         )
+        self.embedding_idx_name = embedding_idx_name
+        self.content_tsv_idx_name = table_name + "_content_tsv_idx"
+        self.chunk_idx_name = table_name + "_collection_uuid_chunk_index_idx"
+        self.metadata_idx_name = table_name + "_metadata_idx"
+
+        # Similarity search statements by shape (filter, columns, candidates),
+        # composed once and prepared by psycopg on each connection
+        self._search_queries = {}
 
     @classmethod
     def initialize_from_env_variables(cls, **kw):
@@ -78,7 +197,48 @@ class PgVectorVectorDB(VectorDB):
             **kw
         )
 
-    def _init_db(
+    def _db_key(self):
+        partitions = self.partitions
+        if isinstance(partitions, dict):
+            partitions = tuple(
+                (name, tuple(str(collection_uuid) for collection_uuid in uuids))
+                for name, uuids in sorted(partitions.items())
+            )
+
+        return (
+            self.conninfo["host"],
+            str(self.conninfo["port"]),
+            self.conninfo["dbname"],
+            self.table_name,
+            self.full_text_search,
+            self.text_search_config,
+            self.index_precision,
+            self.metadata_index,
+            self.indexed_metadata_keys,
+            self.partitioning,
+            partitions,
+        )
+
+    def _is_db_initialized(self):
+        with _initialized_tables_lock:
+            return self._db_key() in _initialized_tables
+
+    def _mark_db_initialized(self):
+        with _initialized_tables_lock:
+            _initialized_tables.add(self._db_key())
+
+    def _init_db_kwargs(self):
+        return dict(
+            m=self.m,
+            ef_construction=self.ef_construction,
+            table_name=self.table_name,
+            embedding_idx_name=self.embedding_idx_name,
+            vector_dimension=self.vector_dimension,
+            create_extension=self.create_extension,
+            full_text_search=self.full_text_search,
+        )
+
+    def _init_db_statements(
         self,
         m,
         ef_construction,
@@ -86,12 +246,24 @@ class PgVectorVectorDB(VectorDB):
         embedding_idx_name,
         vector_dimension,
         create_extension=False,
+        full_text_search=False,
     ):
-        with self.conn.cursor() as cur:
-            if create_extension:
-                cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        statements = []
 
-            cur.execute(
+        if create_extension:
+            statements.append(sql.SQL("CREATE EXTENSION IF NOT EXISTS vector"))
+
+        # New tables get the tsvector column of the full text search. Adding
+        # it to an existing table rewrites it, that's left to
+        # add_full_text_search
+        text_search_column = (
+            sql.SQL("{},").format(self._text_search_column_definition())
+            if full_text_search
+            else sql.SQL("")
+        )
+
+        if self.partitioning is None:
+            statements.append(
                 sql.SQL(
                     """
                 CREATE TABLE IF NOT EXISTS {table_name} (
@@ -100,208 +272,2000 @@ class PgVectorVectorDB(VectorDB):
                     content TEXT,
                     metadata JSONB,
                     embedding_vector vector({vector_dimension}),
+                    {text_search_column}
                     created_at TIMESTAMP DEFAULT NOW()
                 )
             """
                 ).format(
                     table_name=sql.Identifier(table_name),
                     vector_dimension=sql.Literal(vector_dimension),
+                    text_search_column=text_search_column,
                 )
             )
-            cur.execute(
+        else:
+            # The primary key of a partitioned table must include the
+            # partition key
+            statements.append(
                 sql.SQL(
                     """
-                CREATE INDEX IF NOT EXISTS {embedding_idx_name} 
-                ON {table_name} USING hnsw (embedding_vector vector_cosine_ops)
-                WITH (m = {m}, ef_construction = {ef_construction})
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id BIGSERIAL,
+                    collection_uuid UUID NOT NULL,
+                    content TEXT,
+                    metadata JSONB,
+                    embedding_vector vector({vector_dimension}),
+                    {text_search_column}
+                    created_at TIMESTAMP DEFAULT NOW(),
+                    PRIMARY KEY (id, collection_uuid)
+                ) PARTITION BY {partitioning} (collection_uuid)
             """
                 ).format(
-                    embedding_idx_name=sql.Identifier(embedding_idx_name),
                     table_name=sql.Identifier(table_name),
-                    m=sql.Literal(m),
-                    ef_construction=sql.Literal(ef_construction),
+                    vector_dimension=sql.Literal(vector_dimension),
+                    text_search_column=text_search_column,
+                    partitioning=sql.SQL(self.partitioning.upper()),
                 )
             )
-            # Add unique constraint document_id and chunk_number ??
-            self.conn.commit()
+            statements.extend(self._create_partition_statements())
 
-    def _verify_index(self):
-        with self.conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT COUNT(*)
-                FROM pg_indexes
-                WHERE tablename = %s AND indexdef LIKE '%% USING hnsw (embedding_vector vector_cosine_ops)%%' AND indexname = %s AND schemaname = 'public'
-            """,
-                self.table_name,
-                self.table_name + "_embedding_idx",
+        statements.append(
+            self._create_embedding_index_statement(
+                m, ef_construction, table_name, embedding_idx_name, vector_dimension
             )
-
-            return cur.fetchone()[0] == 1
-
-    def _check_health(self) -> bool:
-        """Check database connectivity."""
-        with self.conn.cursor() as cur:
-            try:
-                cur.execute("SELECT 1")
-            except Exception as e:
-                return False
-            else:
-                return True
-
-    def delete_document_chunk_by_id(self, document_chunk_id: int):
-        with conn.cursor() as cur:
-            cur.execute(
+        )
+        if self.metadata_index:
+            statements.append(
                 sql.SQL(
                     """
-                DELETE FROM {table_name}
-                WHERE id = %s
-                """
-                ).format(table_name=self.table_name),
-                (document_chunk_id,),
+                CREATE INDEX IF NOT EXISTS {metadata_idx_name}
+                ON {table_name} USING gin (metadata jsonb_path_ops)
+            """
+                ).format(
+                    metadata_idx_name=sql.Identifier(self.metadata_idx_name),
+                    table_name=sql.Identifier(table_name),
+                )
             )
-            conn.commit()
-
-            return cur.rowcount == 1
-
-    def delete_all_chunks_in_collection(self, collection_uuid: uuid.UUID):
-        with conn.cursor() as cur:
-            cur.execute(
+        for key in self.indexed_metadata_keys:
+            statements.append(
                 sql.SQL(
                     """
-                DELETE FROM {table_name}
-                WHERE collection_uuid = %s
+                CREATE INDEX IF NOT EXISTS {metadata_key_idx_name}
+                ON {table_name} ({metadata_value})
+            """
+                ).format(
+                    metadata_key_idx_name=sql.Identifier(
+                        "%s_metadata_%s_idx" % (table_name, key)
+                    ),
+                    table_name=sql.Identifier(table_name),
+                    metadata_value=self._metadata_value(key),
+                )
+            )
+        # Position and hash of the chunks of the documents stored with
+        # upsert_document_chunks. Tables created before these columns existed
+        # get them added. Their index also serves the lookups by
+        # collection_uuid
+        statements.append(
+            sql.SQL(
+                """
+            ALTER TABLE {table_name}
+            ADD COLUMN IF NOT EXISTS chunk_index INTEGER,
+            ADD COLUMN IF NOT EXISTS content_hash TEXT
+        """
+            ).format(table_name=sql.Identifier(table_name))
+        )
+        statements.append(
+            sql.SQL(
                 """
-                ).format(table_name=self.table_name),
-                (collection_uuid,),
+            CREATE UNIQUE INDEX IF NOT EXISTS {chunk_idx_name}
+            ON {table_name} (collection_uuid, chunk_index)
+        """
+            ).format(
+                chunk_idx_name=sql.Identifier(self.chunk_idx_name),
+                table_name=sql.Identifier(table_name),
             )
-            conn.commit()
+        )
 
-            return cur.rowcount
+        return statements
 
-    def delete_document_chunks(self, **metadata_filter):
-        with conn.cursor() as cur:
-            if len(metadata_filter) == 0:
-                cur.execute(
-                    sql.SQL(
-                        """
-                    DELETE FROM {table_name}
-                    """
-                    ).format(table_name=self.table_name)
-                )
-            else:
-                cur.execute(
-                    sql.SQL(
-                        """
-                    DELETE FROM {table_name}
-                    WHERE metadata @> %s
-                    """
-                    ).format(table_name=self.table_name),
-                    (metadata_filter,),
-                )
-                conn.commit()
+    def _text_search_column_definition(self):
+        return sql.SQL(
+            "content_tsv tsvector GENERATED ALWAYS AS (to_tsvector({text_search_config}, coalesce(content, ''))) STORED"
+        ).format(text_search_config=self._text_search_config())
 
-            return cur.rowcount
+    def _text_search_column_query(self):
+        """Query returning a row when the table has the tsvector column"""
+        return sql.SQL(
+            "SELECT 1 FROM pg_attribute WHERE attrelid = {table_name}::regclass AND attname = 'content_tsv' AND NOT attisdropped"
+        ).format(
+            table_name=sql.Literal(sql.Identifier(self.table_name).as_string(None))
+        )
 
-    def store_document_chunk(
-        self, collection_uuid, content, embedding_vector, metadata=None
+    def _text_search_index_statement(self, concurrently=False):
+        return sql.SQL(
+            """
+            CREATE INDEX {concurrently} IF NOT EXISTS {content_tsv_idx_name}
+            ON {table_name} USING gin (content_tsv)
+        """
+        ).format(
+            concurrently=sql.SQL("CONCURRENTLY" if concurrently else ""),
+            content_tsv_idx_name=sql.Identifier(self.content_tsv_idx_name),
+            table_name=sql.Identifier(self.table_name),
+        )
+
+    def _add_text_search_column_statement(self):
+        return sql.SQL("ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {}").format(
+            self._text_search_column_definition(),
+            table_name=sql.Identifier(self.table_name),
+        )
+
+    def _warn_missing_text_search_column(self):
+        logger.warning(
+            "Table %s has no tsvector column, the hybrid searches will fail "
+            "until add_full_text_search is run",
+            self.table_name,
+        )
+
+    def _create_embedding_index_statement(
+        self,
+        m,
+        ef_construction,
+        table_name,
+        embedding_idx_name,
+        vector_dimension,
+        concurrently=False,
     ):
-        logger.debug("Storing document chunk: [%s] %s", collection_uuid, content)
+        return sql.SQL(
+            """
+            CREATE INDEX {concurrently} IF NOT EXISTS {embedding_idx_name}
+            ON {table_name} USING hnsw ({indexed_expression} {operator_class})
+            WITH (m = {m}, ef_construction = {ef_construction})
+        """
+        ).format(
+            concurrently=sql.SQL("CONCURRENTLY" if concurrently else ""),
+            embedding_idx_name=sql.Identifier(embedding_idx_name),
+            table_name=sql.Identifier(table_name),
+            indexed_expression=self._indexed_expression(
+                sql.Identifier("embedding_vector"), vector_dimension
+            ),
+            operator_class=sql.SQL(
+                {
+                    "float": "vector_cosine_ops",
+                    "half": "halfvec_cosine_ops",
+                    "binary": "bit_hamming_ops",
+                }[self.index_precision]
+            ),
+            m=sql.Literal(m),
+            ef_construction=sql.Literal(ef_construction),
+        )
 
-        with self.conn.cursor() as cur:
-            cur.execute(
-                sql.SQL(
-                    "INSERT INTO {} (collection_uuid, content, metadata, embedding_vector) VALUES (%s, %s, %s, %s) RETURNING id"
-                ).format(sql.Identifier(self.table_name)),
-                (
-                    collection_uuid,
-                    content,
-                    Json(metadata) if metadata is not None else None,
-                    np.array(embedding_vector),
-                ),
+    def _build_index_statement(self, concurrently=False, m=None, ef_construction=None):
+        if concurrently and self.partitioning is not None:
+            raise ValueError(
+                "The index of a partitioned table can't be built concurrently"
             )
 
-            self.conn.commit()
+        return self._create_embedding_index_statement(
+            m or self.m,
+            ef_construction or self.ef_construction,
+            self.table_name,
+            self.embedding_idx_name,
+            self.vector_dimension,
+            concurrently,
+        )
 
-            document_chunk_id = cur.fetchone()[0]
+    def _drop_index_statement(self):
+        return sql.SQL("DROP INDEX IF EXISTS {embedding_idx_name}").format(
+            embedding_idx_name=sql.Identifier(self.embedding_idx_name)
+        )
 
-            return DocumentChunk(
-                id=document_chunk_id,
-                collection_uuid=collection_uuid,
-                content=content,
-                metadata=metadata,
-                created_at=datetime.datetime.now(),
-            )
+    def _reindex_statements(self, m=None, ef_construction=None, concurrently=True):
+        """Statements rebuilding the HNSW index, with new m or ef_construction
+        when given, and whether they must run in one transaction. REINDEX
+        CONCURRENTLY doesn't block the writes, but the options of a
+        partitioned index can't be altered, it's dropped and built again"""
+        reindex = sql.SQL("REINDEX INDEX {concurrently} {embedding_idx_name}").format(
+            concurrently=sql.SQL("CONCURRENTLY" if concurrently else ""),
+            embedding_idx_name=sql.Identifier(self.embedding_idx_name),
+        )
 
-    def store_document_chunks_in_batch(
-        self, collection_uuid, content_list, embedding_list, metadata_list
+        options = {
+            name: value
+            for name, value in (("m", m), ("ef_construction", ef_construction))
+            if value is not None
+        }
+        if not options:
+            return [reindex], False
+
+        if self.partitioning is not None:
+            if concurrently:
+                raise ValueError(
+                    "The index options of a partitioned table can't be changed concurrently"
+                )
+
+            return [
+                self._drop_index_statement(),
+                self._build_index_statement(False, m, ef_construction),
+            ], True
+
+        alter_index = sql.SQL(
+            "ALTER INDEX {embedding_idx_name} SET ({options})"
+        ).format(
+            embedding_idx_name=sql.Identifier(self.embedding_idx_name),
+            options=sql.SQL(", ").join(
+                sql.SQL("{} = {}").format(sql.SQL(name), sql.Literal(value))
+                for name, value in options.items()
+            ),
+        )
+        return [alter_index, reindex], False
+
+    def _vacuum_statement(self, analyze=True, full=False):
+        options = [
+            name for name, value in (("FULL", full), ("ANALYZE", analyze)) if value
+        ]
+
+        return sql.SQL("VACUUM {options} {table_name}").format(
+            options=sql.SQL("(%s)" % ", ".join(options) if options else ""),
+            table_name=sql.Identifier(self.table_name),
+        )
+
+    def _analyze_statement(self):
+        return sql.SQL("ANALYZE {table_name}").format(
+            table_name=sql.Identifier(self.table_name)
+        )
+
+    def _maintenance_settings(
+        self, maintenance_work_mem=None, max_parallel_maintenance_workers=None
     ):
-        with self.vector_db.conn.cursor() as cur:
-            batch_size = min(len(content_list), len(embedding_list), len(metadata_list))
-            metadata_list = [
-                Json(metadata) if metadata is not None else None
-                for metadata in metadata_list
+        """Settings of the index builds, the defaults of the store being
+        overridden by the given ones"""
+        settings = {
+            "maintenance_work_mem": (
+                maintenance_work_mem
+                if maintenance_work_mem is not None
+                else self.maintenance_work_mem
+            ),
+            "max_parallel_maintenance_workers": (
+                max_parallel_maintenance_workers
+                if max_parallel_maintenance_workers is not None
+                else self.max_parallel_maintenance_workers
+            ),
+        }
+        return {
+            name: str(value) for name, value in settings.items() if value is not None
+        }
+
+    @staticmethod
+    def _maintenance_settings_query(settings):
+        """Query setting the maintenance settings for the session, the
+        maintenance statements running outside of a transaction"""
+        query = sql.SQL("SELECT {}").format(
+            sql.SQL(", ").join(sql.SQL("set_config(%s, %s, false)") for _ in settings)
+        )
+        params = [param for setting in settings.items() for param in setting]
+
+        return query, params
+
+    @staticmethod
+    def _reset_settings_statements(settings):
+        return [sql.SQL("RESET {}").format(sql.SQL(name)) for name in settings]
+
+    def _partition_statement(self, name, collection_uuids):
+        """Statement creating a list partition holding the collections"""
+        return sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} FOR VALUES IN ({collection_uuids})"
+        ).format(
+            partition_name=sql.Identifier("%s_%s" % (self.table_name, name)),
+            table_name=sql.Identifier(self.table_name),
+            collection_uuids=sql.SQL(", ").join(
+                sql.SQL("{}::uuid").format(sql.Literal(str(collection_uuid)))
+                for collection_uuid in collection_uuids
+            ),
+        )
+
+    def _add_partition_statement(self, name, collection_uuids):
+        if self.partitioning != "list":
+            raise ValueError("Partitions can only be added to a list partitioned table")
+
+        return self._partition_statement(name, collection_uuids)
+
+    def _create_partition_statements(self):
+        if self.partitioning == "hash":
+            return [
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})"
+                ).format(
+                    partition_name=sql.Identifier("%s_p%s" % (self.table_name, i)),
+                    table_name=sql.Identifier(self.table_name),
+                    modulus=sql.Literal(self.partitions),
+                    remainder=sql.Literal(i),
+                )
+                for i in range(self.partitions)
             ]
 
-            values_template = sql.SQL("({}, {}, {} {})").format(
-                sql.Placeholder(), sql.Placeholder(), sql.Placeholder()
+        statements = [
+            self._partition_statement(name, collection_uuids)
+            for name, collection_uuids in self.partitions.items()
+        ]
+        statements.append(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} DEFAULT"
+            ).format(
+                partition_name=sql.Identifier(self.table_name + "_default"),
+                table_name=sql.Identifier(self.table_name),
             )
+        )
+        return statements
+
+    @staticmethod
+    def _metadata_value(key):
+        """Expression of the text value of a metadata key, as indexed"""
+        return sql.SQL("(metadata ->> {})").format(sql.Literal(key))
+
+    def _filter_condition(self, metadata_filter, collection_uuid=None):
+        """Condition of the document chunks matching the metadata filter and
+        belonging to the collection, or to one of the collections when it's
+        a list, and its parameters. The condition is None without filter.
+
+        The string values of the indexed metadata keys are also compared as
+        text, for the planner to use their expression indexes, and the
+        collection condition lets it skip the partitions of the other
+        collections"""
+        filter_shape, params = self._filter_params(metadata_filter, collection_uuid)
+
+        return self._filter_shape_condition(filter_shape), params
 
-            all_values_template = sql.SQL(",").join(
-                [values_template for _ in range(batch_size)]
+    def _filter_params(self, metadata_filter, collection_uuid=None):
+        """Shape of the filter condition, a hashable tuple of its terms, and
+        its parameters"""
+        filter_shape = []
+        params = []
+
+        if collection_uuid is not None:
+            if isinstance(collection_uuid, (list, tuple, set)):
+                filter_shape.append("collection_uuids")
+                params.append(list(collection_uuid))
+            else:
+                filter_shape.append("collection_uuid")
+                params.append(collection_uuid)
+
+        if metadata_filter:
+            for key in self.indexed_metadata_keys:
+                value = metadata_filter.get(key)
+
+                # Only strings: the text of other jsonb values differs from
+                # their Python str (1.0, 1e20, true), and 1 equals 1.0 in jsonb
+                if isinstance(value, str):
+                    filter_shape.append(("metadata_value", key))
+                    params.append(value)
+
+            filter_shape.append("metadata")
+            params.append(Jsonb(metadata_filter))
+
+        return tuple(filter_shape), params
+
+    def _filter_shape_condition(self, filter_shape):
+        conditions = []
+
+        for term in filter_shape:
+            if term == "collection_uuids":
+                conditions.append(sql.SQL("collection_uuid = ANY(%s)"))
+            elif term == "collection_uuid":
+                conditions.append(sql.SQL("collection_uuid = %s"))
+            elif term == "metadata":
+                conditions.append(sql.SQL("metadata @> %s"))
+            else:
+                conditions.append(
+                    sql.SQL("{} = %s").format(self._metadata_value(term[1]))
+                )
+
+        if not conditions:
+            return None
+
+        return sql.SQL(" AND ").join(conditions)
+
+    def _text_search_config(self):
+        return sql.SQL("{}::regconfig").format(sql.Literal(self.text_search_config))
+
+    def _indexed_expression(self, embedding_vector, vector_dimension=None):
+        """Expression of the embedding vector, or of the query vector, in the
+        precision of the index"""
+        vector_dimension = sql.Literal(vector_dimension or self.vector_dimension)
+
+        if self.index_precision == "half":
+            return sql.SQL("({}::halfvec({}))").format(
+                embedding_vector, vector_dimension
+            )
+        elif self.index_precision == "binary":
+            return sql.SQL("(binary_quantize({})::bit({}))").format(
+                embedding_vector, vector_dimension
             )
+        else:
+            return embedding_vector
 
-            query = sql.SQL(
-                "INSERT INTO {table_name} (collection_uuid, content, embedding_vector, metadata) VALUES {all_values}"
+    def _oversampling(self, search_params):
+        """How many times more candidates are fetched from a quantized index,
+        None when the search uses exact distances only"""
+        search_params = {**self.search_params, **(search_params or {})}
+
+        if self.index_precision == "float" or search_params.get("exact"):
+            return None
+
+        return search_params.get("oversampling") or self.oversampling
+
+    def _nearest_query(self, query_vector, filter_condition, limit, search_params):
+        """Subquery of the limit document chunks nearest to the query vector
+        expression, with their distance. Placeholders: the ones of the filter
+        condition, then the limit. With a quantized index the candidates
+        found with it are re-ranked by exact cosine distance"""
+        where_clause = (
+            sql.SQL("WHERE {}").format(filter_condition)
+            if filter_condition is not None
+            else sql.SQL("")
+        )
+        oversampling = self._oversampling(search_params)
+
+        if oversampling is None:
+            return sql.SQL(
+                """
+                SELECT id, collection_uuid, content, metadata, created_at, embedding_vector, embedding_vector <=> {query_vector} AS distance
+                FROM {table_name}
+                {where_clause}
+                ORDER BY embedding_vector <=> {query_vector}
+                LIMIT %s
+            """
             ).format(
+                query_vector=query_vector,
                 table_name=sql.Identifier(self.table_name),
-                all_values=all_values_template,
-            )
-
-            # flatten parameters
-            sql_params = list(
-                itertools.chain(
-                    *zip(
-                        [collection_uuid] * batch_size,
-                        content_list,
-                        embedding_list,
-                        metadata_list,
-                    )
-                )
+                where_clause=where_clause,
             )
 
-            cur.execute(query, sql_params)
-            self.conn.commit()
+        return sql.SQL(
+            """
+            SELECT id, collection_uuid, content, metadata, created_at, embedding_vector, embedding_vector <=> {query_vector} AS distance
+            FROM (
+                SELECT id, collection_uuid, content, metadata, created_at, embedding_vector
+                FROM {table_name}
+                {where_clause}
+                ORDER BY {indexed_embedding_vector} {operator} {indexed_query_vector}
+                LIMIT {candidates}
+            ) candidates
+            ORDER BY distance
+            LIMIT %s
+        """
+        ).format(
+            query_vector=query_vector,
+            table_name=sql.Identifier(self.table_name),
+            where_clause=where_clause,
+            indexed_embedding_vector=self._indexed_expression(
+                sql.Identifier("embedding_vector")
+            ),
+            operator=sql.SQL("<~>" if self.index_precision == "binary" else "<=>"),
+            indexed_query_vector=self._indexed_expression(query_vector),
+            candidates=sql.Literal(limit * oversampling),
+        )
 
-    def similarity_search(self, embedding_vector, k=3, metadata_filter=None):
-        with self.conn.cursor() as cur:
-            if metadata_filter:
-                cur.execute(
-                    sql.SQL(
-                        "SELECT id, collection_uuid, content, metadata, created_at FROM {table_name} WHERE metadata @> %s ORDER BY embedding_vector <=> %s LIMIT %s"
-                    ).format(table_name=sql.Identifier(self.table_name)),
-                    (metadata_filter, np.array(embedding_vector), k),
-                )
+    def _search_settings_query(self, search_params, limit=None):
+        """Query setting the search parameters for the current transaction
+        only, or None when there are none. With exact=True the HNSW index is
+        not used and the search is an exact sequential scan. The ef_search
+        of a quantized index is raised to the number of candidates fetched
+        from it for limit results, it caps the rows an index scan returns"""
+        search_params = {**self.search_params, **(search_params or {})}
+
+        oversampling = self._oversampling(search_params)
+        if oversampling is not None and limit is not None:
+            search_params["ef_search"] = max(
+                search_params.get("ef_search") or DEFAULT_EF_SEARCH,
+                min(limit * oversampling, MAX_EF_SEARCH),
+            )
+
+        settings = []
+        for name, value in search_params.items():
+            if name == "exact":
+                if value:
+                    settings.append(("enable_indexscan", "off"))
+            elif name == "oversampling":
+                continue
+            elif name in SEARCH_PARAMS:
+                if value is not None:
+                    settings.append((SEARCH_PARAMS[name], str(value)))
             else:
-                cur.execute(
-                    sql.SQL(
-                        "SELECT id, collection_uuid, content, metadata, created_at FROM {table_name} ORDER BY embedding_vector <=> %s LIMIT %s"
-                    ).format(table_name=sql.Identifier(self.table_name)),
-                    (np.array(embedding_vector), k),
-                )
+                raise ValueError("Unknown search parameter %s" % name)
 
-            result = [
-                DocumentChunk(
-                    id=row[0],
-                    collection_uuid=row[1],
-                    content=row[2],
-                    metadata=row[3],
-                    created_at=row[4],
-                )
-                for row in cur.fetchall()
-            ]
-            return result
+        if not settings:
+            return None, None
 
-    def close(self):
-        logger.debug("Closing connection")
-        self.conn.close()
+        query = sql.SQL("SELECT {}").format(
+            sql.SQL(", ").join(sql.SQL("set_config(%s, %s, true)") for _ in settings)
+        )
+        params = [param for setting in settings for param in setting]
+
+        return query, params
+
+    def _store_document_chunk_query(
+        self, collection_uuid, content, embedding_vector, metadata
+    ):
+        query = sql.SQL(
+            "INSERT INTO {} (collection_uuid, content, metadata, embedding_vector) VALUES (%s, %s, %s, %s) RETURNING id"
+        ).format(sql.Identifier(self.table_name))
+        params = (
+            collection_uuid,
+            content,
+            Json(metadata) if metadata is not None else None,
+            np.array(embedding_vector),
+        )
+        return query, params
+
+    # Column types of the rows written by _copy_row
+    _copy_types = ["bigint", "uuid", "text", "jsonb", "vector"]
+
+    def _reserve_ids_query(self):
+        """Query taking new ids from the sequence of the id column. COPY
+        can't return the generated ids, so they are reserved beforehand"""
+        quoted_table_name = '"%s"' % self.table_name.replace('"', '""')
+
+        return sql.SQL(
+            "SELECT nextval(pg_get_serial_sequence({table_name}, 'id')) FROM generate_series(1, %s)"
+        ).format(table_name=sql.Literal(quoted_table_name))
+
+    def _copy_document_chunks_query(self):
+        return sql.SQL(
+            "COPY {table_name} (id, collection_uuid, content, metadata, embedding_vector) FROM STDIN WITH (FORMAT BINARY)"
+        ).format(table_name=sql.Identifier(self.table_name))
+
+    @staticmethod
+    def _copy_row(
+        document_chunk_id, collection_uuid, content, embedding_vector, metadata
+    ):
+        return (
+            document_chunk_id,
+            collection_uuid,
+            content,
+            Jsonb(metadata) if metadata is not None else None,
+            np.asarray(embedding_vector, dtype=np.float32),
+        )
+
+    @staticmethod
+    def _search_columns(include_embeddings=False, columns=None):
+        """Names of the columns returned by a search: the given ones, or the
+        ones read by _row_to_document_chunk"""
+        if columns is None:
+            return SEARCH_COLUMNS if include_embeddings else SEARCH_COLUMNS[:-1]
+
+        for column in columns:
+            if column not in SEARCH_COLUMNS:
+                raise ValueError("Unknown search column %s" % column)
+
+        return tuple(columns)
+
+    @staticmethod
+    def _document_chunk_columns(columns, table_alias, distance):
+        """Select list of the named columns, distance being the expression of
+        the distance to the query vector"""
+        return sql.SQL(", ").join(
+            distance if column == "distance" else sql.Identifier(table_alias, column)
+            for column in columns
+        )
+
+    @staticmethod
+    def _vector_param(embedding_vector):
+        # float32 arrays are passed as is, the vector dumper writes them in
+        # the binary format
+        return np.asarray(embedding_vector, dtype=np.float32)
+
+    def _search_query(self, search_shape, compose):
+        """Statement of the search shape, composed on first use. The same
+        statement text lets psycopg prepare it once per connection"""
+        query = self._search_queries.get(search_shape)
+
+        if query is None:
+            query = self._search_queries[search_shape] = compose().as_string(None)
+
+        return query
+
+    def _similarity_search_query(
+        self,
+        embedding_vector,
+        k,
+        metadata_filter,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+        columns=None,
+    ):
+        filter_shape, filter_params = self._filter_params(
+            metadata_filter, collection_uuid
+        )
+        columns = self._search_columns(include_embeddings, columns)
+        # The number of candidates of a quantized index is in the statement
+        oversampling = self._oversampling(search_params)
+
+        def compose():
+            return sql.SQL(
+                """
+                SELECT {columns}
+                FROM (SELECT %b::vector AS query_vector) q
+                CROSS JOIN LATERAL ({nearest}) d
+                ORDER BY d.distance
+            """
+            ).format(
+                columns=self._document_chunk_columns(
+                    columns, "d", sql.SQL("d.distance")
+                ),
+                nearest=self._nearest_query(
+                    sql.SQL("q.query_vector"),
+                    self._filter_shape_condition(filter_shape),
+                    k,
+                    search_params,
+                ),
+            )
+
+        query = self._search_query(
+            (
+                "similarity_search",
+                filter_shape,
+                columns,
+                oversampling and k * oversampling,
+            ),
+            compose,
+        )
+        params = [self._vector_param(embedding_vector), *filter_params, k]
+
+        return query, params
+
+    def _similarity_search_many_query(
+        self,
+        embedding_vectors,
+        k,
+        metadata_filter,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+        columns=None,
+    ):
+        """Query running the similarity searches of all the embedding vectors
+        in one statement, with a lateral join over the unnested array of
+        query vectors. Rows start with the 1-based index of their query"""
+        filter_shape, filter_params = self._filter_params(
+            metadata_filter, collection_uuid
+        )
+        columns = self._search_columns(include_embeddings, columns)
+        # The number of candidates of a quantized index is in the statement
+        oversampling = self._oversampling(search_params)
+
+        def compose():
+            return sql.SQL(
+                """
+                SELECT q.query_index, {columns}
+                FROM unnest(%b::vector[]) WITH ORDINALITY AS q(query_vector, query_index)
+                CROSS JOIN LATERAL ({nearest}) d
+                ORDER BY q.query_index, d.distance
+            """
+            ).format(
+                columns=self._document_chunk_columns(
+                    columns, "d", sql.SQL("d.distance")
+                ),
+                nearest=self._nearest_query(
+                    sql.SQL("q.query_vector"),
+                    self._filter_shape_condition(filter_shape),
+                    k,
+                    search_params,
+                ),
+            )
+
+        query = self._search_query(
+            (
+                "similarity_search_many",
+                filter_shape,
+                columns,
+                oversampling and k * oversampling,
+            ),
+            compose,
+        )
+        params = [
+            [
+                self._vector_param(embedding_vector)
+                for embedding_vector in embedding_vectors
+            ],
+            *filter_params,
+            k,
+        ]
+
+        return query, params
+
+    def _hybrid_search_query(
+        self,
+        embedding_vectors,
+        query_texts,
+        k,
+        metadata_filter,
+        candidates,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+    ):
+        """Query fusing, for each query, the candidates of a HNSW search and
+        of a full text search with reciprocal rank fusion: a document chunk
+        scores the sum of 1 / (rrf_k + rank) over the candidate lists where
+        it's found. Rows start with the 1-based index of their query"""
+        if not self.full_text_search:
+            raise ValueError(
+                "Hybrid search needs the vector store built with full_text_search=True"
+            )
+
+        filter_condition, filter_params = self._filter_condition(
+            metadata_filter, collection_uuid
+        )
+        where_clause = (
+            sql.SQL("AND {}").format(filter_condition)
+            if filter_condition is not None
+            else sql.SQL("")
+        )
+
+        query = sql.SQL(
+            """
+            SELECT q.query_index, {columns}
+            FROM unnest(%s::vector[], %s::text[]) WITH ORDINALITY AS q(query_vector, query_text, query_index)
+            CROSS JOIN LATERAL (
+                SELECT id, sum(1.0 / ({rrf_k} + rank)) AS score
+                FROM (
+                    SELECT id, row_number() OVER (ORDER BY distance) AS rank
+                    FROM ({nearest}) semantic
+                    UNION ALL
+                    SELECT id, row_number() OVER (ORDER BY text_rank DESC) AS rank
+                    FROM (
+                        SELECT id, ts_rank_cd(content_tsv, text_query) AS text_rank
+                        FROM {table_name}, websearch_to_tsquery({text_search_config}, q.query_text) AS text_query
+                        WHERE content_tsv @@ text_query {where_clause}
+                        ORDER BY text_rank DESC
+                        LIMIT %s
+                    ) lexical
+                ) ranked
+                GROUP BY id
+                ORDER BY score DESC, id
+                LIMIT %s
+            ) fused
+            JOIN {table_name} d ON d.id = fused.id
+            ORDER BY q.query_index, fused.score DESC, fused.id
+        """
+        ).format(
+            columns=self._document_chunk_columns(
+                self._search_columns(include_embeddings),
+                "d",
+                sql.SQL("d.embedding_vector <=> q.query_vector"),
+            ),
+            table_name=sql.Identifier(self.table_name),
+            where_clause=where_clause,
+            rrf_k=sql.Literal(self.rrf_k),
+            text_search_config=self._text_search_config(),
+            nearest=self._nearest_query(
+                sql.SQL("q.query_vector"),
+                filter_condition,
+                self._hybrid_candidates(k, candidates),
+                search_params,
+            ),
+        )
+
+        params = [
+            [np.array(embedding_vector) for embedding_vector in embedding_vectors],
+            list(query_texts),
+        ]
+        for _ in range(2):
+            params.extend(filter_params)
+            params.append(self._hybrid_candidates(k, candidates))
+        params.append(k)
+
+        return query, params
+
+    @staticmethod
+    def _hybrid_candidates(k, candidates):
+        """Number of candidates of each search fused by the hybrid search"""
+        return candidates or max(20, 4 * k)
+
+    def _document_chunk_hashes_query(self):
+        return sql.SQL(
+            "SELECT chunk_index, content_hash FROM {table_name} WHERE collection_uuid = %s AND chunk_index IS NOT NULL"
+        ).format(table_name=sql.Identifier(self.table_name))
+
+    def _embeddings_by_hash_query(self):
+        """Query of the embeddings of the stored chunks with the given
+        hashes, locked until the end of the upsert transaction so a
+        concurrent writer can't delete them in between"""
+        return sql.SQL(
+            "SELECT content_hash, embedding_vector FROM {table_name} WHERE collection_uuid = %s AND content_hash = ANY(%s) FOR UPDATE"
+        ).format(table_name=sql.Identifier(self.table_name))
+
+    @staticmethod
+    def _check_reused_embeddings(reused_hashes, embeddings_by_hash):
+        missing_hashes = set(reused_hashes) - embeddings_by_hash.keys()
+
+        if missing_hashes:
+            raise MissingEmbeddingsError(missing_hashes)
+
+    def _upsert_document_chunk_query(self):
+        return sql.SQL(
+            """
+            INSERT INTO {table_name} (collection_uuid, chunk_index, content, content_hash, metadata, embedding_vector)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (collection_uuid, chunk_index) DO UPDATE SET
+                content = EXCLUDED.content,
+                content_hash = EXCLUDED.content_hash,
+                metadata = EXCLUDED.metadata,
+                embedding_vector = EXCLUDED.embedding_vector,
+                created_at = NOW()
+        """
+        ).format(table_name=sql.Identifier(self.table_name))
+
+    def _delete_stale_document_chunks_query(self):
+        """Query deleting the chunks of a collection beyond its number of
+        chunks. The chunks not stored by upsert_document_chunks have no
+        chunk index and are left alone"""
+        return sql.SQL(
+            "DELETE FROM {table_name} WHERE collection_uuid = %s AND chunk_index >= %s"
+        ).format(table_name=sql.Identifier(self.table_name))
+
+    def _update_collection_metadata_query(self):
+        return sql.SQL(
+            "UPDATE {table_name} SET metadata = %s WHERE collection_uuid = %s AND metadata IS DISTINCT FROM %s"
+        ).format(table_name=sql.Identifier(self.table_name))
+
+    @staticmethod
+    def _upsert_rows(collection_uuid, document_chunks, embeddings_by_hash, metadata):
+        """Rows of _upsert_document_chunk_query. The chunks without embedding
+        vector take the one of the stored chunk with the same hash"""
+        metadata = Jsonb(metadata) if metadata is not None else None
+
+        return [
+            (
+                collection_uuid,
+                chunk_index,
+                content,
+                content_hash,
+                metadata,
+                np.asarray(
+                    (
+                        embedding_vector
+                        if embedding_vector is not None
+                        else embeddings_by_hash[content_hash]
+                    ),
+                    dtype=np.float32,
+                ),
+            )
+            for chunk_index, content, content_hash, embedding_vector in document_chunks
+        ]
+
+    def _delete_document_chunk_by_id_query(self):
+        return sql.SQL("DELETE FROM {table_name} WHERE id = %s").format(
+            table_name=sql.Identifier(self.table_name)
+        )
+
+    def _delete_all_chunks_in_collection_query(self):
+        return sql.SQL("DELETE FROM {table_name} WHERE collection_uuid = %s").format(
+            table_name=sql.Identifier(self.table_name)
+        )
+
+    def _delete_document_chunks_query(self, metadata_filter):
+        filter_condition, params = self._filter_condition(metadata_filter)
+
+        if filter_condition is not None:
+            query = sql.SQL("DELETE FROM {table_name} WHERE {condition}").format(
+                table_name=sql.Identifier(self.table_name),
+                condition=filter_condition,
+            )
+        else:
+            query = sql.SQL("DELETE FROM {table_name}").format(
+                table_name=sql.Identifier(self.table_name)
+            )
+            params = ()
+
+        return query, params
+
+    @staticmethod
+    def _group_similarity_search_many_rows(rows, num_queries, projected=False):
+        """Group the rows by query, as document chunks or, for the searches
+        projecting columns, as tuples of these columns"""
+        results = [[] for _ in range(num_queries)]
+
+        for row in rows:
+            results[row[0] - 1].append(
+                row[1:]
+                if projected
+                else BasePgVectorVectorDB._row_to_document_chunk(row[1:])
+            )
+
+        return results
+
+    @staticmethod
+    def _row_to_document_chunk(row):
+        return DocumentChunk(
+            id=row[0],
+            collection_uuid=row[1],
+            content=row[2],
+            metadata=row[3],
+            created_at=row[4],
+            distance=row[5],
+            embedding_vector=row[6] if len(row) > 6 else None,
+        )
+
+
+class PgVectorVectorDB(BasePgVectorVectorDB):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        init_db_kwargs = self._init_db_kwargs()
+
+        if self.pool_size:
+            # The vector type must exist before the pool registers it on
+            # every new connection, so the schema is initialized first with
+            # a short-lived connection
+            self.conn = None
+
+            if not self._is_db_initialized():
+                with psycopg.connect(**self.conninfo) as conn:
+                    self._init_db_once(conn, **init_db_kwargs)
+
+            logger.info(
+                "Opening connection pool (min_size=%s, max_size=%s)",
+                self.pool_min_size,
+                self.pool_size,
+            )
+            self.pool = ConnectionPool(
+                kwargs=self.conninfo,
+                min_size=min(self.pool_min_size, self.pool_size),
+                max_size=self.pool_size,
+                timeout=self.pool_timeout,
+                configure=register_vector,
+                check=self._check_pool_connection,
+                open=True,
+            )
+        else:
+            self.pool = None
+            self.conn = psycopg.connect(**self.conninfo)
+
+            self._init_db_once(self.conn, **init_db_kwargs)
+
+            register_vector(self.conn)
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Yield a connection from the pool, or the single connection when
+        the instance is not pooled. Like the pooled connections, the single
+        one commits its pending transaction at the end of the block and rolls
+        it back on errors, so a failed statement doesn't leave it aborted"""
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+
+    @contextlib.contextmanager
+    def _search_cursor(self, search_params, limit=None):
+        """Yield a cursor in a transaction with the search parameters set.
+        The transaction is ended afterwards so the settings don't leak to
+        the next statements of the connection"""
+        settings_query, settings_params = self._search_settings_query(
+            search_params, limit
+        )
+
+        with self._connection() as conn, conn.cursor() as cur:
+            if settings_query is None:
+                yield cur
+                return
+
+            try:
+                cur.execute(settings_query, settings_params)
+                yield cur
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def _init_db_once(self, conn, **kwargs):
+        """Run _init_db only once per process for each database table"""
+        with _initialized_tables_lock:
+            if self._db_key() in _initialized_tables:
+                return
+
+            self._init_db(conn, **kwargs)
+            _initialized_tables.add(self._db_key())
+
+    def _init_db(self, conn, **kwargs):
+        with conn.cursor() as cur:
+            for statement in self._init_db_statements(**kwargs):
+                cur.execute(statement)
+
+            # The GIN index is created along with a new table's tsvector
+            # column. Existing tables without it are left to
+            # add_full_text_search
+            if kwargs.get("full_text_search"):
+                cur.execute(self._text_search_column_query())
+
+                if cur.fetchone() is not None:
+                    cur.execute(self._text_search_index_statement())
+                else:
+                    self._warn_missing_text_search_column()
+
+            conn.commit()
+
+    def _verify_index(self):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(*)
+                FROM pg_indexes
+                WHERE tablename = %s AND indexdef LIKE '%% USING hnsw %%' AND indexname = %s AND schemaname = 'public'
+            """,
+                (self.table_name, self.embedding_idx_name),
+            )
+            exists = cur.fetchone()[0] == 1
+
+            conn.commit()
+
+            return exists
+
+    @contextlib.contextmanager
+    def _maintenance_cursor(self, **settings):
+        """Yield a cursor of a connection in autocommit mode, VACUUM and the
+        concurrent index builds can't run in a transaction, with the
+        maintenance settings set for the session and reset afterwards"""
+        settings = self._maintenance_settings(**settings)
+
+        with self._connection() as conn:
+            conn.commit()
+            conn.autocommit = True
+
+            try:
+                with conn.cursor() as cur:
+                    if settings:
+                        cur.execute(*self._maintenance_settings_query(settings))
+
+                    try:
+                        yield cur
+                    finally:
+                        for statement in self._reset_settings_statements(settings):
+                            cur.execute(statement)
+            finally:
+                conn.autocommit = False
+
+    def drop_index(self):
+        """Drop the HNSW index, the searches become sequential scans until
+        build_index"""
+        logger.info("Dropping index %s", self.embedding_idx_name)
+
+        with self._maintenance_cursor() as cur:
+            cur.execute(self._drop_index_statement())
+
+    def build_index(
+        self,
+        concurrently=False,
+        maintenance_work_mem=None,
+        max_parallel_maintenance_workers=None,
+    ):
+        """Build the HNSW index on the stored embeddings, when it doesn't
+        exist. Building it once after loading the data is much faster than
+        inserting into it. Without concurrently the build blocks the writes
+        to the table, but not the reads"""
+        logger.info("Building index %s", self.embedding_idx_name)
+        started_at = time.perf_counter()
+
+        with self._maintenance_cursor(
+            maintenance_work_mem=maintenance_work_mem,
+            max_parallel_maintenance_workers=max_parallel_maintenance_workers,
+        ) as cur:
+            cur.execute(self._build_index_statement(concurrently))
+
+        logger.info(
+            "Built index %s in %.1fs",
+            self.embedding_idx_name,
+            time.perf_counter() - started_at,
+        )
+
+    @contextlib.contextmanager
+    def bulk_load(
+        self, maintenance_work_mem=None, max_parallel_maintenance_workers=None
+    ):
+        """Drop the HNSW index for the stores of the block, and build it
+        afterwards, even when the block fails so the table isn't left
+        without it:
+
+            with vector_store.bulk_load(maintenance_work_mem="8GB"):
+                rag.add_documents(documents)
+        """
+        self.drop_index()
+
+        try:
+            yield self
+        finally:
+            self.build_index(
+                maintenance_work_mem=maintenance_work_mem,
+                max_parallel_maintenance_workers=max_parallel_maintenance_workers,
+            )
+            self.analyze()
+
+    def reindex(
+        self,
+        m=None,
+        ef_construction=None,
+        concurrently=True,
+        maintenance_work_mem=None,
+        max_parallel_maintenance_workers=None,
+    ):
+        """Rebuild the HNSW index, with new m or ef_construction when given.
+        By default the index is rebuilt concurrently, without blocking the
+        reads and writes, which needs space for both indexes"""
+        statements, in_transaction = self._reindex_statements(
+            m, ef_construction, concurrently
+        )
+        logger.info("Rebuilding index %s", self.embedding_idx_name)
+
+        with self._maintenance_cursor(
+            maintenance_work_mem=maintenance_work_mem,
+            max_parallel_maintenance_workers=max_parallel_maintenance_workers,
+        ) as cur:
+            with (
+                cur.connection.transaction()
+                if in_transaction
+                else contextlib.nullcontext()
+            ):
+                for statement in statements:
+                    cur.execute(statement)
+
+        self.m = m or self.m
+        self.ef_construction = ef_construction or self.ef_construction
+
+    def add_full_text_search(self, concurrently=False):
+        """Add the tsvector column of the full text search and its GIN index
+        to a table created without them. Adding the column rewrites the
+        table under an ACCESS EXCLUSIVE lock, to be run in a maintenance
+        window. With concurrently the index build doesn't block the writes"""
+        logger.info("Adding the full text search column to %s", self.table_name)
+
+        with self._maintenance_cursor() as cur:
+            cur.execute(self._add_text_search_column_statement())
+            cur.execute(self._text_search_index_statement(concurrently))
+
+    def vacuum(self, analyze=True, full=False):
+        """Vacuum the table, after mass deletes: it reclaims the space of the
+        deleted chunks and repairs the HNSW graph. VACUUM FULL rewrites the
+        table and locks it"""
+        logger.info("Vacuuming %s", self.table_name)
+
+        with self._maintenance_cursor() as cur:
+            cur.execute(self._vacuum_statement(analyze, full))
+
+    def analyze(self):
+        """Update the planner statistics of the table"""
+        with self._maintenance_cursor() as cur:
+            cur.execute(self._analyze_statement())
+
+    def _check_health(self, conn=None) -> bool:
+        """Check database connectivity."""
+        if conn is None:
+            with self._connection() as conn:
+                return self._check_health(conn)
+
+        with conn.cursor() as cur:
+            try:
+                cur.execute("SELECT 1")
+            except Exception as e:
+                return False
+            else:
+                return True
+
+    def _check_pool_connection(self, conn):
+        """Health check run by the pool before handing out a connection"""
+        if not self._check_health(conn):
+            raise psycopg.OperationalError("Pooled connection is not healthy")
+
+        # Hand out the connection idle, not inside the health check transaction
+        conn.rollback()
+
+    def delete_document_chunk_by_id(self, document_chunk_id: int):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(self._delete_document_chunk_by_id_query(), (document_chunk_id,))
+            conn.commit()
+
+            return cur.rowcount == 1
+
+    def delete_all_chunks_in_collection(self, collection_uuid: uuid.UUID):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                self._delete_all_chunks_in_collection_query(), (collection_uuid,)
+            )
+            conn.commit()
+
+            return cur.rowcount
+
+    def delete_document_chunks(self, **metadata_filter):
+        query, params = self._delete_document_chunks_query(metadata_filter)
+
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            conn.commit()
+
+            return cur.rowcount
+
+    def get_document_chunk_hashes(self, collection_uuid):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(self._document_chunk_hashes_query(), (collection_uuid,))
+
+            return dict(cur.fetchall())
+
+    def upsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        """Write the new or changed chunks of a collection, given as
+        (chunk_index, content, content_hash, embedding_vector) tuples, and
+        delete the stale ones in one transaction. A chunk with embedding
+        vector None reuses the one of the stored chunk with the same hash,
+        read and locked in the transaction. When it's gone the transaction is
+        rolled back and MissingEmbeddingsError raised"""
+        document_chunks = list(document_chunks)
+
+        reused_hashes = [
+            content_hash
+            for _, _, content_hash, embedding_vector in document_chunks
+            if embedding_vector is None
+        ]
+
+        # The statements run in the transaction of the connection, committed
+        # at the end
+        with self._connection() as conn, conn.cursor() as cur:
+            embeddings_by_hash = {}
+            if reused_hashes:
+                cur.execute(
+                    self._embeddings_by_hash_query(), (collection_uuid, reused_hashes)
+                )
+                embeddings_by_hash = dict(cur.fetchall())
+                self._check_reused_embeddings(reused_hashes, embeddings_by_hash)
+
+            if document_chunks:
+                cur.executemany(
+                    self._upsert_document_chunk_query(),
+                    self._upsert_rows(
+                        collection_uuid, document_chunks, embeddings_by_hash, metadata
+                    ),
+                )
+
+            cur.execute(
+                self._delete_stale_document_chunks_query(),
+                (collection_uuid, num_chunks),
+            )
+            deleted = cur.rowcount
+
+            metadata = Jsonb(metadata) if metadata is not None else None
+            cur.execute(
+                self._update_collection_metadata_query(),
+                (metadata, collection_uuid, metadata),
+            )
+
+            conn.commit()
+
+        return deleted
+
+    def store_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
+        logger.debug("Storing document chunk: [%s] %s", collection_uuid, content)
+
+        query, params = self._store_document_chunk_query(
+            collection_uuid, content, embedding_vector, metadata
+        )
+
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+
+            conn.commit()
+
+            document_chunk_id = cur.fetchone()[0]
+
+            return DocumentChunk(
+                id=document_chunk_id,
+                collection_uuid=collection_uuid,
+                content=content,
+                metadata=metadata,
+                created_at=datetime.datetime.now(),
+            )
+
+    def store_document_chunks_in_batch(
+        self, collection_uuid, content_list, embedding_list, metadata_list
+    ):
+        return self.bulk_store_document_chunks(
+            zip(
+                itertools.repeat(collection_uuid),
+                content_list,
+                embedding_list,
+                metadata_list,
+            )
+        )
+
+    def bulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        """Store an iterable of (collection_uuid, content, embedding_vector,
+        metadata) tuples with the binary COPY protocol, committing once per
+        batch. Returns the ids of the stored document chunks"""
+        document_chunk_ids = []
+
+        for batch in batched(document_chunks, batch_size):
+            logger.debug("Copying batch of %s document chunks", len(batch))
+
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(self._reserve_ids_query(), (len(batch),))
+                batch_ids = [row[0] for row in cur.fetchall()]
+
+                with cur.copy(self._copy_document_chunks_query()) as copy:
+                    copy.set_types(self._copy_types)
+
+                    for document_chunk_id, document_chunk in zip(batch_ids, batch):
+                        copy.write_row(
+                            self._copy_row(document_chunk_id, *document_chunk)
+                        )
+
+                conn.commit()
+
+            document_chunk_ids.extend(batch_ids)
+
+        return document_chunk_ids
+
+    def similarity_search(
+        self,
+        embedding_vector,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+        columns=None,
+    ):
+        """Document chunks nearest to the embedding vector. With columns,
+        a subset of SEARCH_COLUMNS, the results are tuples of these columns
+        instead of document chunks"""
+        query, params = self._similarity_search_query(
+            embedding_vector,
+            k,
+            metadata_filter,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+            columns,
+        )
+
+        with self._search_cursor(search_params, k) as cur:
+            cur.execute(query, params, prepare=True, binary=True)
+            rows = cur.fetchall()
+
+        if columns is not None:
+            return rows
+
+        return [self._row_to_document_chunk(row) for row in rows]
+
+    def similarity_search_many(
+        self,
+        embedding_vectors,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+        columns=None,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        query, params = self._similarity_search_many_query(
+            embedding_vectors,
+            k,
+            metadata_filter,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+            columns,
+        )
+
+        with self._search_cursor(search_params, k) as cur:
+            cur.execute(query, params, prepare=True, binary=True)
+            rows = cur.fetchall()
+
+        return self._group_similarity_search_many_rows(
+            rows, len(embedding_vectors), columns is not None
+        )
+
+    def hybrid_search(
+        self,
+        embedding_vector,
+        query_text,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+    ):
+        return self.hybrid_search_many(
+            [embedding_vector],
+            [query_text],
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+        )[0]
+
+    def hybrid_search_many(
+        self,
+        embedding_vectors,
+        query_texts,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        query, params = self._hybrid_search_query(
+            embedding_vectors,
+            query_texts,
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+        )
+
+        with self._search_cursor(
+            search_params, self._hybrid_candidates(k, candidates)
+        ) as cur:
+            cur.execute(query, params)
+
+            return self._group_similarity_search_many_rows(
+                cur.fetchall(), len(embedding_vectors)
+            )
+
+    def add_partition(self, name, collection_uuids):
+        """Create a list partition, with its HNSW index, holding the document
+        chunks of the collections. It must be created before chunks of these
+        collections are stored in the default partition"""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(self._add_partition_statement(name, collection_uuids))
+            conn.commit()
+
+    def close(self):
+        if self.pool is not None:
+            logger.debug("Closing connection pool")
+            self.pool.close()
+        else:
+            logger.debug("Closing connection")
+            self.conn.close()
+
+
+def _async_only(method_name):
+    """Blocking method of an asyncio-only vector store, raising an error
+    naming the asyncio method to await instead"""
+
+    def method(self, *args, **kwargs):
+        raise RuntimeError(
+            "%s only implements the asyncio API, use await %s.a%s() instead"
+            % (type(self).__name__, type(self).__name__, method_name)
+        )
+
+    method.__name__ = method_name
+    return method
+
+
+class AsyncPgVectorVectorDB(BasePgVectorVectorDB):
+    """pgvector store built on psycopg's AsyncConnection.
+
+    Only the asyncio methods of VectorDB are implemented, the blocking ones
+    raise a RuntimeError naming their asyncio counterpart. The instance must
+    be opened before use:
+
+        vector_store = await AsyncPgVectorVectorDB(...).open()
+    """
+
+    # Rather than the bare NotImplementedError of VectorDB, and a close()
+    # leaving the connections open
+    store_document_chunk = _async_only("store_document_chunk")
+    store_document_chunks_in_batch = _async_only("store_document_chunks_in_batch")
+    bulk_store_document_chunks = _async_only("bulk_store_document_chunks")
+    similarity_search = _async_only("similarity_search")
+    similarity_search_many = _async_only("similarity_search_many")
+    hybrid_search = _async_only("hybrid_search")
+    hybrid_search_many = _async_only("hybrid_search_many")
+    delete_document_chunk_by_id = _async_only("delete_document_chunk_by_id")
+    delete_all_chunks_in_collection = _async_only("delete_all_chunks_in_collection")
+    delete_document_chunks = _async_only("delete_document_chunks")
+    get_document_chunk_hashes = _async_only("get_document_chunk_hashes")
+    upsert_document_chunks = _async_only("upsert_document_chunks")
+    close = _async_only("close")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.conn = None
+        self.pool = None
+
+    async def open(self):
+        if not self._is_db_initialized():
+            async with await psycopg.AsyncConnection.connect(**self.conninfo) as conn:
+                await self._init_db(conn, **self._init_db_kwargs())
+
+            self._mark_db_initialized()
+
+        if self.pool_size:
+            logger.info(
+                "Opening async connection pool (min_size=%s, max_size=%s)",
+                self.pool_min_size,
+                self.pool_size,
+            )
+            self.pool = AsyncConnectionPool(
+                kwargs=self.conninfo,
+                min_size=min(self.pool_min_size, self.pool_size),
+                max_size=self.pool_size,
+                timeout=self.pool_timeout,
+                configure=register_vector_async,
+                check=self._check_pool_connection,
+                open=False,
+            )
+            await self.pool.open()
+        else:
+            self.conn = await psycopg.AsyncConnection.connect(**self.conninfo)
+
+            await register_vector_async(self.conn)
+
+        return self
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        if self.pool is not None:
+            async with self.pool.connection() as conn:
+                yield conn
+        else:
+            try:
+                yield self.conn
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            else:
+                await self.conn.commit()
+
+    @contextlib.asynccontextmanager
+    async def _search_cursor(self, search_params, limit=None):
+        settings_query, settings_params = self._search_settings_query(
+            search_params, limit
+        )
+
+        async with self._connection() as conn, conn.cursor() as cur:
+            if settings_query is None:
+                yield cur
+                return
+
+            try:
+                await cur.execute(settings_query, settings_params)
+                yield cur
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+    @contextlib.asynccontextmanager
+    async def _maintenance_cursor(self, **settings):
+        settings = self._maintenance_settings(**settings)
+
+        async with self._connection() as conn:
+            await conn.commit()
+            await conn.set_autocommit(True)
+
+            try:
+                async with conn.cursor() as cur:
+                    if settings:
+                        await cur.execute(*self._maintenance_settings_query(settings))
+
+                    try:
+                        yield cur
+                    finally:
+                        for statement in self._reset_settings_statements(settings):
+                            await cur.execute(statement)
+            finally:
+                await conn.set_autocommit(False)
+
+    async def _init_db(self, conn, **kwargs):
+        async with conn.cursor() as cur:
+            for statement in self._init_db_statements(**kwargs):
+                await cur.execute(statement)
+
+            if kwargs.get("full_text_search"):
+                await cur.execute(self._text_search_column_query())
+
+                if await cur.fetchone() is not None:
+                    await cur.execute(self._text_search_index_statement())
+                else:
+                    self._warn_missing_text_search_column()
+
+            await conn.commit()
+
+    async def _check_health(self, conn=None) -> bool:
+        """Check database connectivity."""
+        if conn is None:
+            async with self._connection() as conn:
+                return await self._check_health(conn)
+
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute("SELECT 1")
+            except Exception as e:
+                return False
+            else:
+                return True
+
+    async def _check_pool_connection(self, conn):
+        if not await self._check_health(conn):
+            raise psycopg.OperationalError("Pooled connection is not healthy")
+
+        await conn.rollback()
+
+    async def astore_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
+        logger.debug("Storing document chunk: [%s] %s", collection_uuid, content)
+
+        query, params = self._store_document_chunk_query(
+            collection_uuid, content, embedding_vector, metadata
+        )
+
+        async with self._connection() as conn, conn.cursor() as cur:
+            await cur.execute(query, params)
+
+            await conn.commit()
+
+            document_chunk_id = (await cur.fetchone())[0]
+
+            return DocumentChunk(
+                id=document_chunk_id,
+                collection_uuid=collection_uuid,
+                content=content,
+                metadata=metadata,
+                created_at=datetime.datetime.now(),
+            )
+
+    async def astore_document_chunks_in_batch(
+        self, collection_uuid, content_list, embedding_list, metadata_list
+    ):
+        return await self.abulk_store_document_chunks(
+            zip(
+                itertools.repeat(collection_uuid),
+                content_list,
+                embedding_list,
+                metadata_list,
+            )
+        )
+
+    async def abulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        document_chunk_ids = []
+
+        for batch in batched(document_chunks, batch_size):
+            logger.debug("Copying batch of %s document chunks", len(batch))
+
+            async with self._connection() as conn, conn.cursor() as cur:
+                await cur.execute(self._reserve_ids_query(), (len(batch),))
+                batch_ids = [row[0] for row in await cur.fetchall()]
+
+                async with cur.copy(self._copy_document_chunks_query()) as copy:
+                    copy.set_types(self._copy_types)
+
+                    for document_chunk_id, document_chunk in zip(batch_ids, batch):
+                        await copy.write_row(
+                            self._copy_row(document_chunk_id, *document_chunk)
+                        )
+
+                await conn.commit()
+
+            document_chunk_ids.extend(batch_ids)
+
+        return document_chunk_ids
+
+    async def adelete_document_chunk_by_id(self, document_chunk_id: int):
+        async with self._connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                self._delete_document_chunk_by_id_query(), (document_chunk_id,)
+            )
+            await conn.commit()
+
+            return cur.rowcount == 1
+
+    async def adelete_all_chunks_in_collection(self, collection_uuid: uuid.UUID):
+        async with self._connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                self._delete_all_chunks_in_collection_query(), (collection_uuid,)
+            )
+            await conn.commit()
+
+            return cur.rowcount
+
+    async def adelete_document_chunks(self, **metadata_filter):
+        query, params = self._delete_document_chunks_query(metadata_filter)
+
+        async with self._connection() as conn, conn.cursor() as cur:
+            await cur.execute(query, params)
+            await conn.commit()
+
+            return cur.rowcount
+
+    async def aget_document_chunk_hashes(self, collection_uuid):
+        async with self._connection() as conn, conn.cursor() as cur:
+            await cur.execute(self._document_chunk_hashes_query(), (collection_uuid,))
+
+            return dict(await cur.fetchall())
+
+    async def aupsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        document_chunks = list(document_chunks)
+
+        reused_hashes = [
+            content_hash
+            for _, _, content_hash, embedding_vector in document_chunks
+            if embedding_vector is None
+        ]
+
+        async with self._connection() as conn, conn.cursor() as cur:
+            embeddings_by_hash = {}
+            if reused_hashes:
+                await cur.execute(
+                    self._embeddings_by_hash_query(), (collection_uuid, reused_hashes)
+                )
+                embeddings_by_hash = dict(await cur.fetchall())
+                self._check_reused_embeddings(reused_hashes, embeddings_by_hash)
+
+            if document_chunks:
+                await cur.executemany(
+                    self._upsert_document_chunk_query(),
+                    self._upsert_rows(
+                        collection_uuid, document_chunks, embeddings_by_hash, metadata
+                    ),
+                )
+
+            await cur.execute(
+                self._delete_stale_document_chunks_query(),
+                (collection_uuid, num_chunks),
+            )
+            deleted = cur.rowcount
+
+            metadata = Jsonb(metadata) if metadata is not None else None
+            await cur.execute(
+                self._update_collection_metadata_query(),
+                (metadata, collection_uuid, metadata),
+            )
+
+            await conn.commit()
+
+        return deleted
+
+    async def asimilarity_search(
+        self,
+        embedding_vector,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+        columns=None,
+    ):
+        query, params = self._similarity_search_query(
+            embedding_vector,
+            k,
+            metadata_filter,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+            columns,
+        )
+
+        async with self._search_cursor(search_params, k) as cur:
+            await cur.execute(query, params, prepare=True, binary=True)
+            rows = await cur.fetchall()
+
+        if columns is not None:
+            return rows
+
+        return [self._row_to_document_chunk(row) for row in rows]
+
+    async def asimilarity_search_many(
+        self,
+        embedding_vectors,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+        columns=None,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        query, params = self._similarity_search_many_query(
+            embedding_vectors,
+            k,
+            metadata_filter,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+            columns,
+        )
+
+        async with self._search_cursor(search_params, k) as cur:
+            await cur.execute(query, params, prepare=True, binary=True)
+            rows = await cur.fetchall()
+
+        return self._group_similarity_search_many_rows(
+            rows, len(embedding_vectors), columns is not None
+        )
+
+    async def ahybrid_search(
+        self,
+        embedding_vector,
+        query_text,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+    ):
+        return (
+            await self.ahybrid_search_many(
+                [embedding_vector],
+                [query_text],
+                k,
+                metadata_filter,
+                candidates,
+                include_embeddings,
+                search_params,
+                collection_uuid,
+            )
+        )[0]
+
+    async def ahybrid_search_many(
+        self,
+        embedding_vectors,
+        query_texts,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        search_params=None,
+        collection_uuid=None,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        query, params = self._hybrid_search_query(
+            embedding_vectors,
+            query_texts,
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            search_params,
+            collection_uuid,
+        )
+
+        async with self._search_cursor(
+            search_params, self._hybrid_candidates(k, candidates)
+        ) as cur:
+            await cur.execute(query, params)
+
+            return self._group_similarity_search_many_rows(
+                await cur.fetchall(), len(embedding_vectors)
+            )
+
+    async def aadd_partition(self, name, collection_uuids):
+        async with self._connection() as conn, conn.cursor() as cur:
+            await cur.execute(self._add_partition_statement(name, collection_uuids))
+            await conn.commit()
+
+    async def adrop_index(self):
+        logger.info("Dropping index %s", self.embedding_idx_name)
+
+        async with self._maintenance_cursor() as cur:
+            await cur.execute(self._drop_index_statement())
+
+    async def abuild_index(
+        self,
+        concurrently=False,
+        maintenance_work_mem=None,
+        max_parallel_maintenance_workers=None,
+    ):
+        logger.info("Building index %s", self.embedding_idx_name)
+        started_at = time.perf_counter()
+
+        async with self._maintenance_cursor(
+            maintenance_work_mem=maintenance_work_mem,
+            max_parallel_maintenance_workers=max_parallel_maintenance_workers,
+        ) as cur:
+            await cur.execute(self._build_index_statement(concurrently))
+
+        logger.info(
+            "Built index %s in %.1fs",
+            self.embedding_idx_name,
+            time.perf_counter() - started_at,
+        )
+
+    @contextlib.asynccontextmanager
+    async def abulk_load(
+        self, maintenance_work_mem=None, max_parallel_maintenance_workers=None
+    ):
+        await self.adrop_index()
+
+        try:
+            yield self
+        finally:
+            await self.abuild_index(
+                maintenance_work_mem=maintenance_work_mem,
+                max_parallel_maintenance_workers=max_parallel_maintenance_workers,
+            )
+            await self.aanalyze()
+
+    async def areindex(
+        self,
+        m=None,
+        ef_construction=None,
+        concurrently=True,
+        maintenance_work_mem=None,
+        max_parallel_maintenance_workers=None,
+    ):
+        statements, in_transaction = self._reindex_statements(
+            m, ef_construction, concurrently
+        )
+        logger.info("Rebuilding index %s", self.embedding_idx_name)
+
+        async with self._maintenance_cursor(
+            maintenance_work_mem=maintenance_work_mem,
+            max_parallel_maintenance_workers=max_parallel_maintenance_workers,
+        ) as cur:
+            async with (
+                cur.connection.transaction()
+                if in_transaction
+                else contextlib.nullcontext()
+            ):
+                for statement in statements:
+                    await cur.execute(statement)
+
+        self.m = m or self.m
+        self.ef_construction = ef_construction or self.ef_construction
+
+    async def aadd_full_text_search(self, concurrently=False):
+        logger.info("Adding the full text search column to %s", self.table_name)
+
+        async with self._maintenance_cursor() as cur:
+            await cur.execute(self._add_text_search_column_statement())
+            await cur.execute(self._text_search_index_statement(concurrently))
+
+    async def avacuum(self, analyze=True, full=False):
+        logger.info("Vacuuming %s", self.table_name)
+
+        async with self._maintenance_cursor() as cur:
+            await cur.execute(self._vacuum_statement(analyze, full))
+
+    async def aanalyze(self):
+        async with self._maintenance_cursor() as cur:
+            await cur.execute(self._analyze_statement())
+
+    async def aclose(self):
+        if self.pool is not None:
+            logger.debug("Closing async connection pool")
+            await self.pool.close()
+        elif self.conn is not None:
+            logger.debug("Closing connection")
+            await self.conn.close()
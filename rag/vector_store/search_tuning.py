@@ -0,0 +1,197 @@
+"""Measure the recall and the latency of the HNSW searches of a pgvector
+store for several search parameters, against exact sequential scans:
+
+    python -m rag.vector_store.search_tuning --vector-dimension 1536 \\
+        --queries 100 --k 10 --ef-search 40 80 160 320
+
+The queries are embedding vectors sampled from the table itself, the
+connection settings are read from the POSTGRES_* environment variables.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import time
+
+
+import numpy as np
+from psycopg import sql
+
+
+from .pgvector_vectorstore import PgVectorVectorDB
+
+
+logger = logging.getLogger(__name__)
+
+
+def sample_query_vectors(vector_store, num_queries, seed=None):
+    """Embedding vectors of num_queries random document chunks of the store"""
+    query = sql.SQL(
+        "SELECT embedding_vector FROM {table_name} ORDER BY random() LIMIT %s"
+    ).format(table_name=sql.Identifier(vector_store.table_name))
+
+    with vector_store._connection() as conn, conn.cursor() as cur:
+        if seed is not None:
+            cur.execute("SELECT setseed(%s)", (seed,))
+
+        cur.execute(query, (num_queries,))
+        query_vectors = [row[0] for row in cur.fetchall()]
+
+        conn.commit()
+
+    return query_vectors
+
+
+def _timed_searches(vector_store, query_vectors, k, metadata_filter, search_params):
+    results = []
+    latencies = []
+
+    for query_vector in query_vectors:
+        started_at = time.perf_counter()
+        results.append(
+            vector_store.similarity_search(
+                query_vector, k, metadata_filter, search_params=search_params
+            )
+        )
+        latencies.append(time.perf_counter() - started_at)
+
+    return results, np.array(latencies) * 1000
+
+
+def evaluate_search_params(
+    vector_store, query_vectors, search_params_list, k=10, metadata_filter=None
+):
+    """Run the searches of the query vectors with each search parameters and
+    with an exact scan. Returns a dict per search parameters with their
+    recall@k, the mean number of results (filtered searches can return fewer
+    than k) and the latencies in milliseconds, the exact scan coming first"""
+    exact_results, exact_latencies = _timed_searches(
+        vector_store, query_vectors, k, metadata_filter, {"exact": True}
+    )
+    exact_ids = [
+        {document_chunk.id for document_chunk in document_chunks}
+        for document_chunks in exact_results
+    ]
+
+    def report(search_params, results, latencies):
+        recalls = [
+            (
+                len(expected_ids & {document_chunk.id for document_chunk in found})
+                / len(expected_ids)
+                if expected_ids
+                else 1.0
+            )
+            for expected_ids, found in zip(exact_ids, results)
+        ]
+
+        return {
+            "search_params": search_params,
+            "recall": float(np.mean(recalls)),
+            "mean_results": float(np.mean([len(found) for found in results])),
+            "mean_latency_ms": float(np.mean(latencies)),
+            "p50_latency_ms": float(np.percentile(latencies, 50)),
+            "p95_latency_ms": float(np.percentile(latencies, 95)),
+        }
+
+    reports = [report({"exact": True}, exact_results, exact_latencies)]
+
+    for search_params in search_params_list:
+        results, latencies = _timed_searches(
+            vector_store, query_vectors, k, metadata_filter, search_params
+        )
+        reports.append(report(search_params, results, latencies))
+
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recall and latency of the HNSW searches against exact scans"
+    )
+    parser.add_argument("--vector-dimension", type=int, default=1536)
+    parser.add_argument("--table-name", default="documents")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=float, default=None)
+    parser.add_argument(
+        "--metadata-filter", type=json.loads, default=None, help="JSON object"
+    )
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[40])
+    parser.add_argument(
+        "--iterative-scan",
+        nargs="+",
+        default=[None],
+        choices=["off", "strict_order", "relaxed_order"],
+    )
+    parser.add_argument("--max-scan-tuples", type=int, default=None)
+    parser.add_argument(
+        "--index-precision", default="float", choices=["float", "half", "binary"]
+    )
+    parser.add_argument(
+        "--oversampling",
+        type=int,
+        nargs="+",
+        default=[None],
+        help="Candidates fetched from a quantized index, as a multiple of k",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    vector_store = PgVectorVectorDB.initialize_from_env_variables(
+        vector_dimension=args.vector_dimension,
+        table_name=args.table_name,
+        index_precision=args.index_precision,
+    )
+
+    try:
+        query_vectors = sample_query_vectors(vector_store, args.queries, args.seed)
+
+        search_params_list = [
+            {
+                "ef_search": ef_search,
+                "iterative_scan": iterative_scan,
+                "max_scan_tuples": args.max_scan_tuples,
+                "oversampling": oversampling,
+            }
+            for ef_search, iterative_scan, oversampling in itertools.product(
+                args.ef_search, args.iterative_scan, args.oversampling
+            )
+        ]
+
+        reports = evaluate_search_params(
+            vector_store,
+            query_vectors,
+            search_params_list,
+            k=args.k,
+            metadata_filter=args.metadata_filter,
+        )
+    finally:
+        vector_store.close()
+
+    print(
+        "%-60s %8s %8s %10s %10s %10s"
+        % ("search params", "recall", "results", "mean ms", "p50 ms", "p95 ms")
+    )
+    for report in reports:
+        search_params = ", ".join(
+            "%s=%s" % item
+            for item in report["search_params"].items()
+            if item[1] is not None
+        )
+        print(
+            "%-60s %8.3f %8.1f %10.2f %10.2f %10.2f"
+            % (
+                search_params,
+                report["recall"],
+                report["mean_results"],
+                report["mean_latency_ms"],
+                report["p50_latency_ms"],
+                report["p95_latency_ms"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
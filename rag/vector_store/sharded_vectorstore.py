@@ -0,0 +1,567 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import threading
+import uuid
+
+
+from .base import VectorDB
+from ..utils import batched
+
+
+logger = logging.getLogger(__name__)
+
+
+# The ids of the document chunks of a sharded vector store hold the index of
+# their shard in the bits above SHARD_ID_SHIFT, and their id in the shard
+# below, so the consecutive chunks of a collection keep consecutive ids
+SHARD_ID_SHIFT = 48
+LOCAL_ID_MASK = (1 << SHARD_ID_SHIFT) - 1
+
+
+def global_document_chunk_id(shard_index, document_chunk_id):
+    return (shard_index << SHARD_ID_SHIFT) | document_chunk_id
+
+
+def split_document_chunk_id(document_chunk_id):
+    """Return the shard index and the id in the shard of a document chunk"""
+    return document_chunk_id >> SHARD_ID_SHIFT, document_chunk_id & LOCAL_ID_MASK
+
+
+def merge_by_distance(results, k):
+    """Merge the per shard results of a similarity search"""
+    return sorted(
+        itertools.chain.from_iterable(results),
+        key=lambda document_chunk: document_chunk.distance,
+    )[:k]
+
+
+def merge_by_rank(results, k):
+    """Merge the per shard results of a hybrid search, interleaving them by
+    rank: their fused scores are only comparable within a shard"""
+    return [
+        document_chunk
+        for document_chunks in itertools.zip_longest(*results)
+        for document_chunk in document_chunks
+        if document_chunk is not None
+    ][:k]
+
+
+class ShardedVectorDB(VectorDB):
+    """Vector store spreading the collections over several vector stores,
+    like PgVectorVectorDB instances on different Postgres nodes.
+
+    The chunks of a collection are stored in the shard chosen by a hash of
+    the collection uuid. The searches run on all the shards concurrently and
+    the per shard top k are merged by distance. The ids of the returned
+    document chunks encode their shard.
+
+    replicas optionally gives, for each shard, a list of vector stores of its
+    read replicas: the searches are then spread over them round robin, and
+    fall back to the primary when a replica fails. The writes, and the reads
+    of the upserts, always go to the primaries.
+
+    The shard calls run in a thread pool of max_workers threads, by default
+    max_concurrency threads per shard so that max_concurrency searches can
+    fan out at the same time without queuing behind each other.
+
+    The number of shards can't change once documents are stored, the
+    collections would be looked up in other shards.
+    """
+
+    def __init__(self, shards, replicas=None, max_workers=None, max_concurrency=8):
+        if not shards:
+            raise ValueError("At least one shard is needed")
+
+        self.shards = list(shards)
+        self.replicas = [list(shard_replicas) for shard_replicas in replicas or []]
+        self.replicas.extend([] for _ in range(len(self.shards) - len(self.replicas)))
+
+        self._replica_cycles = [
+            itertools.cycle(shard_replicas) if shard_replicas else None
+            for shard_replicas in self.replicas
+        ]
+        self._replica_lock = threading.Lock()
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or max_concurrency * len(self.shards),
+            thread_name_prefix="sharded-vector-store",
+        )
+
+    def shard_index(self, collection_uuid):
+        digest = hashlib.blake2b(
+            uuid.UUID(str(collection_uuid)).bytes, digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big") % len(self.shards)
+
+    def _collection_shard(self, collection_uuid):
+        shard_index = self.shard_index(collection_uuid)
+        return shard_index, self.shards[shard_index]
+
+    def _search_shard_indices(self, search_kwargs):
+        """Shards searched: the ones of the collections the search is scoped
+        to, or all of them"""
+        collection_uuid = search_kwargs.get("collection_uuid")
+
+        if collection_uuid is None:
+            return range(len(self.shards))
+
+        if not isinstance(collection_uuid, (list, tuple, set)):
+            collection_uuid = [collection_uuid]
+
+        return sorted({self.shard_index(uuid_) for uuid_ in collection_uuid})
+
+    def _read_store(self, shard_index):
+        if self._replica_cycles[shard_index] is None:
+            return self.shards[shard_index]
+
+        with self._replica_lock:
+            return next(self._replica_cycles[shard_index])
+
+    @staticmethod
+    def _globalize(shard_index, document_chunks):
+        for document_chunk in document_chunks:
+            document_chunk.id = global_document_chunk_id(shard_index, document_chunk.id)
+
+        return document_chunks
+
+    @staticmethod
+    def _search_kwargs(kwargs):
+        # Only the extra search arguments that are set are passed on, so
+        # shards not supporting them can be used without them
+        search_kwargs = {
+            name: value for name, value in kwargs.items() if value is not None
+        }
+
+        # The results are merged as document chunks
+        if "columns" in search_kwargs:
+            raise ValueError("The sharded searches can't project columns")
+
+        return search_kwargs
+
+    def _read(self, shard_index, method, *args, **kwargs):
+        """Call a read method on a replica of the shard, or on its primary
+        when the replica fails"""
+        store = self._read_store(shard_index)
+
+        try:
+            return getattr(store, method)(*args, **kwargs)
+        except Exception:
+            if store is self.shards[shard_index]:
+                raise
+
+            logger.warning(
+                "Read replica of shard %s failed, reading from the primary",
+                shard_index,
+                exc_info=True,
+            )
+            return getattr(self.shards[shard_index], method)(*args, **kwargs)
+
+    async def _aread(self, shard_index, method, *args, **kwargs):
+        store = self._read_store(shard_index)
+
+        try:
+            return await getattr(store, method)(*args, **kwargs)
+        except Exception:
+            if store is self.shards[shard_index]:
+                raise
+
+            logger.warning(
+                "Read replica of shard %s failed, reading from the primary",
+                shard_index,
+                exc_info=True,
+            )
+            return await getattr(self.shards[shard_index], method)(*args, **kwargs)
+
+    def _scatter(self, shard_indices, method, *args, **kwargs):
+        """Call a read method on the shards concurrently. Returns the results
+        of each shard, with global document chunk ids"""
+        futures = [
+            (
+                shard_index,
+                self._executor.submit(self._read, shard_index, method, *args, **kwargs),
+            )
+            for shard_index in shard_indices
+        ]
+
+        return [(shard_index, future.result()) for shard_index, future in futures]
+
+    async def _ascatter(self, shard_indices, method, *args, **kwargs):
+        results = await asyncio.gather(
+            *(
+                self._aread(shard_index, method, *args, **kwargs)
+                for shard_index in shard_indices
+            )
+        )
+
+        return list(zip(shard_indices, results))
+
+    def store_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
+        shard_index, shard = self._collection_shard(collection_uuid)
+        document_chunk = shard.store_document_chunk(
+            collection_uuid, content, embedding_vector, metadata
+        )
+        return self._globalize(shard_index, [document_chunk])[0]
+
+    def store_document_chunks_in_batch(
+        self, collection_uuid, content_list, embedding_list, metadata_list
+    ):
+        shard_index, shard = self._collection_shard(collection_uuid)
+        document_chunk_ids = shard.store_document_chunks_in_batch(
+            collection_uuid, content_list, embedding_list, metadata_list
+        )
+        return [
+            global_document_chunk_id(shard_index, document_chunk_id)
+            for document_chunk_id in document_chunk_ids
+        ]
+
+    def _group_by_shard(self, window):
+        """Group the (collection_uuid, content, embedding_vector, metadata)
+        tuples by shard, with their position"""
+        shard_rows = collections.defaultdict(list)
+        for position, row in enumerate(window):
+            shard_rows[self.shard_index(row[0])].append((position, row))
+
+        return shard_rows
+
+    @staticmethod
+    def _window_ids(window, shard_rows, shard_ids):
+        window_ids = [None] * len(window)
+
+        for shard_index, rows in shard_rows.items():
+            for (position, _), document_chunk_id in zip(rows, shard_ids[shard_index]):
+                window_ids[position] = global_document_chunk_id(
+                    shard_index, document_chunk_id
+                )
+
+        return window_ids
+
+    def bulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        """Bulk store the chunks in windows of batch_size chunks per shard,
+        each window being stored on the shards concurrently"""
+        document_chunk_ids = []
+
+        for window in batched(document_chunks, batch_size * len(self.shards)):
+            shard_rows = self._group_by_shard(window)
+
+            futures = {
+                shard_index: self._executor.submit(
+                    self.shards[shard_index].bulk_store_document_chunks,
+                    [row for _, row in rows],
+                    batch_size,
+                )
+                for shard_index, rows in shard_rows.items()
+            }
+            shard_ids = {
+                shard_index: future.result() for shard_index, future in futures.items()
+            }
+
+            document_chunk_ids.extend(self._window_ids(window, shard_rows, shard_ids))
+
+        return document_chunk_ids
+
+    def similarity_search(
+        self,
+        embedding_vector,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return self.similarity_search_many(
+            [embedding_vector], k, metadata_filter, include_embeddings, **kwargs
+        )[0]
+
+    def similarity_search_many(
+        self,
+        embedding_vectors,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        search_kwargs = self._search_kwargs(kwargs)
+        shard_results = self._scatter(
+            self._search_shard_indices(search_kwargs),
+            "similarity_search_many",
+            embedding_vectors,
+            k,
+            metadata_filter,
+            include_embeddings,
+            **search_kwargs,
+        )
+
+        return self._merge_many(
+            shard_results, len(embedding_vectors), k, merge_by_distance
+        )
+
+    def _merge_many(self, shard_results, num_queries, k, merge):
+        for shard_index, results in shard_results:
+            for document_chunks in results:
+                self._globalize(shard_index, document_chunks)
+
+        return [
+            merge([results[i] for _, results in shard_results], k)
+            for i in range(num_queries)
+        ]
+
+    def hybrid_search(
+        self,
+        embedding_vector,
+        query_text,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return self.hybrid_search_many(
+            [embedding_vector],
+            [query_text],
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            **kwargs,
+        )[0]
+
+    def hybrid_search_many(
+        self,
+        embedding_vectors,
+        query_texts,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        search_kwargs = self._search_kwargs(kwargs)
+        shard_results = self._scatter(
+            self._search_shard_indices(search_kwargs),
+            "hybrid_search_many",
+            embedding_vectors,
+            query_texts,
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            **search_kwargs,
+        )
+
+        return self._merge_many(shard_results, len(embedding_vectors), k, merge_by_rank)
+
+    def delete_document_chunk_by_id(self, document_chunk_id: int):
+        shard_index, document_chunk_id = split_document_chunk_id(document_chunk_id)
+        return self.shards[shard_index].delete_document_chunk_by_id(document_chunk_id)
+
+    def delete_all_chunks_in_collection(self, collection_uuid):
+        _, shard = self._collection_shard(collection_uuid)
+        return shard.delete_all_chunks_in_collection(collection_uuid)
+
+    def delete_document_chunks(self, **metadata_filter):
+        futures = [
+            self._executor.submit(shard.delete_document_chunks, **metadata_filter)
+            for shard in self.shards
+        ]
+        return sum(future.result() or 0 for future in futures)
+
+    def get_document_chunk_hashes(self, collection_uuid):
+        _, shard = self._collection_shard(collection_uuid)
+        return shard.get_document_chunk_hashes(collection_uuid)
+
+    def upsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        _, shard = self._collection_shard(collection_uuid)
+        return shard.upsert_document_chunks(
+            collection_uuid, document_chunks, num_chunks, metadata
+        )
+
+    def _stores(self):
+        return self.shards + [
+            replica for shard_replicas in self.replicas for replica in shard_replicas
+        ]
+
+    def close(self):
+        self._executor.shutdown()
+
+        for store in self._stores():
+            store.close()
+
+    # Asyncio interface, the shards are called with their asyncio methods
+
+    async def astore_document_chunk(
+        self, collection_uuid, content, embedding_vector, metadata=None
+    ):
+        shard_index, shard = self._collection_shard(collection_uuid)
+        document_chunk = await shard.astore_document_chunk(
+            collection_uuid, content, embedding_vector, metadata
+        )
+        return self._globalize(shard_index, [document_chunk])[0]
+
+    async def astore_document_chunks_in_batch(
+        self, collection_uuid, content_list, embedding_list, metadata_list
+    ):
+        shard_index, shard = self._collection_shard(collection_uuid)
+        document_chunk_ids = await shard.astore_document_chunks_in_batch(
+            collection_uuid, content_list, embedding_list, metadata_list
+        )
+        return [
+            global_document_chunk_id(shard_index, document_chunk_id)
+            for document_chunk_id in document_chunk_ids
+        ]
+
+    async def abulk_store_document_chunks(self, document_chunks, batch_size=1000):
+        document_chunk_ids = []
+
+        for window in batched(document_chunks, batch_size * len(self.shards)):
+            shard_rows = self._group_by_shard(window)
+
+            results = await asyncio.gather(
+                *(
+                    self.shards[shard_index].abulk_store_document_chunks(
+                        [row for _, row in rows], batch_size
+                    )
+                    for shard_index, rows in shard_rows.items()
+                )
+            )
+            shard_ids = dict(zip(shard_rows, results))
+
+            document_chunk_ids.extend(self._window_ids(window, shard_rows, shard_ids))
+
+        return document_chunk_ids
+
+    async def asimilarity_search(
+        self,
+        embedding_vector,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return (
+            await self.asimilarity_search_many(
+                [embedding_vector], k, metadata_filter, include_embeddings, **kwargs
+            )
+        )[0]
+
+    async def asimilarity_search_many(
+        self,
+        embedding_vectors,
+        k=3,
+        metadata_filter=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        search_kwargs = self._search_kwargs(kwargs)
+        shard_results = await self._ascatter(
+            self._search_shard_indices(search_kwargs),
+            "asimilarity_search_many",
+            embedding_vectors,
+            k,
+            metadata_filter,
+            include_embeddings,
+            **search_kwargs,
+        )
+
+        return self._merge_many(
+            shard_results, len(embedding_vectors), k, merge_by_distance
+        )
+
+    async def ahybrid_search(
+        self,
+        embedding_vector,
+        query_text,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        return (
+            await self.ahybrid_search_many(
+                [embedding_vector],
+                [query_text],
+                k,
+                metadata_filter,
+                candidates,
+                include_embeddings,
+                **kwargs,
+            )
+        )[0]
+
+    async def ahybrid_search_many(
+        self,
+        embedding_vectors,
+        query_texts,
+        k=3,
+        metadata_filter=None,
+        candidates=None,
+        include_embeddings=False,
+        **kwargs,
+    ):
+        if len(embedding_vectors) == 0:
+            return []
+
+        search_kwargs = self._search_kwargs(kwargs)
+        shard_results = await self._ascatter(
+            self._search_shard_indices(search_kwargs),
+            "ahybrid_search_many",
+            embedding_vectors,
+            query_texts,
+            k,
+            metadata_filter,
+            candidates,
+            include_embeddings,
+            **search_kwargs,
+        )
+
+        return self._merge_many(shard_results, len(embedding_vectors), k, merge_by_rank)
+
+    async def adelete_document_chunk_by_id(self, document_chunk_id: int):
+        shard_index, document_chunk_id = split_document_chunk_id(document_chunk_id)
+        return await self.shards[shard_index].adelete_document_chunk_by_id(
+            document_chunk_id
+        )
+
+    async def adelete_all_chunks_in_collection(self, collection_uuid):
+        _, shard = self._collection_shard(collection_uuid)
+        return await shard.adelete_all_chunks_in_collection(collection_uuid)
+
+    async def adelete_document_chunks(self, **metadata_filter):
+        deleted = await asyncio.gather(
+            *(shard.adelete_document_chunks(**metadata_filter) for shard in self.shards)
+        )
+        return sum(count or 0 for count in deleted)
+
+    async def aget_document_chunk_hashes(self, collection_uuid):
+        _, shard = self._collection_shard(collection_uuid)
+        return await shard.aget_document_chunk_hashes(collection_uuid)
+
+    async def aupsert_document_chunks(
+        self, collection_uuid, document_chunks, num_chunks, metadata=None
+    ):
+        _, shard = self._collection_shard(collection_uuid)
+        return await shard.aupsert_document_chunks(
+            collection_uuid, document_chunks, num_chunks, metadata
+        )
+
+    async def aclose(self):
+        self._executor.shutdown()
+
+        for store in self._stores():
+            await store.aclose()
@@ -0,0 +1,112 @@
+import datetime
+import uuid
+
+
+import numpy as np
+
+
+from rag.answer_cache import SemanticAnswerCache
+from rag.document import DocumentChunk
+
+
+COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000001")
+OTHER_COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000002")
+
+
+def document_chunks(*ids, collection_uuid=COLLECTION_UUID):
+    return [
+        DocumentChunk(
+            id=id,
+            collection_uuid=collection_uuid,
+            content=str(id),
+            created_at=datetime.datetime(2024, 1, 1),
+        )
+        for id in ids
+    ]
+
+
+def test_answer_cache_hit():
+    cache = SemanticAnswerCache(similarity_threshold=0.95)
+    cache.set(np.array([1.0, 0.0, 0.0]), document_chunks(1, 2), "answer")
+
+    # Near duplicate question retrieving the same chunks
+    assert cache.get(np.array([2.0, 0.1, 0.0]), document_chunks(1, 2)) == "answer"
+
+    # Different question, or other chunks retrieved
+    assert cache.get(np.array([1.0, 1.0, 0.0]), document_chunks(1, 2)) is None
+    assert cache.get(np.array([1.0, 0.0, 0.0]), document_chunks(2, 1)) is None
+
+    assert cache.stats() == {"hits": 1, "misses": 2, "size": 1}
+
+
+def test_answer_cache_evicts_least_recently_used():
+    cache = SemanticAnswerCache(similarity_threshold=0.99, max_size=2)
+    cache.set(np.array([1.0, 0.0, 0.0]), document_chunks(1), "a")
+    cache.set(np.array([0.0, 1.0, 0.0]), document_chunks(2), "b")
+
+    assert cache.get(np.array([1.0, 0.0, 0.0]), document_chunks(1)) == "a"
+    cache.set(np.array([0.0, 0.0, 1.0]), document_chunks(3), "c")
+
+    assert cache.get(np.array([0.0, 1.0, 0.0]), document_chunks(2)) is None
+    assert cache.get(np.array([1.0, 0.0, 0.0]), document_chunks(1)) == "a"
+    assert cache.get(np.array([0.0, 0.0, 1.0]), document_chunks(3)) == "c"
+
+
+def test_answer_cache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("rag.answer_cache.time.monotonic", lambda: now)
+
+    cache = SemanticAnswerCache(ttl=10)
+    cache.set(np.array([1.0, 0.0]), document_chunks(1), "answer")
+
+    now = 1010.0
+    assert cache.get(np.array([1.0, 0.0]), document_chunks(1)) == "answer"
+
+    now = 1010.5
+    assert cache.get(np.array([1.0, 0.0]), document_chunks(1)) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_answer_cache_invalidate_collection():
+    cache = SemanticAnswerCache()
+    mixed_chunks = document_chunks(1) + document_chunks(
+        2, collection_uuid=OTHER_COLLECTION_UUID
+    )
+    cache.set(np.array([1.0, 0.0]), mixed_chunks, "mixed answer")
+    cache.set(np.array([0.0, 1.0]), document_chunks(3), "answer")
+
+    # The answers generated from any chunk of the collection are dropped
+    cache.invalidate_collection(OTHER_COLLECTION_UUID)
+
+    assert cache.get(np.array([1.0, 0.0]), mixed_chunks) is None
+    assert cache.get(np.array([0.0, 1.0]), document_chunks(3)) == "answer"
+
+    cache.clear()
+    assert cache.stats()["size"] == 0
+
+
+def test_answer_cache_tries_the_next_similar_entry():
+    cache = SemanticAnswerCache(similarity_threshold=0.9)
+
+    cache.set(np.array([1.0, 0.1]), document_chunks(1, 2), "stale answer")
+    cache.set(np.array([1.0, 0.2]), document_chunks(1, 3), "answer")
+
+    # The most similar entry was generated from other chunks
+    assert cache.get(np.array([1.0, 0.1]), document_chunks(1, 3)) == "answer"
+    assert cache.get(np.array([1.0, 0.1]), document_chunks(4)) is None
+
+
+def test_answer_cache_skips_expired_entries(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("rag.answer_cache.time.monotonic", lambda: now)
+
+    cache = SemanticAnswerCache(similarity_threshold=0.9, ttl=10)
+    cache.set(np.array([1.0, 0.0]), document_chunks(1), "expired answer")
+
+    now = 1005.0
+    cache.set(np.array([1.0, 0.2]), document_chunks(1), "answer")
+
+    # The most similar entry expired, the other one is still valid
+    now = 1012.0
+    assert cache.get(np.array([1.0, 0.0]), document_chunks(1)) == "answer"
+    assert cache.stats()["size"] == 1
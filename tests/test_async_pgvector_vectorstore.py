@@ -0,0 +1,169 @@
+import asyncio
+import contextlib
+import uuid
+
+
+import numpy as np
+import pytest
+from psycopg import sql
+
+
+from benchmarks.fakes import FakeEmbeddings, fake_rag_system
+from benchmarks.runner import pgvector_available
+from rag.vector_store.base import MissingEmbeddingsError
+from rag.vector_store.pgvector_vectorstore import AsyncPgVectorVectorDB
+
+
+# Run against the Postgres of the POSTGRES_* environment variables, like the
+# benchmarks
+pytestmark = pytest.mark.skipif(
+    not pgvector_available(), reason="Postgres is not available"
+)
+
+COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000001")
+OTHER_COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000002")
+
+
+def unit_vector(index, dimension=4):
+    vector = np.zeros(dimension, dtype=np.float32)
+    vector[index] = 1
+    return vector
+
+
+@contextlib.asynccontextmanager
+async def vector_store(**kwargs):
+    """Opened vector store of an empty table, dropped afterwards"""
+    vector_store = await AsyncPgVectorVectorDB.initialize_from_env_variables(
+        vector_dimension=4,
+        table_name="test_%s" % uuid.uuid4().hex[:12],
+        create_extension=True,
+        **kwargs
+    ).open()
+
+    try:
+        yield vector_store
+    finally:
+        async with vector_store._connection() as conn:
+            await conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {table_name}").format(
+                    table_name=sql.Identifier(vector_store.table_name)
+                )
+            )
+
+        await vector_store.aclose()
+
+
+@pytest.mark.parametrize("pool_size", [None, 2])
+def test_store_and_search(pool_size):
+    async def main():
+        async with vector_store(pool_size=pool_size) as store:
+            document_chunk = await store.astore_document_chunk(
+                COLLECTION_UUID, "a", unit_vector(0), {"source": "wiki"}
+            )
+            document_chunk_ids = await store.abulk_store_document_chunks(
+                [
+                    (COLLECTION_UUID, "b", unit_vector(1), {"source": "wiki"}),
+                    (OTHER_COLLECTION_UUID, "c", [1, 0.5, 0, 0], {"source": "blog"}),
+                ]
+            )
+
+            results = await store.asimilarity_search_many(
+                [unit_vector(0), unit_vector(1)], k=2
+            )
+            filtered_results = await asyncio.gather(
+                store.asimilarity_search(
+                    unit_vector(0), k=3, metadata_filter={"source": "wiki"}
+                ),
+                store.asimilarity_search(unit_vector(0), k=3, include_embeddings=True),
+            )
+
+            await store.adelete_document_chunk_by_id(document_chunk.id)
+            await store.adelete_all_chunks_in_collection(OTHER_COLLECTION_UUID)
+            remaining = await store.asimilarity_search(unit_vector(0), k=3)
+
+            return document_chunk_ids, results, filtered_results, remaining
+
+    document_chunk_ids, results, filtered_results, remaining = asyncio.run(main())
+
+    assert len(document_chunk_ids) == 2
+    assert [[doc.content for doc in docs] for docs in results] == [
+        ["a", "c"],
+        ["b", "c"],
+    ]
+    assert results[0][0].distance == pytest.approx(0, abs=1e-6)
+    assert [doc.content for doc in filtered_results[0]] == ["a", "b"]
+    assert np.allclose(filtered_results[1][0].embedding_vector, unit_vector(0))
+    assert [doc.content for doc in remaining] == ["b"]
+
+
+def test_hybrid_search():
+    async def main():
+        async with vector_store(full_text_search=True) as store:
+            await store.abulk_store_document_chunks(
+                [
+                    (COLLECTION_UUID, "error E42 in the pump", unit_vector(1), None),
+                    (COLLECTION_UUID, "the pump works", unit_vector(0), None),
+                ]
+            )
+            return await store.ahybrid_search(unit_vector(0), "E42", k=2)
+
+    # Both searches contribute candidates to the fused ranking
+    assert {doc.content for doc in asyncio.run(main())} == {
+        "error E42 in the pump",
+        "the pump works",
+    }
+
+
+def test_upsert_document_chunks():
+    async def main():
+        async with vector_store() as store:
+            await store.aupsert_document_chunks(
+                COLLECTION_UUID,
+                [
+                    (0, "a", "ha", unit_vector(0)),
+                    (1, "b", "hb", unit_vector(1)),
+                    (2, "c", "hc", unit_vector(2)),
+                ],
+                3,
+            )
+
+            # The moved chunk reuses its stored embedding, the last one is
+            # stale
+            deleted = await store.aupsert_document_chunks(
+                COLLECTION_UUID, [(0, "b", "hb", None)], 2
+            )
+            hashes = await store.aget_document_chunk_hashes(COLLECTION_UUID)
+
+            with pytest.raises(MissingEmbeddingsError) as e:
+                await store.aupsert_document_chunks(
+                    COLLECTION_UUID, [(0, "x", "hx", None)], 2
+                )
+
+            results = await store.asimilarity_search(unit_vector(1), k=3)
+
+            return deleted, hashes, e.value.content_hashes, results
+
+    deleted, hashes, missing_hashes, results = asyncio.run(main())
+
+    assert deleted == 1
+    assert hashes == {0: "hb", 1: "hb"}
+    assert missing_hashes == {"hx"}
+    assert [doc.content for doc in results][:2] == ["b", "b"]
+
+
+def test_rag_system_aquery():
+    embeddings = FakeEmbeddings(dimension=4)
+
+    async def main():
+        async with vector_store() as store:
+            rag_system = fake_rag_system(store, embeddings)
+
+            await rag_system.aadd_document("red fox", document_uuid=COLLECTION_UUID)
+            await rag_system.aadd_document("blue whale")
+
+            return await rag_system.aquery("red fox", k=1, return_full_data=True)
+
+    result = asyncio.run(main())
+
+    assert [doc.content for doc in result["relevant_docs"]] == ["red fox"]
+    assert result["answer"] == "This is a fake answer."
@@ -0,0 +1,251 @@
+import asyncio
+import uuid
+
+
+import pytest
+
+
+from benchmarks.fakes import FakeEmbeddings, fake_rag_system
+from rag.answer_cache import SemanticAnswerCache
+from rag.instrumentation import MetricsInstrumentation
+from rag.text_splitters import WordTextSplitter
+from rag.vector_store.numpy_vectorstore import NumpyVectorDB
+
+
+DOCUMENTS = {
+    uuid.UUID("00000000-0000-0000-0000-000000000001"): "the red fox jumps",
+    uuid.UUID("00000000-0000-0000-0000-000000000002"): "the blue whale swims",
+    uuid.UUID("00000000-0000-0000-0000-000000000003"): "the green frog sings",
+}
+
+
+class ContextLLM:
+    """Answer with the question and the context of the prompt"""
+
+    def generate_response(self, messages):
+        context, question = messages[-1]["content"].split("\n\nQuestion: ")
+        return "%s | %s" % (question, context.removeprefix("Context:\n"))
+
+    async def agenerate_response(self, messages):
+        return self.generate_response(messages)
+
+
+@pytest.fixture
+def rag_system():
+    rag_system = fake_rag_system(
+        NumpyVectorDB(vector_dimension=16),
+        FakeEmbeddings(dimension=16),
+        ContextLLM(),
+        instrumentation=MetricsInstrumentation(),
+    )
+
+    for document_uuid, text in DOCUMENTS.items():
+        rag_system.add_document(text, {"animal": text.split()[2]}, document_uuid)
+
+    return rag_system
+
+
+def test_query(rag_system):
+    assert rag_system.query("red fox", k=1) == "red fox | the red fox jumps"
+
+    result = rag_system.query(
+        "the", k=3, metadata_filter={"animal": "whale"}, return_full_data=True
+    )
+    assert [doc.content for doc in result["relevant_docs"]] == ["the blue whale swims"]
+    assert result["answer"] == "the | the blue whale swims"
+    assert result["chat_completion_messages"][0]["role"] == "system"
+
+    counters = rag_system.instrumentation.snapshot()["counters"]
+    assert counters["queries"] == 2
+    assert counters["retrieved_chunks"] == 2
+
+
+def test_query_many(rag_system):
+    questions = ["green frog", "red fox", "blue whale"]
+
+    # The answers are returned in the order of the questions, each from its
+    # own retrieval
+    assert rag_system.query_many(questions, k=1, max_concurrency=2) == [
+        "green frog | the green frog sings",
+        "red fox | the red fox jumps",
+        "blue whale | the blue whale swims",
+    ]
+
+    results = rag_system.query_many(questions, k=2, return_full_data=True)
+    assert [result["question"] for result in results] == questions
+    assert all(len(result["relevant_docs"]) == 2 for result in results)
+    assert rag_system.query_many([]) == []
+
+
+def test_aquery_and_aquery_many(rag_system):
+    async def main():
+        return await asyncio.gather(
+            rag_system.aquery("red fox", k=1),
+            rag_system.aquery_many(["blue whale", "green frog"], k=1),
+        )
+
+    answer, answers = asyncio.run(main())
+
+    assert answer == "red fox | the red fox jumps"
+    assert answers == [
+        "blue whale | the blue whale swims",
+        "green frog | the green frog sings",
+    ]
+
+
+def test_query_stream(rag_system):
+    generated = []
+
+    def generate_response_stream(messages):
+        for token in rag_system.generate_response(messages).split(" "):
+            generated.append(token)
+            yield token + " "
+
+    rag_system.generate_response_stream = generate_response_stream
+    rag_system.answer_cache = SemanticAnswerCache()
+
+    # The documents are returned before the first token is generated
+    relevant_docs, tokens = rag_system.query_stream("red fox", k=1)
+    assert [doc.content for doc in relevant_docs] == ["the red fox jumps"]
+    assert generated == []
+
+    assert "".join(tokens) == "red fox | the red fox jumps "
+    assert len(generated) == 7
+
+    # The complete answer was cached
+    relevant_docs, tokens = rag_system.query_stream("red fox", k=1)
+    assert list(tokens) == ["red fox | the red fox jumps "]
+    assert len(generated) == 7
+
+    snapshot = rag_system.instrumentation.snapshot()
+    assert snapshot["stage_durations"]["first_token"]["count"] == 1
+    assert snapshot["counters"]["answer_cache_hits"] == 1
+
+
+def test_aquery_stream(rag_system):
+    async def agenerate_response_stream(messages):
+        for token in (await rag_system.agenerate_response(messages)).split(" "):
+            yield token + " "
+
+    rag_system.agenerate_response_stream = agenerate_response_stream
+
+    async def main():
+        relevant_docs, tokens = await rag_system.aquery_stream("blue whale", k=1)
+        return relevant_docs, [token async for token in tokens]
+
+    relevant_docs, tokens = asyncio.run(main())
+
+    assert [doc.content for doc in relevant_docs] == ["the blue whale swims"]
+    assert tokens == ["blue ", "whale ", "| ", "the ", "blue ", "whale ", "swims "]
+
+
+def upsert_rag_system(embeddings):
+    # Documents of more than 5 characters are split in chunks of 3 words
+    return fake_rag_system(
+        NumpyVectorDB(vector_dimension=16),
+        embeddings,
+        text_splitter=WordTextSplitter(chunk_size=3, overlap=0),
+        max_document_length_text=5,
+    )
+
+
+def test_upsert_document():
+    embeddings = FakeEmbeddings(dimension=16)
+    rag_system = upsert_rag_system(embeddings)
+    document_uuid = uuid.uuid4()
+
+    assert rag_system.upsert_document(document_uuid, "a b c d e f g h i") == {
+        "chunks": 3,
+        "written": 3,
+        "embedded": 3,
+        "deleted": 0,
+    }
+    assert rag_system.upsert_document(document_uuid, "a b c d e f g h i") == {
+        "chunks": 3,
+        "written": 0,
+        "embedded": 0,
+        "deleted": 0,
+    }
+
+    # The moved chunks reuse their stored embedding
+    assert rag_system.upsert_document(document_uuid, "d e f a b c") == {
+        "chunks": 2,
+        "written": 2,
+        "embedded": 0,
+        "deleted": 1,
+    }
+    assert embeddings.texts == 3
+
+    assert [
+        doc.content
+        for doc in rag_system.vector_store.similarity_search(
+            embeddings.embed("a b c"), k=5
+        )
+    ] == ["a b c", "d e f"]
+
+
+def test_upsert_document_reembeds_missing_embeddings():
+    embeddings = FakeEmbeddings(dimension=16)
+    rag_system = upsert_rag_system(embeddings)
+    vector_store = rag_system.vector_store
+    document_uuid = uuid.uuid4()
+
+    rag_system.upsert_document(document_uuid, "a b c d e f")
+
+    # The collection is emptied between the read of its hashes and the
+    # upsert, the moved chunk's embedding is gone
+    upsert_document_chunks = vector_store.upsert_document_chunks
+
+    def upsert_after_delete(*args):
+        vector_store.upsert_document_chunks = upsert_document_chunks
+        vector_store.delete_all_chunks_in_collection(document_uuid)
+        return upsert_document_chunks(*args)
+
+    vector_store.upsert_document_chunks = upsert_after_delete
+
+    assert rag_system.upsert_document(document_uuid, "g h i a b c") == {
+        "chunks": 2,
+        "written": 2,
+        "embedded": 2,
+        "deleted": 0,
+    }
+    assert vector_store.get_document_chunk_hashes(document_uuid).keys() == {0, 1}
+    assert embeddings.texts == 4
+
+
+def test_aupsert_document():
+    rag_system = upsert_rag_system(FakeEmbeddings(dimension=16))
+    document_uuid = uuid.uuid4()
+
+    async def main():
+        await rag_system.aupsert_document(document_uuid, "a b c d e f g h i")
+        return await rag_system.aupsert_document(document_uuid, "a b c x y z")
+
+    assert asyncio.run(main()) == {
+        "chunks": 2,
+        "written": 1,
+        "embedded": 1,
+        "deleted": 1,
+    }
+
+
+def test_query_answer_cache(rag_system):
+    rag_system.answer_cache = SemanticAnswerCache(similarity_threshold=0.9)
+    generate_response = rag_system.generate_response
+    prompts = []
+
+    def count_generate_response(messages):
+        prompts.append(messages)
+        return generate_response(messages)
+
+    rag_system.generate_response = count_generate_response
+    document_uuid = next(iter(DOCUMENTS))
+
+    assert rag_system.query("red fox", k=1) == "red fox | the red fox jumps"
+    assert rag_system.query("red fox", k=1) == "red fox | the red fox jumps"
+    assert len(prompts) == 1
+
+    # Modifying the collection of the retrieved chunk drops the answer
+    rag_system.add_document("purple owl", document_uuid=document_uuid)
+    rag_system.query("red fox", k=1)
+    assert len(prompts) == 2
@@ -0,0 +1,106 @@
+import datetime
+import uuid
+
+
+from rag.context import ContextPacker, overlap_length
+from rag.document import DocumentChunk
+
+
+COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000001")
+OTHER_COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000002")
+
+
+def document_chunk(id, content, collection_uuid=COLLECTION_UUID):
+    return DocumentChunk(
+        id=id,
+        collection_uuid=collection_uuid,
+        content=content,
+        created_at=datetime.datetime(2024, 1, 1),
+    )
+
+
+def test_overlap_length():
+    assert overlap_length("a b c d".split(), "c d e".split()) == 2
+    assert overlap_length("a b a b".split(), "a b a b c".split()) == 4
+    assert overlap_length("a b c".split(), "d e".split()) == 0
+    assert overlap_length([], "a".split()) == 0
+
+
+def test_merge_overlapping_and_consecutive_chunks():
+    packer = ContextPacker(min_overlap_words=2)
+
+    passages = packer.merge(
+        [
+            document_chunk(11, "e f g h i"),
+            document_chunk(1, "a b c d"),
+            document_chunk(5, "x y"),
+            document_chunk(10, "c d e f"),
+            document_chunk(2, "p q", OTHER_COLLECTION_UUID),
+            document_chunk(3, "r s", OTHER_COLLECTION_UUID),
+        ]
+    )
+
+    # Passages in the order of their best ranked chunk: chunks 10 and 11
+    # overlap, chunk 1 overlaps chunk 10 but 5 sits between them, chunks 2
+    # and 3 are consecutive
+    assert [
+        (passage.text, passage.document_chunk_ids, passage.rank) for passage in passages
+    ] == [
+        ("c d e f g h i", [10, 11], 0),
+        ("a b c d", [1], 1),
+        ("x y", [5], 2),
+        ("p q r s", [2, 3], 4),
+    ]
+    assert passages[0].overlap_words_removed == 2
+    assert passages[3].overlap_words_removed == 0
+
+
+def test_merge_drops_contained_chunk():
+    passages = ContextPacker(min_overlap_words=2).merge(
+        [document_chunk(1, "a b c"), document_chunk(2, "b c")]
+    )
+
+    assert [(passage.text, passage.document_chunk_ids) for passage in passages] == [
+        ("a b c", [1, 2])
+    ]
+
+
+def test_pack_within_budget():
+    packer = ContextPacker(max_tokens=7, separator=" | ")
+
+    packed = packer.pack(
+        [
+            document_chunk(1, "a b c"),
+            document_chunk(10, "d e f g"),
+            document_chunk(20, "h i"),
+        ]
+    )
+
+    # 3 tokens, then 1 + 4 tokens don't fit but 1 + 2 do
+    assert packed.text == "a b c | h i"
+    assert packed.tokens == 6
+    assert [decision["included"] for decision in packed.decisions] == [
+        True,
+        False,
+        True,
+    ]
+    assert not any(decision["truncated"] for decision in packed.decisions)
+
+
+def test_pack_truncates_first_passage():
+    packed = ContextPacker(max_tokens=3).pack(
+        [document_chunk(1, "a b c d e"), document_chunk(10, "f")]
+    )
+
+    assert packed.text == "a b c"
+    assert packed.tokens == 3
+    assert packed.decisions[0]["truncated"]
+    assert packed.decisions[0]["tokens"] == 3
+    assert not packed.decisions[1]["included"]
+
+
+def test_pack_without_budget():
+    packed = ContextPacker().pack([document_chunk(1, "a b"), document_chunk(10, "c d")])
+
+    assert packed.text == "a b\n\nc d"
+    assert all(decision["included"] for decision in packed.decisions)
@@ -0,0 +1,113 @@
+import asyncio
+
+
+import pytest
+
+
+from rag.embedding_batcher import EmbeddingMicroBatcher
+
+
+class RecordingEmbeddings:
+    """Embed each text as [its length], recording the batches"""
+
+    def __init__(self):
+        self.batches = []
+
+    def get_batch_embedding_vectors(self, texts):
+        self.batches.append(list(texts))
+        return [[len(text)] for text in texts]
+
+    async def aget_batch_embedding_vectors(self, texts):
+        return self.get_batch_embedding_vectors(texts)
+
+
+def embed_all_but_last(texts):
+    return [[len(text)] for text in texts[:-1]]
+
+
+async def aembed_all_but_last(texts):
+    return embed_all_but_last(texts)
+
+
+def test_batcher_fails_short_batches():
+    batcher = EmbeddingMicroBatcher(max_wait=0.05)
+
+    futures = [batcher.submit(text, embed_all_but_last) for text in ("a", "bb")]
+
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+    batcher.close()
+
+
+def test_batcher_fails_short_batches_async():
+    batcher = EmbeddingMicroBatcher(max_wait=0.05)
+
+    async def main():
+        return await asyncio.wait_for(
+            asyncio.gather(
+                batcher.aembed("a", aembed_all_but_last),
+                batcher.aembed("bb", aembed_all_but_last),
+                return_exceptions=True,
+            ),
+            timeout=5,
+        )
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+
+def test_batcher_coalesces_requests():
+    embeddings = RecordingEmbeddings()
+    batcher = EmbeddingMicroBatcher(max_batch_size=3, max_wait=0.2)
+
+    futures = [
+        batcher.submit(text, embeddings.get_batch_embedding_vectors)
+        for text in ("a", "bb", "ccc", "dddd")
+    ]
+
+    # The first batch is full, the second one is flushed after max_wait
+    assert [future.result(timeout=5) for future in futures] == [[1], [2], [3], [4]]
+    assert embeddings.batches == [["a", "bb", "ccc"], ["dddd"]]
+    assert batcher.stats() == {"requests": 4, "batches": 2, "mean_batch_size": 2}
+
+    batcher.close()
+
+
+def test_batcher_coalesces_requests_async():
+    embeddings = RecordingEmbeddings()
+    batcher = EmbeddingMicroBatcher(max_batch_size=2, max_wait=0.05)
+
+    async def main():
+        return await asyncio.wait_for(
+            asyncio.gather(
+                *[
+                    batcher.aembed(text, embeddings.aget_batch_embedding_vectors)
+                    for text in ("a", "bb", "ccc")
+                ]
+            ),
+            timeout=5,
+        )
+
+    assert asyncio.run(main()) == [[1], [2], [3]]
+    assert embeddings.batches == [["a", "bb"], ["ccc"]]
+
+
+def test_batcher_close():
+    embeddings = RecordingEmbeddings()
+    batcher = EmbeddingMicroBatcher(max_wait=10)
+
+    future = batcher.submit("a", embeddings.get_batch_embedding_vectors)
+
+    # The queued texts are embedded without waiting for max_wait
+    batcher.close()
+    assert future.result(timeout=0) == [1]
+
+    with pytest.raises(RuntimeError):
+        batcher.embed("b", embeddings.get_batch_embedding_vectors)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(batcher.aembed("b", embeddings.aget_batch_embedding_vectors))
+
+    batcher.close()
+    assert embeddings.batches == [["a"]]
@@ -0,0 +1,110 @@
+import asyncio
+
+
+import numpy as np
+
+
+from rag.embedding_cache import EmbeddingCache, SQLiteEmbeddingStore
+
+
+class RecordingEmbeddings:
+    """Embed a text as [its length, its number of calls], recording the
+    batches"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        return [[len(text), len(self.batches)] for text in texts]
+
+    async def aembed(self, texts):
+        return self(texts)
+
+
+def test_embedding_cache_splices_hits_and_misses():
+    cache = EmbeddingCache()
+    embeddings = RecordingEmbeddings()
+
+    cache.get_batch_embedding_vectors(["bb", "dddd"], embeddings, "model")
+    embedding_vectors = cache.get_batch_embedding_vectors(
+        ["a", "bb", "ccc", "a", "dddd", " ccc  "], embeddings, "model"
+    )
+
+    # Only the misses are embedded, once each and in order
+    assert embeddings.batches == [["bb", "dddd"], ["a", "ccc"]]
+    assert [embedding_vector.tolist() for embedding_vector in embedding_vectors] == [
+        [1, 2],
+        [2, 1],
+        [3, 2],
+        [1, 2],
+        [4, 1],
+        [3, 2],
+    ]
+    assert all(
+        embedding_vector.dtype == np.float32 for embedding_vector in embedding_vectors
+    )
+    assert cache.stats() == {"hits": 2, "misses": 6, "store_hits": 0, "size": 4}
+
+
+def test_embedding_cache_is_keyed_by_model():
+    cache = EmbeddingCache()
+    embeddings = RecordingEmbeddings()
+
+    cache.get_batch_embedding_vectors(["a"], embeddings, "model")
+    cache.get_batch_embedding_vectors(["a"], embeddings, "other-model")
+
+    assert embeddings.batches == [["a"], ["a"]]
+
+
+def test_embedding_cache_lru_eviction():
+    cache = EmbeddingCache(max_size=2)
+    embeddings = RecordingEmbeddings()
+
+    cache.get_batch_embedding_vectors(["a", "bb"], embeddings, "model")
+    cache.get_batch_embedding_vectors(["a"], embeddings, "model")
+    cache.get_batch_embedding_vectors(["ccc"], embeddings, "model")
+    cache.get_batch_embedding_vectors(["a", "bb"], embeddings, "model")
+
+    # bb was the least recently used entry when ccc was added
+    assert embeddings.batches == [["a", "bb"], ["ccc"], ["bb"]]
+
+
+def test_embedding_cache_store_tier(tmp_path):
+    path = str(tmp_path / "embeddings.db")
+    embeddings = RecordingEmbeddings()
+
+    cache = EmbeddingCache(store=SQLiteEmbeddingStore(path))
+    cache.get_batch_embedding_vectors(["a", "bb"], embeddings, "model")
+    cache.close()
+
+    cache = EmbeddingCache(store=SQLiteEmbeddingStore(path))
+    embedding_vectors = cache.get_batch_embedding_vectors(
+        ["ccc", "bb", "a"], embeddings, "model"
+    )
+    cache.close()
+
+    assert embeddings.batches == [["a", "bb"], ["ccc"]]
+    assert [embedding_vector.tolist() for embedding_vector in embedding_vectors] == [
+        [3, 2],
+        [2, 1],
+        [1, 1],
+    ]
+    assert cache.stats()["store_hits"] == 2
+
+
+def test_embedding_cache_async():
+    cache = EmbeddingCache()
+    embeddings = RecordingEmbeddings()
+
+    cache.get_batch_embedding_vectors(["bb"], embeddings, "model")
+    embedding_vectors = asyncio.run(
+        cache.aget_batch_embedding_vectors(["a", "bb", "a"], embeddings.aembed, "model")
+    )
+
+    assert embeddings.batches == [["bb"], ["a"]]
+    assert [embedding_vector.tolist() for embedding_vector in embedding_vectors] == [
+        [1, 2],
+        [2, 1],
+        [1, 2],
+    ]
@@ -0,0 +1,142 @@
+import asyncio
+import random
+import threading
+import time
+
+
+import pytest
+
+
+from rag.embedding_dispatcher import EmbeddingDispatcher, TokenBucket
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class FakeProvider:
+    """Embed a text as [its number], recording the sub-batches and failing
+    the first calls with the given errors"""
+
+    def __init__(self, errors=(), latency=0.0):
+        self.errors = list(errors)
+        self.latency = latency
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def _embed(self, texts):
+        with self._lock:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.batches.append(list(texts))
+
+        return [[int(text)] for text in texts]
+
+    def __call__(self, texts):
+        # Random latencies complete the sub-batches out of order
+        time.sleep(random.uniform(0, self.latency))
+        return self._embed(texts)
+
+    async def aembed(self, texts):
+        await asyncio.sleep(random.uniform(0, self.latency))
+        return self._embed(texts)
+
+
+TEXTS = [str(i) for i in range(100)]
+
+
+def test_dispatcher_keeps_the_order_of_the_texts():
+    provider = FakeProvider(latency=0.005)
+    dispatcher = EmbeddingDispatcher(
+        batch_size=7, min_batch_size=1, max_batch_size=7, max_concurrency=4
+    )
+
+    embedding_vectors = dispatcher.embed(TEXTS, provider)
+
+    assert embedding_vectors == [[i] for i in range(100)]
+    assert all(len(batch) <= 7 for batch in provider.batches)
+    assert sorted(text for batch in provider.batches for text in batch) == sorted(TEXTS)
+
+
+def test_dispatcher_async_keeps_the_order_of_the_texts():
+    provider = FakeProvider(latency=0.005)
+    dispatcher = EmbeddingDispatcher(
+        batch_size=7, min_batch_size=1, max_batch_size=7, max_concurrency=4
+    )
+
+    embedding_vectors = asyncio.run(dispatcher.aembed(TEXTS, provider.aembed))
+
+    assert embedding_vectors == [[i] for i in range(100)]
+    assert len(provider.batches) == 15
+
+
+def test_dispatcher_token_limit():
+    provider = FakeProvider()
+    dispatcher = EmbeddingDispatcher(
+        batch_size=100, max_batch_tokens=10, count_tokens=len, max_concurrency=1
+    )
+
+    embedding_vectors = dispatcher.embed(["1", "22", "333", "4444", "55555"], provider)
+
+    assert embedding_vectors == [[1], [22], [333], [4444], [55555]]
+    assert provider.batches == [["1", "22", "333", "4444"], ["55555"]]
+
+
+def test_dispatcher_retries_rate_limits():
+    provider = FakeProvider(errors=[RateLimitError(), ConnectionError()])
+    dispatcher = EmbeddingDispatcher(
+        batch_size=64, max_batch_size=64, initial_backoff=0, max_concurrency=1
+    )
+
+    assert dispatcher.embed(TEXTS, provider) == [[i] for i in range(100)]
+    # The failed sub-batch is retried as a whole, the next one is smaller
+    assert provider.batches == [TEXTS[:64], TEXTS[64:]]
+
+
+def test_dispatcher_adapts_batch_size():
+    dispatcher = EmbeddingDispatcher(
+        batch_size=64, min_batch_size=16, max_batch_size=128, target_latency=10
+    )
+
+    dispatcher._adapt_batch_size(64, rate_limited=True)
+    assert dispatcher.batch_size == 32
+
+    dispatcher._adapt_batch_size(32, latency=20)
+    dispatcher._adapt_batch_size(16, latency=20)
+    assert dispatcher.batch_size == 16
+
+    # Only full sub-batches well under the target latency grow it
+    dispatcher._adapt_batch_size(8, latency=1)
+    dispatcher._adapt_batch_size(16, latency=6)
+    assert dispatcher.batch_size == 16
+
+    for _ in range(4):
+        dispatcher._adapt_batch_size(dispatcher.batch_size, latency=1)
+    assert dispatcher.batch_size == 81
+
+    for _ in range(2):
+        dispatcher._adapt_batch_size(dispatcher.batch_size, latency=1)
+    assert dispatcher.batch_size == 128
+
+
+def test_dispatcher_raises_other_errors():
+    provider = FakeProvider(errors=[ValueError("invalid input")])
+    dispatcher = EmbeddingDispatcher(batch_size=10, initial_backoff=0)
+
+    with pytest.raises(ValueError):
+        dispatcher.embed(TEXTS, provider)
+
+
+def test_dispatcher_gives_up_after_max_retries():
+    provider = FakeProvider(errors=[RateLimitError()] * 3)
+    dispatcher = EmbeddingDispatcher(initial_backoff=0, max_retries=2)
+
+    with pytest.raises(RateLimitError):
+        dispatcher.embed(TEXTS, provider)
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(rate=1000, capacity=10)
+
+    assert bucket._reserve(10) == 0
+    assert bucket._reserve(5) == pytest.approx(0.005, abs=0.001)
@@ -0,0 +1,91 @@
+import queue
+import threading
+
+
+import pytest
+
+
+from benchmarks.fakes import FakeEmbeddings, fake_rag_system
+from rag.ingestion import IngestionJob, IngestionQueue
+from rag.text_splitters import WordTextSplitter
+from rag.vector_store.numpy_vectorstore import NumpyVectorDB
+
+
+@pytest.fixture
+def rag_system():
+    # Documents of more than 5 characters are split in chunks of 3 words
+    return fake_rag_system(
+        NumpyVectorDB(vector_dimension=16),
+        FakeEmbeddings(dimension=16),
+        text_splitter=WordTextSplitter(chunk_size=3, overlap=0),
+        max_document_length_text=5,
+    )
+
+
+def test_ingestion_queue(rag_system):
+    ingestion_queue = IngestionQueue(
+        rag_system, embedding_workers=2, writer_workers=2, embedding_batch_size=2
+    ).start()
+
+    jobs = [
+        ingestion_queue.submit("a b c d e f g h i j k l m n o", {"page": 1}),
+        ingestion_queue.submit("p q r", {"page": 2}),
+    ]
+    ingestion_queue.close()
+
+    assert [job.to_dict()["status"] for job in jobs] == ["done", "done"]
+    assert [job.chunks_total for job in jobs] == [5, 1]
+    assert [job.chunks_stored for job in jobs] == [5, 1]
+    assert len(rag_system.vector_store) == 6
+    assert ingestion_queue.stats()["jobs"] == {"done": 2}
+    assert ingestion_queue.get_job(jobs[1].id) is jobs[1]
+
+
+def test_ingestion_queue_backpressure(rag_system):
+    ingestion_queue = IngestionQueue(rag_system, max_pending_jobs=1)
+
+    # Without workers the first job stays queued
+    ingestion_queue.submit("a b c")
+    with pytest.raises(queue.Full):
+        ingestion_queue.submit("d e f", block=False)
+
+    assert len(ingestion_queue.jobs()) == 1
+    assert ingestion_queue.stats()["pending_jobs"] == 1
+
+
+def test_ingestion_queue_failed_job_cleanup(rag_system):
+    vector_store = rag_system.vector_store
+    get_batch_embedding_vectors = rag_system.get_batch_embedding_vectors
+    first_batch_stored = threading.Event()
+
+    # The second batch of the document fails once the first one is stored
+    def embed_or_fail(texts):
+        if "x" in texts[0]:
+            first_batch_stored.wait(5)
+            raise RuntimeError("embedding provider error")
+
+        return get_batch_embedding_vectors(texts)
+
+    bulk_store_document_chunks = vector_store.bulk_store_document_chunks
+
+    def bulk_store_and_notify(document_chunks, batch_size=1000):
+        document_chunk_ids = bulk_store_document_chunks(document_chunks, batch_size)
+        first_batch_stored.set()
+        return document_chunk_ids
+
+    rag_system.get_batch_embedding_vectors = embed_or_fail
+    vector_store.bulk_store_document_chunks = bulk_store_and_notify
+
+    ingestion_queue = IngestionQueue(rag_system, embedding_batch_size=1).start()
+    job = ingestion_queue.submit("a b c x y z d e f")
+
+    assert job.wait(5)
+    ingestion_queue.close()
+
+    assert first_batch_stored.is_set()
+    assert job.status == IngestionJob.FAILED
+    assert "embedding provider error" in job.error
+    assert job.chunks_stored == 0
+
+    # The stored chunks of the failed document were deleted
+    assert len(vector_store) == 0
@@ -0,0 +1,65 @@
+from rag.instrumentation import Histogram, MetricsInstrumentation
+
+
+def test_histogram_quantile():
+    histogram = Histogram((1, 2, 4))
+
+    assert histogram.quantile(0.5) is None
+
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+
+    assert histogram.bucket_counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == float("inf")
+
+
+def test_render_prometheus():
+    instrumentation = MetricsInstrumentation(
+        prefix="test", latency_buckets=(0.1, 1.0), size_buckets=(8,)
+    )
+
+    instrumentation.observe_duration("similarity_search", 0.05)
+    instrumentation.observe_duration("similarity_search", 0.5)
+    instrumentation.observe_duration("embed_question", 2.0)
+    instrumentation.observe_batch_size("embed_chunks", 10)
+    instrumentation.increment("queries")
+    instrumentation.increment("queries", 2)
+
+    assert instrumentation.render_prometheus() == (
+        "# TYPE test_stage_duration_seconds histogram\n"
+        'test_stage_duration_seconds_bucket{stage="embed_question",le="0.1"} 0\n'
+        'test_stage_duration_seconds_bucket{stage="embed_question",le="1.0"} 0\n'
+        'test_stage_duration_seconds_bucket{stage="embed_question",le="+Inf"} 1\n'
+        'test_stage_duration_seconds_sum{stage="embed_question"} 2.0\n'
+        'test_stage_duration_seconds_count{stage="embed_question"} 1\n'
+        'test_stage_duration_seconds_bucket{stage="similarity_search",le="0.1"} 1\n'
+        'test_stage_duration_seconds_bucket{stage="similarity_search",le="1.0"} 2\n'
+        'test_stage_duration_seconds_bucket{stage="similarity_search",le="+Inf"} 2\n'
+        'test_stage_duration_seconds_sum{stage="similarity_search"} 0.55\n'
+        'test_stage_duration_seconds_count{stage="similarity_search"} 2\n'
+        "# TYPE test_batch_size histogram\n"
+        'test_batch_size_bucket{stage="embed_chunks",le="8"} 0\n'
+        'test_batch_size_bucket{stage="embed_chunks",le="+Inf"} 1\n'
+        'test_batch_size_sum{stage="embed_chunks"} 10\n'
+        'test_batch_size_count{stage="embed_chunks"} 1\n'
+        "# TYPE test_queries_total counter\n"
+        "test_queries_total 3\n"
+    )
+
+
+def test_render_prometheus_stage():
+    instrumentation = MetricsInstrumentation()
+
+    with instrumentation.stage("generate_response"):
+        pass
+
+    # Without observations there is nothing to render
+    assert MetricsInstrumentation().render_prometheus() == "\n"
+    assert (
+        'rag_stage_duration_seconds_count{stage="generate_response"} 1'
+        in instrumentation.render_prometheus().splitlines()
+    )
+    assert (
+        instrumentation.snapshot()["stage_durations"]["generate_response"]["count"] == 1
+    )
@@ -0,0 +1,218 @@
+import uuid
+
+
+import numpy as np
+import pytest
+
+
+from rag.vector_store.base import MissingEmbeddingsError
+from rag.vector_store.numpy_vectorstore import NumpyVectorDB, jsonb_contains
+
+
+COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000001")
+OTHER_COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000002")
+
+
+def unit_vector(index, dimension=4):
+    vector = np.zeros(dimension, dtype=np.float32)
+    vector[index] = 1
+    return vector
+
+
+@pytest.fixture
+def vector_store():
+    vector_store = NumpyVectorDB(vector_dimension=4, initial_capacity=2)
+    vector_store.bulk_store_document_chunks(
+        [
+            (COLLECTION_UUID, "a", unit_vector(0), {"source": "wiki", "page": 1}),
+            (COLLECTION_UUID, "b", unit_vector(1), {"source": "wiki", "page": 2.0}),
+            (
+                OTHER_COLLECTION_UUID,
+                "c",
+                unit_vector(2),
+                {"source": "blog", "tags": ["x", "y"], "flag": True},
+            ),
+            (OTHER_COLLECTION_UUID, "d", unit_vector(3), None),
+        ]
+    )
+    return vector_store
+
+
+def contents(document_chunks):
+    return [document_chunk.content for document_chunk in document_chunks]
+
+
+def test_jsonb_contains():
+    assert jsonb_contains({"a": 1, "b": {"c": [1, 2]}}, {"b": {"c": [2]}})
+    assert jsonb_contains({"a": 1.0}, {"a": 1})
+    assert not jsonb_contains({"a": True}, {"a": 1})
+    assert not jsonb_contains({"a": [1]}, {"a": 1})
+    assert not jsonb_contains(None, {"a": 1})
+
+
+def test_similarity_search(vector_store):
+    document_chunks = vector_store.similarity_search(
+        [1, 0.5, 0, 0], k=3, include_embeddings=True
+    )
+
+    assert contents(document_chunks) == ["a", "b", "c"]
+    assert document_chunks[0].distance == pytest.approx(1 - 1 / np.sqrt(1.25))
+    assert document_chunks[2].distance == pytest.approx(1)
+    np.testing.assert_allclose(document_chunks[0].embedding_vector, unit_vector(0))
+    assert document_chunks[1].embedding_vector is not None
+    assert vector_store.similarity_search([1, 0, 0, 0])[0].embedding_vector is None
+
+
+@pytest.mark.parametrize(
+    "metadata_filter, expected",
+    [
+        ({"source": "wiki"}, ["a", "b"]),
+        ({"source": "wiki", "page": 2}, ["b"]),
+        ({"page": 1.0}, ["a"]),
+        ({"tags": ["y"]}, ["c"]),
+        ({"source": "blog", "flag": True}, ["c"]),
+        ({"flag": 1}, []),
+        ({"source": "news"}, []),
+    ],
+)
+def test_similarity_search_metadata_filter(vector_store, metadata_filter, expected):
+    document_chunks = vector_store.similarity_search(
+        [1, 1, 1, 1], k=4, metadata_filter=metadata_filter
+    )
+
+    assert sorted(contents(document_chunks)) == expected
+
+
+def test_similarity_search_many(vector_store):
+    results = vector_store.similarity_search_many([unit_vector(3), unit_vector(1)], k=1)
+
+    assert [contents(document_chunks) for document_chunks in results] == [
+        ["d"],
+        ["b"],
+    ]
+
+
+def test_delete_document_chunk_by_id(vector_store):
+    document_chunk = vector_store.similarity_search(unit_vector(1), k=1)[0]
+
+    assert vector_store.delete_document_chunk_by_id(document_chunk.id)
+    assert not vector_store.delete_document_chunk_by_id(document_chunk.id)
+    assert len(vector_store) == 3
+    assert contents(vector_store.similarity_search(unit_vector(1), k=4)) == [
+        "a",
+        "c",
+        "d",
+    ]
+    # The tombstoned row is also left out of the cached filter masks
+    assert contents(
+        vector_store.similarity_search(
+            unit_vector(1), k=4, metadata_filter={"source": "wiki"}
+        )
+    ) == ["a"]
+
+
+def test_delete_document_chunks(vector_store):
+    assert vector_store.delete_document_chunks(source="wiki") == 2
+    assert vector_store.delete_document_chunks(source="wiki") == 0
+    assert vector_store.delete_all_chunks_in_collection(OTHER_COLLECTION_UUID) == 2
+    assert len(vector_store) == 0
+    assert vector_store.similarity_search(unit_vector(0)) == []
+
+
+def test_compaction_keeps_ids_and_filters():
+    vector_store = NumpyVectorDB(vector_dimension=4, compaction_threshold=0.25)
+    document_chunk_ids = vector_store.bulk_store_document_chunks(
+        [
+            (COLLECTION_UUID, str(i), unit_vector(i % 4), {"parity": i % 2})
+            for i in range(8)
+        ]
+    )
+
+    for document_chunk_id in document_chunk_ids[:3]:
+        vector_store.delete_document_chunk_by_id(document_chunk_id)
+
+    # The third deletion exceeded the threshold and compacted the store
+    assert vector_store._size == 5
+    assert contents(
+        vector_store.similarity_search(
+            unit_vector(1), k=2, metadata_filter={"parity": 1}
+        )
+    ) == ["5", "3"]
+    assert vector_store.delete_document_chunk_by_id(document_chunk_ids[7])
+    assert len(vector_store) == 4
+
+
+def test_save_and_load(vector_store, tmp_path):
+    vector_store.path = str(tmp_path)
+    vector_store.delete_document_chunks(source="blog")
+    vector_store.save()
+
+    loaded = NumpyVectorDB(vector_dimension=4, path=str(tmp_path))
+
+    assert len(loaded) == 3
+    assert contents(
+        loaded.similarity_search(unit_vector(0), k=3, metadata_filter={"page": 1})
+    ) == ["a"]
+
+    # The memory-mapped matrix is copied on the first write
+    loaded.store_document_chunk(COLLECTION_UUID, "e", unit_vector(2))
+    assert contents(loaded.similarity_search(unit_vector(2), k=1)) == ["e"]
+
+
+def test_upsert_document_chunks(vector_store):
+    vector_store.upsert_document_chunks(
+        COLLECTION_UUID,
+        [(0, "x", "hx", unit_vector(0)), (1, "y", "hy", unit_vector(1))],
+        2,
+    )
+
+    # The chunks stored without upsert are left alone
+    assert vector_store.get_document_chunk_hashes(COLLECTION_UUID) == {
+        0: "hx",
+        1: "hy",
+    }
+    assert len(vector_store) == 6
+
+    # Moved chunks reuse their stored embedding
+    deleted = vector_store.upsert_document_chunks(
+        COLLECTION_UUID,
+        [(0, "y", "hy", None), (1, "z", "hz", unit_vector(2))],
+        2,
+        metadata={"version": 2},
+    )
+
+    assert deleted == 0
+    assert vector_store.get_document_chunk_hashes(COLLECTION_UUID) == {
+        0: "hy",
+        1: "hz",
+    }
+    # The metadata is updated on all the chunks of the collection
+    assert sorted(
+        contents(
+            vector_store.similarity_search(
+                unit_vector(1), k=10, metadata_filter={"version": 2}
+            )
+        )
+    ) == ["a", "b", "y", "z"]
+
+    assert vector_store.upsert_document_chunks(COLLECTION_UUID, [], 1) == 1
+    assert vector_store.get_document_chunk_hashes(COLLECTION_UUID) == {0: "hy"}
+    assert vector_store.get_document_chunk_hashes(OTHER_COLLECTION_UUID) == {}
+
+
+def test_upsert_document_chunks_missing_embedding(vector_store):
+    vector_store.upsert_document_chunks(
+        COLLECTION_UUID, [(0, "x", "hx", unit_vector(0))], 1
+    )
+
+    # Nothing is written when a reused embedding isn't stored
+    with pytest.raises(MissingEmbeddingsError) as exc_info:
+        vector_store.upsert_document_chunks(
+            COLLECTION_UUID,
+            [(0, "y", "hy", None), (1, "x", "hx", None), (2, "z", "hz", None)],
+            3,
+        )
+
+    assert exc_info.value.content_hashes == {"hy", "hz"}
+    assert vector_store.get_document_chunk_hashes(COLLECTION_UUID) == {0: "hx"}
+    assert len(vector_store) == 5
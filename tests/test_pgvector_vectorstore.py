@@ -0,0 +1,192 @@
+import uuid
+
+
+import numpy as np
+import pytest
+
+
+from rag.vector_store.pgvector_vectorstore import (
+    AsyncPgVectorVectorDB,
+    BasePgVectorVectorDB,
+)
+
+
+COLLECTION_UUID = uuid.UUID("00000000-0000-0000-0000-000000000001")
+
+
+# The statements are composed without a server, BasePgVectorVectorDB doesn't
+# connect
+
+
+@pytest.fixture
+def vector_store():
+    return BasePgVectorVectorDB(
+        vector_dimension=3, indexed_metadata_keys=("source", "page")
+    )
+
+
+def test_filter_condition(vector_store):
+    condition, params = vector_store._filter_condition(
+        {"source": "wiki", "lang": "en"}, COLLECTION_UUID
+    )
+
+    # The values of the indexed keys are also compared as text
+    assert (
+        condition.as_string(None)
+        == "collection_uuid = %s AND (metadata ->> 'source') = %s AND metadata @> %s"
+    )
+    assert params[:2] == [COLLECTION_UUID, "wiki"]
+    assert params[2].obj == {"source": "wiki", "lang": "en"}
+
+
+def test_filter_condition_collections(vector_store):
+    condition, params = vector_store._filter_condition(
+        {"lang": "en"}, [COLLECTION_UUID]
+    )
+
+    assert condition.as_string(None) == "collection_uuid = ANY(%s) AND metadata @> %s"
+    assert params[0] == [COLLECTION_UUID]
+    assert vector_store._filter_condition(None) == (None, [])
+
+
+def test_filter_params(vector_store):
+    filter_shape, params = vector_store._filter_params(
+        {"source": "wiki", "page": 1, "lang": "en"}, COLLECTION_UUID
+    )
+
+    # Only the string values of the indexed keys are compared as text
+    assert filter_shape == ("collection_uuid", ("metadata_value", "source"), "metadata")
+    assert params[:2] == [COLLECTION_UUID, "wiki"]
+    assert params[2].obj == {"source": "wiki", "page": 1, "lang": "en"}
+
+
+def test_filter_params_collections(vector_store):
+    filter_shape, params = vector_store._filter_params(
+        None, (COLLECTION_UUID, COLLECTION_UUID)
+    )
+
+    assert filter_shape == ("collection_uuids",)
+    assert params == [[COLLECTION_UUID, COLLECTION_UUID]]
+    assert vector_store._filter_params(None) == ((), [])
+
+
+def test_filter_shape_condition(vector_store):
+    filter_shape, _ = vector_store._filter_params({"source": "wiki"}, [COLLECTION_UUID])
+
+    assert (
+        vector_store._filter_shape_condition(filter_shape).as_string(None)
+        == "collection_uuid = ANY(%s) AND (metadata ->> 'source') = %s AND metadata @> %s"
+    )
+    assert vector_store._filter_shape_condition(()) is None
+
+
+def test_similarity_search_query(vector_store):
+    query, params = vector_store._similarity_search_query(
+        [1, 0, 0], 5, {"source": "wiki"}, collection_uuid=COLLECTION_UUID
+    )
+
+    assert "WHERE collection_uuid = %s AND (metadata ->> 'source') = %s" in query
+    assert query.count("%s") == len(params) - 1
+    assert params[0].dtype == np.float32
+    assert params[1:3] == [COLLECTION_UUID, "wiki"]
+    assert params[-1] == 5
+
+
+def test_search_statements_are_cached_by_shape(vector_store):
+    query, _ = vector_store._similarity_search_query([1, 0, 0], 5, {"source": "a"})
+    other_query, _ = vector_store._similarity_search_query(
+        [0, 1, 0], 10, {"source": "b"}
+    )
+
+    # Different values and k share the statement
+    assert other_query is query
+    assert len(vector_store._search_queries) == 1
+
+    vector_store._similarity_search_query([1, 0, 0], 5, {"lang": "en"})
+    vector_store._similarity_search_query([1, 0, 0], 5, None, include_embeddings=True)
+    vector_store._similarity_search_many_query([[1, 0, 0]], 5, {"source": "a"})
+
+    assert sorted(vector_store._search_queries, key=repr) == sorted(
+        [
+            (
+                "similarity_search",
+                (("metadata_value", "source"), "metadata"),
+                vector_store._search_columns(),
+                None,
+            ),
+            ("similarity_search", ("metadata",), vector_store._search_columns(), None),
+            ("similarity_search", (), vector_store._search_columns(True), None),
+            (
+                "similarity_search_many",
+                (("metadata_value", "source"), "metadata"),
+                vector_store._search_columns(),
+                None,
+            ),
+        ],
+        key=repr,
+    )
+
+
+def test_quantized_search_statements_are_cached_by_candidates():
+    vector_store = BasePgVectorVectorDB(
+        vector_dimension=3, index_precision="half", oversampling=4
+    )
+
+    query, params = vector_store._similarity_search_query([1, 0, 0], 10, None)
+    other_query, _ = vector_store._similarity_search_query([1, 0, 0], 50, None)
+    exact_query, _ = vector_store._similarity_search_query(
+        [1, 0, 0], 10, None, search_params={"exact": True}
+    )
+
+    # The number of candidates of the index is in the statement
+    assert "LIMIT 40" in query
+    assert "LIMIT 200" in other_query
+    assert "halfvec" not in exact_query
+    assert params[-1] == 10
+    assert [search_shape[-1] for search_shape in vector_store._search_queries] == [
+        40,
+        200,
+        None,
+    ]
+
+
+def test_search_columns():
+    assert BasePgVectorVectorDB._search_columns(columns=["id", "distance"]) == (
+        "id",
+        "distance",
+    )
+
+    with pytest.raises(ValueError):
+        BasePgVectorVectorDB._search_columns(columns=["password"])
+
+
+def test_full_text_search_column_in_create_table(vector_store):
+    statements = [
+        statement.as_string(None)
+        for statement in vector_store._init_db_statements(
+            m=16,
+            ef_construction=64,
+            table_name=vector_store.table_name,
+            embedding_idx_name=vector_store.embedding_idx_name,
+            vector_dimension=3,
+            full_text_search=True,
+        )
+    ]
+
+    # The column comes with new tables, the startup never rewrites a table
+    assert "content_tsv tsvector GENERATED ALWAYS" in statements[0]
+    assert not any("ADD COLUMN IF NOT EXISTS content_tsv" in s for s in statements)
+    assert (
+        "ADD COLUMN IF NOT EXISTS content_tsv"
+        in vector_store._add_text_search_column_statement().as_string(None)
+    )
+
+
+def test_async_vector_store_blocking_methods():
+    vector_store = AsyncPgVectorVectorDB(vector_dimension=3)
+
+    with pytest.raises(RuntimeError, match=r"use await AsyncPgVectorVectorDB.aclose"):
+        vector_store.close()
+
+    with pytest.raises(RuntimeError, match=r"\.asimilarity_search\(\)"):
+        vector_store.similarity_search([1, 0, 0])
@@ -0,0 +1,65 @@
+import datetime
+import uuid
+
+
+import numpy as np
+
+
+from rag.document import DocumentChunk
+from rag.rerank import MMRReranker, maximal_marginal_relevance
+
+
+# Two near duplicates close to the query and a less relevant, different one
+CANDIDATE_EMBEDDINGS = np.array(
+    [[1.0, 0.1, 0.0], [1.0, 0.12, 0.0], [0.6, 0.0, 0.8]], dtype=np.float32
+)
+QUERY_EMBEDDING = np.array([1.0, 0.0, 0.0])
+
+
+def test_mmr_relevance_only():
+    assert maximal_marginal_relevance(
+        QUERY_EMBEDDING, CANDIDATE_EMBEDDINGS, k=3, lambda_mult=1
+    ) == [0, 1, 2]
+
+
+def test_mmr_skips_near_duplicates():
+    assert maximal_marginal_relevance(
+        QUERY_EMBEDDING, CANDIDATE_EMBEDDINGS, k=2, lambda_mult=0.5
+    ) == [0, 2]
+
+
+def test_mmr_ignores_vector_norms():
+    assert maximal_marginal_relevance(
+        3 * QUERY_EMBEDDING,
+        CANDIDATE_EMBEDDINGS * np.array([[10.0], [0.5], [2.0]], dtype=np.float32),
+        k=2,
+    ) == [0, 2]
+
+
+def test_mmr_k_bounds():
+    assert maximal_marginal_relevance(QUERY_EMBEDDING, CANDIDATE_EMBEDDINGS, k=5) == [
+        0,
+        2,
+        1,
+    ]
+    assert maximal_marginal_relevance(QUERY_EMBEDDING, CANDIDATE_EMBEDDINGS, k=0) == []
+    assert maximal_marginal_relevance(QUERY_EMBEDDING, [], k=3) == []
+
+
+def test_mmr_reranker():
+    candidates = [
+        DocumentChunk(
+            id=i,
+            collection_uuid=uuid.uuid4(),
+            content=str(i),
+            created_at=datetime.datetime(2024, 1, 1),
+            embedding_vector=embedding_vector,
+        )
+        for i, embedding_vector in enumerate(CANDIDATE_EMBEDDINGS)
+    ]
+
+    reranked = MMRReranker(lambda_mult=0.5).rerank(
+        "question", QUERY_EMBEDDING, candidates, 2
+    )
+
+    assert [candidate.id for candidate in reranked] == [0, 2]
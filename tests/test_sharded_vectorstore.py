@@ -0,0 +1,184 @@
+import asyncio
+import datetime
+import uuid
+
+
+import numpy as np
+import pytest
+
+
+from rag.document import DocumentChunk
+from rag.vector_store.numpy_vectorstore import NumpyVectorDB
+from rag.vector_store.sharded_vectorstore import (
+    ShardedVectorDB,
+    global_document_chunk_id,
+    merge_by_distance,
+    merge_by_rank,
+    split_document_chunk_id,
+)
+
+
+def unit_vector(index, dimension=4):
+    vector = np.zeros(dimension, dtype=np.float32)
+    vector[index] = 1
+    return vector
+
+
+def document_chunk(id, distance=None):
+    return DocumentChunk(
+        id=id,
+        collection_uuid=uuid.UUID(int=0),
+        content=str(id),
+        created_at=datetime.datetime(2024, 1, 1),
+        distance=distance,
+    )
+
+
+class FailingVectorDB(NumpyVectorDB):
+    def similarity_search_many(self, *args, **kwargs):
+        raise ConnectionError("replica down")
+
+
+@pytest.fixture
+def vector_store():
+    vector_store = ShardedVectorDB(
+        [NumpyVectorDB(vector_dimension=4), NumpyVectorDB(vector_dimension=4)]
+    )
+    yield vector_store
+    vector_store.close()
+
+
+def collection_uuids(vector_store):
+    """A collection uuid of each shard"""
+    collection_uuids = {}
+    for i in range(100):
+        collection_uuids.setdefault(
+            vector_store.shard_index(uuid.UUID(int=i)), uuid.UUID(int=i)
+        )
+
+    return [collection_uuids[i] for i in range(len(vector_store.shards))]
+
+
+def test_document_chunk_ids():
+    document_chunk_id = global_document_chunk_id(3, 12345)
+
+    assert document_chunk_id == (3 << 48) + 12345
+    assert split_document_chunk_id(document_chunk_id) == (3, 12345)
+    assert split_document_chunk_id(global_document_chunk_id(0, 7)) == (0, 7)
+
+
+def test_routing(vector_store):
+    collection_uuid_0, collection_uuid_1 = collection_uuids(vector_store)
+
+    # The routing only depends on the collection uuid
+    assert vector_store.shard_index(str(collection_uuid_1)) == 1
+
+    document_chunk_ids = vector_store.bulk_store_document_chunks(
+        [
+            (collection_uuid_0, "a", unit_vector(0), None),
+            (collection_uuid_1, "b", unit_vector(1), None),
+            (collection_uuid_0, "c", unit_vector(2), None),
+        ],
+        batch_size=1,
+    )
+    document_chunk = vector_store.store_document_chunk(
+        collection_uuid_1, "d", unit_vector(3)
+    )
+
+    assert [len(shard) for shard in vector_store.shards] == [2, 2]
+    assert [
+        split_document_chunk_id(document_chunk_id)[0]
+        for document_chunk_id in document_chunk_ids + [document_chunk.id]
+    ] == [0, 1, 0, 1]
+
+    # The chunks are deleted from their shard
+    vector_store.delete_document_chunk_by_id(document_chunk_ids[1])
+    vector_store.delete_all_chunks_in_collection(collection_uuid_0)
+    assert [len(shard) for shard in vector_store.shards] == [0, 1]
+
+    assert vector_store._search_shard_indices({}) == range(2)
+    assert vector_store._search_shard_indices(
+        {"collection_uuid": [collection_uuid_1, collection_uuid_1]}
+    ) == [1]
+
+
+def test_merge():
+    assert [
+        document_chunk.id
+        for document_chunk in merge_by_distance(
+            [
+                [document_chunk(1, 0.1), document_chunk(2, 0.4)],
+                [document_chunk(3, 0.2), document_chunk(4, 0.3)],
+            ],
+            3,
+        )
+    ] == [1, 3, 4]
+
+    # The hybrid search results are interleaved by rank
+    assert [
+        document_chunk.id
+        for document_chunk in merge_by_rank(
+            [
+                [document_chunk(1), document_chunk(2), document_chunk(5)],
+                [document_chunk(3)],
+            ],
+            3,
+        )
+    ] == [1, 3, 2]
+
+
+def test_similarity_search(vector_store):
+    collection_uuid_0, collection_uuid_1 = collection_uuids(vector_store)
+
+    vector_store.store_document_chunk(collection_uuid_0, "a", [1, 0, 0, 0])
+    vector_store.store_document_chunk(collection_uuid_0, "b", [0, 1, 0.5, 0])
+    vector_store.store_document_chunk(collection_uuid_1, "c", [1, 0.5, 0, 0])
+    vector_store.store_document_chunk(collection_uuid_1, "d", [0, 0, 1, 0])
+
+    results = vector_store.similarity_search_many([unit_vector(0), unit_vector(2)], k=2)
+
+    # The top k of the shards are merged by distance, with global ids
+    assert [[doc.content for doc in docs] for docs in results] == [
+        ["a", "c"],
+        ["d", "b"],
+    ]
+
+    # The global ids address the chunks in their shard
+    vector_store.delete_document_chunk_by_id(results[0][1].id)
+    assert [doc.content for doc in vector_store.similarity_search(unit_vector(0))] == [
+        "a",
+        "b",
+        "d",
+    ]
+
+    with pytest.raises(ValueError):
+        vector_store.similarity_search(unit_vector(0), columns=("content",))
+
+
+def test_asimilarity_search(vector_store):
+    collection_uuid_0, collection_uuid_1 = collection_uuids(vector_store)
+
+    vector_store.store_document_chunk(collection_uuid_0, "a", unit_vector(0))
+    vector_store.store_document_chunk(collection_uuid_1, "b", [1, 1, 0, 0])
+
+    results = asyncio.run(vector_store.asimilarity_search(unit_vector(0), k=2))
+
+    assert [doc.content for doc in results] == ["a", "b"]
+    assert [split_document_chunk_id(doc.id)[0] for doc in results] == [0, 1]
+
+
+def test_read_replica_fallback():
+    primary = NumpyVectorDB(vector_dimension=4)
+    vector_store = ShardedVectorDB(
+        [primary], replicas=[[FailingVectorDB(vector_dimension=4)]]
+    )
+
+    vector_store.store_document_chunk(uuid.uuid4(), "a", unit_vector(0))
+
+    # The writes go to the primary, the searches fall back to it
+    assert len(primary) == 1
+    assert [doc.content for doc in vector_store.similarity_search(unit_vector(0))] == [
+        "a"
+    ]
+
+    vector_store.close()
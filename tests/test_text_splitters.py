@@ -0,0 +1,43 @@
+from rag.text_splitters import WordTextSplitter, chunk_text
+
+
+TEXT = "  alpha beta\tgamma\n\ndelta  epsilon zeta eta   theta iota "
+
+
+def test_word_text_splitter_offsets():
+    chunks = list(WordTextSplitter(chunk_size=4, overlap=1)(TEXT))
+
+    assert [chunk.text for chunk in chunks] == [
+        "alpha beta gamma delta",
+        "delta epsilon zeta eta",
+        "eta theta iota",
+    ]
+
+    # The offsets span the chunk words in the original text
+    for chunk in chunks:
+        assert TEXT[chunk.start : chunk.end].split() == chunk.text.split()
+
+    assert chunks[0].start == TEXT.index("alpha")
+    assert chunks[-1].end == TEXT.index("iota") + len("iota")
+
+
+def test_word_text_splitter_short_text():
+    chunks = list(WordTextSplitter(chunk_size=10, overlap=2)("one two  three"))
+
+    assert chunks == [("one two three", 0, 14)]
+
+
+def test_word_text_splitter_empty_text():
+    assert list(WordTextSplitter(chunk_size=10, overlap=2)("  \n ")) == []
+
+
+def test_chunk_text():
+    words = ["w%s" % i for i in range(10)]
+
+    assert chunk_text(" ".join(words), chunk_size=4, overlap=2) == [
+        "w0 w1 w2 w3",
+        "w2 w3 w4 w5",
+        "w4 w5 w6 w7",
+        "w6 w7 w8 w9",
+        "w8 w9",
+    ]